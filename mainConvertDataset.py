@@ -0,0 +1,36 @@
+import argparse
+import time
+
+from utils.XLFMDataset import XLFMDatasetFull
+from utils.PreprocessedDataset import convert_dataset
+
+# Convert a raw dataset (XLFM_image/XLFM_image_stack.tif, XLFM_stack/*.tif and the sparse ones) once into the preprocessed
+# format of utils/PreprocessedDataset.py. Training scripts given --data_folder pointing to the output folder then memory map the
+# frames and volumes as they are used in training, without decoding the tiffs or converting them again.
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_folder', nargs='?', default="", help='Input dataset path, with XLFM_image/XLFM_image_stack.tif and XLFM_stack/*.tif.')
+parser.add_argument('--output_folder', nargs='?', default="", help='Output path for the preprocessed dataset.')
+parser.add_argument('--lenslet_file', nargs='?', default= "lenslet_coords.txt")
+parser.add_argument('--images_to_use', nargs='+', type=int, default=None, help='Indices of the frames to convert, all of them by default.')
+parser.add_argument('--img_size', type=int, default=2160, help='Side size of the stored frames, as img_shape of the training scripts.')
+parser.add_argument('--n_depths', type=int, default=120, help='Depths of the stored volumes, as n_depths_to_fill of the datasets.')
+parser.add_argument('--border_blanking', type=int, default=10, help='Voxels set to zero at the borders of the volumes.')
+parser.add_argument('--lenslets_offset', type=int, default=0)
+parser.add_argument('--load_sparse', type=int, default=1, help='Store the sparse frames and volumes (XLFM_image_stack_S.tif and XLFM_stack_S). 0 or 1')
+parser.add_argument('--load_vols', type=int, default=1, help='Store the volumes. 0 or 1')
+parser.add_argument('--dense_vols', type=int, default=0, help='With load_sparse, store also the volumes of XLFM_stack, for loading the dataset without load_sparse. 0 or 1')
+parser.add_argument('--compression', type=int, default=0, help='zlib level to compress the chunks, lossless. 0 to store them uncompressed and memory map them.')
+parser.add_argument('--chunk_size', type=int, default=16, help='Frames or volumes per chunk.')
+parser.add_argument('--lenslet_views', type=int, default=0, help='Store also the lenslet views of the frames, for --dataset_views of mainTrainXLFMNet.py. 0 or 1')
+parser.add_argument('--subimage_size', type=int, default=512, help='Side size of the lenslet views, as subimage_shape of the SLNet training.')
+args = parser.parse_args()
+
+start = time.time()
+dataset = XLFMDatasetFull(args.data_folder, args.lenslet_file, 2*[args.subimage_size], img_shape=2*[args.img_size], images_to_use=args.images_to_use,
+            lenslets_offset=args.lenslets_offset, n_depths_to_fill=args.n_depths, border_blanking=args.border_blanking,
+            load_vols=args.load_vols==1, load_sparse=args.load_sparse==1, lazy=True, cache_size=0)
+manifest = convert_dataset(dataset, args.output_folder, compression=args.compression, chunk_size=args.chunk_size, dense_volumes=args.dense_vols==1,
+            lenslet_views=args.lenslet_views==1)
+print('Converted ' + str(len(manifest['images_to_use'])) + ' frames to ' + args.output_folder + ' (' + str(round(time.time()-start,1)) + 's)')
+if len(manifest['volume_errors'])>0:
+    print(str(len(manifest['volume_errors'])) + ' volumes could not be loaded and were stored empty, see ' + args.output_folder + '/manifest.json')
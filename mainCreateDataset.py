@@ -23,6 +23,9 @@ import utils.pytorch_shot_noise as pytorch_shot_noise
 from utils.XLFMDataset import XLFMDatasetFull
 from utils.misc_utils import *
 from utils.XLFMDeconv import *
+from utils.OTFStore import load_PSF_OTF_store
+from utils.XLFMDeconvPool import XLFMDeconvPool
+from utils.MemoryPlanner import plan_depth_chunk
 from nets.SLNet import *
 
 
@@ -34,14 +37,19 @@ parser.add_argument('--volume_sparse_reference_path', nargs='?', default= '*tif'
 parser.add_argument('--lenslet_file', nargs='?', default= "lenslet_centers_python.txt")
 parser.add_argument('--files_to_store', nargs='+', default=[], help='Relative paths of files to store in a zip when running this script, for backup.')
 parser.add_argument('--prefix', nargs='?', default= "fishy", help='Prefix string for the output folder.')
+parser.add_argument('--resume_dir', nargs='?', default='', help='Output folder of an interrupted run to resume, skipping its finished simulations. Empty to start a new one.')
 parser.add_argument('--checkpoint', nargs='?', default= "", help='File path of checkpoint of SLNet.')
 parser.add_argument('--psf_file', nargs='?', default= "PSF_2.5um_processed.mat", help='.mat matlab file with PSF stack, used for deconvolution.')
+parser.add_argument('--otf_cache_dir', nargs='?', default=OTF_CACHE_DIR, help='Directory to cache the computed OTFs, empty to disable caching.')
+parser.add_argument('--otf_fftshift', type=int, default=0, help='Fold the fftshift into the OTF as a phase ramp, removing the shift copies after every FFT. 0 or 1')
+parser.add_argument('--otf_max_ram_gb', type=float, default=0, help='RAM ceiling for the OTF in deconvolution, the rest is streamed from the OTF cache. 0 to keep it all in memory.')
 # Images related arguments
 parser.add_argument('--images_to_use', nargs='+', type=int, default=list(range(0,193,1)), help='Indeces of images to train on.')
 parser.add_argument('--n_simulations', type=int, default=50, help='Number of samples to generate.')
 
 # Noise arguments
 parser.add_argument('--add_noise', type=int, default=0, help='Apply noise to images? 0 or 1')
+parser.add_argument('--simulation_seed', type=int, default=0, help='Seed of the random numbers of simulation 0 (noise, signal power, z roll), simulation n uses simulation_seed+n, so resumed runs repeat them.')
 parser.add_argument('--signal_power_max', type=float, default=30**2, help='Max signal value to control signal to noise ratio when applyting noise.')
 parser.add_argument('--signal_power_min', type=float, default=60**2, help='Min signal value to control signal to noise ratio when applyting noise.')
 parser.add_argument('--dark_current', type=float, default=106, help='Dark current value of camera.')
@@ -59,7 +67,23 @@ parser.add_argument('--deconv_n_depths', type=int, default=120, help='Number of
 parser.add_argument('--n_depths', type=int, default=120, help='Number of depths to create in 3D deconvolution.')
 parser.add_argument('--deconv_limit', type=float, default=10000, help='Maximum intensity allowed from doconvolution.')
 parser.add_argument('--deconv_depth_split', type=int, default=6, help='Number of depths to simultaneously deconvolve in the gpu.')
+parser.add_argument('--deconv_batch_size', type=int, default=6, help='Number of images to deconvolve simultaneously, sharing the OTF loads.')
 parser.add_argument('--deconv_gpu', type=int, default=1, help='GPU to use for deconvolution, -1 to use CPU, this is very memory intensive.')    
+parser.add_argument('--deconv_forward_mode', nargs='?', default='per_depth', help='Forward projection in deconvolution: per_depth or spectral (single inverse FFT per iteration).')
+parser.add_argument('--deconv_acceleration', nargs='?', default='none', help='Richardson-Lucy update: none or biggs_andrews (vector extrapolation).')
+parser.add_argument('--deconv_stop_criterion', nargs='?', default='none', help='Stop deconvolution on relative change of the error or the volume: none, error or volume.')
+parser.add_argument('--deconv_stop_tol', type=float, default=1e-3, help='Relative change below which deconvolution stops.')
+parser.add_argument('--deconv_precision', nargs='?', default='float32', help='Storage precision of the OTF and volume in deconvolution: float32, float16 or bfloat16.')
+parser.add_argument('--deconv_skip_tol', type=float, default=0, help='Skip the depths with less energy than this fraction of the brightest one in deconvolution, 0 to use all depths.')
+parser.add_argument('--deconv_median_mode', nargs='?', default='exact', help='Median used to clamp the deconvolution updates: exact, subsampled or histogram (faster approximations).')
+parser.add_argument('--memory_budget', type=float, default=0, help='Memory in GB for the chunks of depths convolved at once, which are then chosen by the memory planner. 0 to use deconv_depth_split, -1 to use the free memory.')
+parser.add_argument('--deconv_guard_depths', type=int, default=-1, help='Deconvolve only the central n_depths, with this many guard depths on each side. -1 to deconvolve all deconv_n_depths and keep the central n_depths.')
+parser.add_argument('--deconv_workers', type=int, default=0, help='Processes to split the depths of the CPU deconvolution, 0 to deconvolve in the main process.')
+parser.add_argument('--deconv_pyramid', nargs='+', type=int, default=[1], help='Downsampling of each level of a coarse to fine deconvolution, e.g. 4 2 1. The last one must be 1.')
+parser.add_argument('--deconv_pyramid_iterations', nargs='+', type=int, default=[], help='Iterations of each coarse level of deconv_pyramid, the full resolution runs deconv_iterations.')
+parser.add_argument('--deconv_checkpoint_every', type=int, default=10, help='Iterations between deconvolution checkpoints, to resume interrupted runs with --resume_dir. 0 to disable.')
+parser.add_argument('--dataset_lazy', type=int, default=0, help='Memory map the image stack and decode the frames when needed, instead of loading it in memory. 0 or 1')
+parser.add_argument('--dataset_cache_size', type=int, default=64, help='Decoded frames and volumes kept in memory with --dataset_lazy.')
 
 parser.add_argument('--output_path', nargs='?', default='')
 # parser.add_argument('--output_path', nargs='?', default=runs_dir + '/garbage/')
@@ -97,7 +121,8 @@ if len(args.checkpoint)>0:
 # Get images
 dataset = XLFMDatasetFull(args.data_folder, args.lenslet_file, argsModel.subimage_shape, img_shape=2*[argsModel.img_size],
             images_to_use=args.images_to_use, divisor=1, isTiff=True, n_frames_net=argsModel.n_frames, 
-            load_all=True, load_sparse=False, load_vols=False, temporal_shifts=args.temporal_shifts, eval_video=True)
+            load_all=True, load_sparse=False, load_vols=False, temporal_shifts=args.temporal_shifts, eval_video=True,
+            lazy=args.dataset_lazy==1, cache_size=args.dataset_cache_size)
 
 # Get normalization values 
 max_images,max_images_sparse,max_volumes = dataset.get_max()
@@ -124,18 +149,23 @@ train_sampler = SequentialSampler(dataset)
 # Create output directory
 head, tail = os.path.split(args.checkpoint)
 output_dir = head + '/Dataset_' + datetime.now().strftime('%Y_%m_%d__%H:%M:%S') + '_' + str(args.n_depths) + 'nD__' + str(args.n_simulations) + 'nS__' + args.prefix
+if args.resume_dir:
+    output_dir = args.resume_dir.rstrip('/')
 print('Output directory: ' + output_dir)
 # Create directories
 # XLFM_image: Raw XLFM image
 # XLFM_stack: Deconvolution of raw images (not computed here)
 # XLFM_stack_S: Deconvolution of sparse image generated by SD algorithm
 # XLFM_stack_SL: Deconvolution of sparse image generated by SLNet
-if not os.path.exists(output_dir):
-    os.mkdir(output_dir)
-    os.mkdir(output_dir + '/XLFM_image')
-    os.mkdir(output_dir + '/XLFM_stack')
-    os.mkdir(output_dir + '/XLFM_stack_S')
-    os.mkdir(output_dir + '/XLFM_stack_S_SL')
+# simulations: Images of every finished simulation, to skip them when resuming
+# checkpoints: Checkpoints of the deconvolutions in progress
+for sub_dir in ['XLFM_image','XLFM_stack','XLFM_stack_S','XLFM_stack_S_SL','simulations','checkpoints']:
+    os.makedirs(output_dir + '/' + sub_dir, exist_ok=True)
+# Checkpoint file of a deconvolution, or None if checkpoints are disabled
+def deconv_checkpoint_path(name):
+    if args.deconv_checkpoint_every <= 0:
+        return None
+    return output_dir + '/checkpoints/' + name + '.pt'
 
 # Tensorboard logger
 writer = SummaryWriter(output_dir)
@@ -177,10 +207,54 @@ end_time_deconv_net = 0
 psf_shape = 2*[argsModel.img_size]
 if currArgs.deconv_iterations > 0:
     n_split = 20
-    OTF,psf_shape = load_PSF_OTF(currArgs.psf_file, output_shape, n_depths=args.deconv_n_depths, 
-                                n_split=n_split, lenslet_centers_file_out="", compute_transpose=True)
+    # Stream the OTF from disk with bounded RAM, or keep it in memory
+    if args.otf_max_ram_gb > 0:
+        OTF,psf_shape = load_PSF_OTF_store(currArgs.psf_file, output_shape, n_depths=args.deconv_n_depths, n_split=n_split,
+                                    cache_dir=args.otf_cache_dir, max_ram_gb=args.otf_max_ram_gb, chunk_depths=args.deconv_depth_split,
+                                    fftshift_in_OTF=args.otf_fftshift==1)
+        print('Streaming OTF from ' + OTF.otf_path + ', ' + str(OTF.n_resident) + ' / ' + str(OTF.n_depths) + ' depths in RAM')
+    else:
+        OTF,psf_shape = load_PSF_OTF(currArgs.psf_file, output_shape, n_depths=args.deconv_n_depths, 
+                                    n_split=n_split, lenslet_centers_file_out="", compute_transpose=True, cache_dir=args.otf_cache_dir,
+                                    fftshift_in_OTF=args.otf_fftshift==1)
 
     # OTF = OTF[:,OTF.shape[1]//2,...].unsqueeze(1).repeat(1,OTF.shape[1],1,1,1)
+# Deconvolution settings shared by all XLFMDeconv calls
+deconv_settings = {'forward_mode':args.deconv_forward_mode, 'acceleration':args.deconv_acceleration,
+                    'stop_criterion':args.deconv_stop_criterion, 'stop_tol':args.deconv_stop_tol, 'precision':args.deconv_precision,
+                    'fftshift_in_OTF':args.otf_fftshift==1, 'skip_tol':args.deconv_skip_tol,
+                    'median_mode':args.deconv_median_mode}
+# Depths deconvolved at once, from the memory budget of the deconvolution device
+if currArgs.deconv_iterations > 0 and args.memory_budget != 0:
+    args.deconv_depth_split = plan_depth_chunk([OTF.shape[2], 2*(OTF.shape[3]-1)], args.deconv_n_depths, batch_size=max(args.deconv_batch_size,1),
+                                            memory_budget_gb=args.memory_budget, device=device_deconv, cache_dir=args.otf_cache_dir, verbose=True)
+# OTFs of the coarse levels of the pyramid deconvolution, they are small and kept in memory
+OTF_pyramid = []
+assert args.deconv_pyramid[-1]==1 and len(args.deconv_pyramid_iterations)==len(args.deconv_pyramid)-1, \
+    'deconv_pyramid should end with 1, with deconv_pyramid_iterations for each of the other levels.'
+if currArgs.deconv_iterations > 0:
+    for downS in args.deconv_pyramid[:-1]:
+        OTF_pyramid.append(load_PSF_OTF(currArgs.psf_file, output_shape, n_depths=args.deconv_n_depths, n_split=n_split, downS=downS,
+                                    lenslet_centers_file_out="", compute_transpose=True, cache_dir=args.otf_cache_dir,
+                                    fftshift_in_OTF=args.otf_fftshift==1)[0])
+# Deconvolution of the images that generate the volumes of the dataset, coarse to fine if a pyramid is used
+# With a depth_range only those depths are deconvolved, with a guard band of deconv_guard_depths
+def deconvolve(img, nIt, depth_range=None, **kwargs):
+    if depth_range is not None:
+        return XLFMDeconvROI(OTF, img, nIt, depth_range=depth_range, guard_depths=args.deconv_guard_depths, **kwargs)
+    if len(OTF_pyramid)==0:
+        return XLFMDeconv(OTF, img, nIt, **kwargs)
+    return XLFMDeconvPyramid(OTF_pyramid + [OTF], img, args.deconv_pyramid_iterations + [nIt], downS=args.deconv_pyramid, **kwargs)
+# Central depths kept in the dataset, optionally the only ones deconvolved
+central_depths = [args.deconv_n_depths//2-args.n_depths//2, args.deconv_n_depths//2+args.n_depths//2]
+assert args.deconv_guard_depths < 0 or (args.otf_max_ram_gb==0 and args.deconv_workers==0 and len(args.deconv_pyramid)==1), \
+    'deconv_guard_depths needs an in memory OTF, and can not be used with deconv_workers or deconv_pyramid.'
+# Split the depths of the CPU deconvolution between worker processes
+deconv_pool = None
+if currArgs.deconv_iterations > 0 and args.deconv_workers > 0:
+    assert device_deconv=='cpu' and args.otf_max_ram_gb==0 and args.deconv_precision=='float32', \
+        'deconv_workers needs the CPU deconvolution (deconv_gpu -1), an in memory OTF and float32 precision.'
+    deconv_pool = XLFMDeconvPool(OTF, args.deconv_workers, ObjSize=output_shape[:2], max_batch_size=max(args.deconv_batch_size,1))
 # If augmentation desired, check if the deconvolved volumes are already computed
 if args.max_z_roll_augm > 0:
     precomputed_volume_path = {'raw' : os.path.split(args.volume_raw_reference_path)[0],
@@ -211,7 +285,18 @@ with torch.no_grad():
     for nSimul in range(args.n_simulations):
         print('Simulating ' + str(nSimul) + ' / ' + str(args.n_simulations) )
         curr_index = nSimul%n_images
+        curr_img_ix = nSimul * len(args.temporal_shifts)
+
+        # Skip the simulations finished in a previous run, their volumes are already stored
+        simulation_path = output_dir + '/simulations/simulation_' + "%03d" % nSimul + '.npy'
+        if os.path.exists(simulation_path):
+            all_images[:,curr_img_ix:curr_img_ix+len(args.temporal_shifts),...] = np.load(simulation_path)
+            print('Simulation ' + str(nSimul) + ' already finished, skipping')
+            continue
         
+        # Same noise and augmentation when a simulation is run again, so the images match its deconvolution checkpoints
+        torch.manual_seed(args.simulation_seed + nSimul)
+
         # fetch current pair
         curr_img_stack, local_volumes = dataset.__getitem__(curr_index)
         curr_img_stack = curr_img_stack.unsqueeze(0)
@@ -277,14 +362,51 @@ with torch.no_grad():
             except:
                 start.record()
                 img_to_deconv_net = sparse_part[:,currArgs.frame_to_grab].unsqueeze(1).float()
-                deconv_vol,proj_net,forward_net,_ = XLFMDeconv(OTF, img_to_deconv_net, currArgs.deconv_iterations, 
+                deconv_vol,proj_net,forward_net,_,deconv_stats = deconvolve(img_to_deconv_net, currArgs.deconv_iterations, 
+                                                    depth_range=central_depths if args.deconv_guard_depths>=0 else None,
                                                     device=device_deconv, all_in_device=0, 
-                                                    nSplitFourier=args.deconv_depth_split,max_allowed=args.deconv_limit)
+                                                    nSplitFourier=args.deconv_depth_split,max_allowed=args.deconv_limit,
+                                                    return_stats=True, pool=deconv_pool, checkpoint_path=deconv_checkpoint_path('deconv_S_' + "%03d" % nSimul),
+                                                    checkpoint_every=args.deconv_checkpoint_every, **deconv_settings)
                 end.record()
                 torch.cuda.synchronize()
                 end_time_deconv_net = start.elapsed_time(end) / curr_img_stack.shape[0]
-                deconv_vol = deconv_vol[:, currArgs.deconv_n_depths//2-currArgs.n_depths//2 : currArgs.deconv_n_depths//2+currArgs.n_depths//2,...]
+                if deconv_vol.shape[1] > currArgs.n_depths:
+                    deconv_vol = deconv_vol[:, central_depths[0] : central_depths[1],...]
                 print(end_time_deconv_net,'s  ',str(deconv_vol.max()))
+                if len(deconv_stats)>0:
+                    print('Deconv iterations: ' + str(len(deconv_stats)) + '\t currErr: ' + str(deconv_stats[-1]['error'][0]))
+                    writer.add_scalar('deconv/iterations', len(deconv_stats), nSimul)
+                    writer.add_scalar('deconv/error', deconv_stats[-1]['error'][0], nSimul)
+                    if args.deconv_skip_tol > 0:
+                        print('Deconv skipped planes in the last iteration: ' + str(deconv_stats[-1]['skipped_planes']) + ' / ' + str(args.deconv_n_depths))
+                        writer.add_scalar('deconv/skipped_planes', deconv_stats[-1]['skipped_planes'], nSimul)
+                    if deconv_pool is not None:
+                        mean_utilization = np.mean([s['worker_utilization'] for s in deconv_stats if 'worker_utilization' in s])
+                        print('Deconv time per iteration: ' + str(round(np.mean([s['time'] for s in deconv_stats]),2)) + 's\t worker utilization: ' + str(round(mean_utilization,3)))
+                        writer.add_scalar('deconv/worker_utilization', mean_utilization, nSimul)
+                # Report once how much the spectral forward projection differs from the per depth one
+                # with the OTF depths of the stored volume, read at once from an OTFStore
+                if args.deconv_forward_mode=='spectral' and nSimul==0:
+                    OTF_central = OTF[:,central_depths[0]:central_depths[1]] if torch.is_tensor(OTF) else OTF[...,0][:,central_depths[0]:central_depths[1],...].unsqueeze(-1)
+                    forward_mode_error = XLFM_forward_mode_error(OTF_central, deconv_vol, nSplitFourier=args.deconv_depth_split, fftshift_in_OTF=args.otf_fftshift==1)
+                    del OTF_central
+                    print('Spectral forward projection error: ' + str(forward_mode_error))
+                    writer.add_scalar('deconv/forward_mode_max_abs_error', forward_mode_error['max_abs_error'], nSimul)
+                    writer.add_scalar('deconv/forward_mode_relative_error', forward_mode_error['relative_error'], nSimul)
+                # Report once the speed and accuracy of the approximate median
+                if args.deconv_median_mode!='exact' and nSimul==0:
+                    median_benchmark = XLFM_median_benchmark(img_to_deconv_net, forward_net)
+                    print('Median benchmark: ' + str(median_benchmark))
+                    writer.add_text('deconv/median_benchmark', str(median_benchmark), nSimul)
+                # Report once the accuracy of the reduced precision deconvolution
+                if args.deconv_precision!='float32' and nSimul==0:
+                    precision_error = XLFM_precision_error(OTF, img_to_deconv_net, currArgs.deconv_iterations, device=device_deconv, all_in_device=0,
+                                                    nSplitFourier=args.deconv_depth_split, max_allowed=args.deconv_limit,
+                                                    **{k:v for k,v in deconv_settings.items() if k!='precision'}, precision=args.deconv_precision)
+                    print('Reduced precision deconvolution error: ' + str(precision_error))
+                    writer.add_scalar('deconv/precision_relative_error', precision_error['relative_error'], nSimul)
+                    writer.add_scalar('deconv/precision_psnr', precision_error['psnr'], nSimul)
 
             # Augmentation needed? We need 3 volumes for this, then shift in z then compute their forward projections
             if args.max_z_roll_augm > 0:
@@ -295,34 +417,49 @@ with torch.no_grad():
                 augmented_sparse_volumes = deconv_vol.clone().unsqueeze(-1).repeat(1,1,1,1,len(args.temporal_shifts))
                 # Roll volume
                 roll_amount = torch.randint(-args.max_z_roll_augm, args.max_z_roll_augm, [1])[0]
-                for img_id in range(len(args.temporal_shifts)):
+                # We need the volumes of both the raw and the sparse images of every temporal shift
+                vol_keys = [(img_id, type_volume) for img_id in range(len(args.temporal_shifts)) for type_volume in ['raw','sparse']]
+                curr_images = {'raw':raw_image_stack, 'sparse':sparse_part}
+                curr_vols = len(vol_keys) * [None]
+                # Check if volumes exist
+                for nVol,(img_id,type_volume) in enumerate(vol_keys):
                     vol_id = args.temporal_shifts[img_id] + curr_index
-                    # Select image to deconvolve
-                    curr_image = {'raw':raw_image_stack[:,img_id,...].clone().unsqueeze(1), 'sparse':sparse_part[:,img_id,...].clone().unsqueeze(1)}
-                    # Is it the raw or the sparse image? we need both
-                    for type_volume in ['raw','sparse']:
-                        volume_exists = False
-                        # Check if volumes exist
-                        try:
-                            curr_vol = dataset.read_tiff_stack(precomputed_volume_path_list[type_volume][vol_id], out_datatype=np.float32).permute(2,0,1).unsqueeze(0)
-                            volume_exists = True
-                            print('Loaded augmented ' + type_volume + ' deconvolution')
-                        except: # Deconvolve them
-                            curr_vol,_,_,_ = XLFMDeconv(OTF, curr_image[type_volume].float(), currArgs.deconv_iterations, 
-                                                            device=device_deconv, all_in_device=0, 
-                                                            nSplitFourier=args.deconv_depth_split,max_allowed=args.deconv_limit)
-                        if not volume_exists:
-                            imsave(precomputed_volume_path[type_volume] + '/XLFM_stack_'+ "%03d" % vol_id + '.tif', curr_vol.cpu().numpy())
-                        curr_vol = torch.roll(curr_vol, (roll_amount.item()), 1)
-                        # Compute new forward projection
-                        new_img = XLFM_forward_projection(OTF, curr_vol, [1,1,OTF.shape[2],OTF.shape[2]], nSplitFourier=args.deconv_depth_split)
-                        # Crop center to match original image
-                        new_img = new_img[:,:,new_img.shape[2]//2-img_shape[0]//2 : new_img.shape[2]//2+img_shape[0]//2, \
-                                                new_img.shape[3]//2-img_shape[1]//2 : new_img.shape[3]//2+img_shape[1]//2]
-                        # Update sparse image and store it
-                        augmented_images[type_volume][:,img_id,...] = new_img[:,0,...]/new_img.sum() * curr_image[type_volume].cpu().float().sum()
-                        # Store augmented volumes 
-                        augmented_sparse_volumes[...,img_id] = curr_vol.clone()
+                    try:
+                        curr_vols[nVol] = dataset.read_tiff_stack(precomputed_volume_path_list[type_volume][vol_id], out_datatype=np.float32).permute(2,0,1).unsqueeze(0)
+                        print('Loaded augmented ' + type_volume + ' deconvolution')
+                    except:
+                        pass
+                # Deconvolve the missing ones, deconv_batch_size images at a time
+                to_deconvolve = [nVol for nVol in range(len(vol_keys)) if curr_vols[nVol] is None]
+                for nBatch in range(0, len(to_deconvolve), args.deconv_batch_size):
+                    batch_ids = to_deconvolve[nBatch : nBatch+args.deconv_batch_size]
+                    batch_images = torch.cat([curr_images[vol_keys[nVol][1]][:,vol_keys[nVol][0],...].unsqueeze(1).float() for nVol in batch_ids])
+                    batch_vols,_,_,_ = deconvolve(batch_images, currArgs.deconv_iterations, 
+                                                    device=device_deconv, all_in_device=0, 
+                                                    nSplitFourier=args.deconv_depth_split,max_allowed=args.deconv_limit,
+                                                    pool=deconv_pool, checkpoint_path=deconv_checkpoint_path('deconv_augm_' + "%03d" % nSimul + '_' + str(nBatch)),
+                                                    checkpoint_every=args.deconv_checkpoint_every, **deconv_settings)
+                    for nB,nVol in enumerate(batch_ids):
+                        img_id,type_volume = vol_keys[nVol]
+                        curr_vols[nVol] = batch_vols[nB].unsqueeze(0)
+                        imsave(precomputed_volume_path[type_volume] + '/XLFM_stack_'+ "%03d" % (args.temporal_shifts[img_id] + curr_index) + '.tif', curr_vols[nVol].cpu().numpy())
+                # Roll volumes and compute their new forward projections, also in batches
+                for nBatch in range(0, len(vol_keys), args.deconv_batch_size):
+                    batch_ids = list(range(nBatch, min(nBatch+args.deconv_batch_size, len(vol_keys))))
+                    batch_vols = torch.roll(torch.cat([curr_vols[nVol] for nVol in batch_ids]), (roll_amount.item()), 1)
+                    new_imgs = XLFM_forward_projection(OTF, batch_vols, [len(batch_ids),1,OTF.shape[2],OTF.shape[2]], nSplitFourier=args.deconv_depth_split, forward_mode=args.deconv_forward_mode,
+                                                    fftshift_in_OTF=args.otf_fftshift==1)
+                    # Crop center to match original image
+                    new_imgs = new_imgs[:,:,new_imgs.shape[2]//2-img_shape[0]//2 : new_imgs.shape[2]//2+img_shape[0]//2, \
+                                            new_imgs.shape[3]//2-img_shape[1]//2 : new_imgs.shape[3]//2+img_shape[1]//2]
+                    for nB,nVol in enumerate(batch_ids):
+                        img_id,type_volume = vol_keys[nVol]
+                        new_img = new_imgs[nB].unsqueeze(0)
+                        # Update image and store it
+                        augmented_images[type_volume][:,img_id,...] = new_img[:,0,...]/new_img.sum() * curr_images[type_volume][:,img_id,...].cpu().float().sum()
+                        # Store augmented sparse volumes 
+                        if type_volume=='sparse':
+                            augmented_sparse_volumes[...,img_id] = batch_vols[nB].unsqueeze(0)
             # Overwrite output images
             sparse_part = augmented_images['sparse'].clone()
             raw_image_stack = augmented_images['raw'].clone()
@@ -342,7 +479,8 @@ with torch.no_grad():
                 start.record()
                 img_to_deconv_SL = sparse_part_SL[:,currArgs.frame_to_grab].unsqueeze(1).float()
                 deconv_SL,proj_SL,forward_SL,_ =    XLFMDeconv(OTF, img_to_deconv_SL, currArgs.deconv_iterations, 
-                                                    device=device, all_in_device=args.deconv_gpu)
+                                                    device=device, all_in_device=args.deconv_gpu, checkpoint_path=deconv_checkpoint_path('deconv_S_SL_' + "%03d" % nSimul),
+                                                    checkpoint_every=args.deconv_checkpoint_every, **deconv_settings)
                 end.record()
                 torch.cuda.synchronize()
                 end_time_deconv_SL = start.elapsed_time(end) / curr_img_stack.shape[0]
@@ -375,7 +513,6 @@ with torch.no_grad():
         
 
         # Store current images
-        curr_img_ix = nSimul * len(args.temporal_shifts)
         all_images[0,curr_img_ix:curr_img_ix+len(args.temporal_shifts),...] = raw_image_stack.cpu().numpy().astype(np.float16)
         all_images[1,curr_img_ix:curr_img_ix+len(args.temporal_shifts),...] = dense_part.cpu().numpy().astype(np.float16)
         all_images[2,curr_img_ix:curr_img_ix+len(args.temporal_shifts),...] = sparse_part.cpu().numpy().astype(np.float16)
@@ -386,6 +523,13 @@ with torch.no_grad():
             if args.SD_iterations > 0:
                 imsave(output_dir + '/XLFM_stack_S_SL/XLFM_stack_'+ "%03d" % nSimul + '.tif', deconv_SL.cpu().numpy())
 
+        # Mark the simulation as finished, storing its images, and remove its deconvolution checkpoints
+        with open(simulation_path + '.tmp', 'wb') as f:
+            np.save(f, all_images[:,curr_img_ix:curr_img_ix+len(args.temporal_shifts),...])
+        os.replace(simulation_path + '.tmp', simulation_path)
+        for checkpoint_file in glob.glob(output_dir + '/checkpoints/deconv_*_' + "%03d" % nSimul + '*.pt'):
+            os.remove(checkpoint_file)
+
         rescale_img = lambda img: F.interpolate( img, [img.shape[-2]//10, img.shape[-1]//10])
         
         # Store images and log them to tensorboard
@@ -425,6 +569,9 @@ if args.SD_iterations>0:
 if args.deconv_iterations>0:
     writer.add_scalar('mean/time_deconv_SL', end_time_deconv_SL)
 writer.add_scalar('mean/min_time', min_time)
+if deconv_pool is not None:
+    writer.add_scalar('mean/deconv_worker_utilization', deconv_pool.utilization())
+    deconv_pool.close()
 
 writer.close()
             
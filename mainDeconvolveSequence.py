@@ -0,0 +1,200 @@
+import torch
+import glob, os
+import time
+import numpy as np
+from datetime import datetime
+import argparse
+from torch.utils.tensorboard import SummaryWriter
+import torch.nn.functional as F
+from tifffile import imread, imsave, TiffFile
+
+from utils.misc_utils import *
+from utils.XLFMDeconv import *
+from utils.OTFStore import load_PSF_OTF_store
+from utils.XLFMDeconvPool import XLFMDeconvPool
+from utils.MemoryPlanner import plan_depth_chunk
+
+# Deconvolve a time-lapse XLFM recording frame by frame.
+# Consecutive frames produce nearly identical volumes, so each frame can be warm started:
+# warm_start:
+#   'none': every frame starts from a volume of ones and runs deconv_iterations.
+#   'previous': the first frame runs deconv_iterations, the next ones start from the volume of the previous frame
+#               and run at most deconv_iterations_warm.
+#   'xlfmnet': every frame starts from a precomputed volume (e.g. XLFMNet predictions stored by mainReconstructSequence.py
+#              with --writeVolsToStack 1), found with init_volumes_path, and runs at most deconv_iterations_warm.
+# With a stop criterion the warm started frames stop as soon as they converge.
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_file', nargs='?', default='', help='Multi-page tif with the XLFM images of the recording.')
+parser.add_argument('--frames_to_use', nargs='+', type=int, default=[], help='Indices of the frames to deconvolve, in order. Empty for all.')
+parser.add_argument('--psf_file', nargs='?', default= "PSF_2.5um_processed.mat", help='.mat matlab file with PSF stack, used for deconvolution.')
+parser.add_argument('--otf_cache_dir', nargs='?', default=OTF_CACHE_DIR, help='Directory to cache the computed OTFs, empty to disable caching.')
+parser.add_argument('--otf_fftshift', type=int, default=0, help='Fold the fftshift into the OTF as a phase ramp, removing the shift copies after every FFT. 0 or 1')
+parser.add_argument('--otf_max_ram_gb', type=float, default=0, help='RAM ceiling for the OTF in deconvolution, the rest is streamed from the OTF cache. 0 to keep it all in memory.')
+parser.add_argument('--prefix', nargs='?', default= "fishy", help='Prefix string for the output folder.')
+parser.add_argument('--output_path', nargs='?', default='')
+parser.add_argument('--dark_current', type=float, default=106, help='Dark current value of camera.')
+# 3D deconvolution arguments
+parser.add_argument('--vol_size', nargs='+', type=int, default=[512,512], help='Lateral size of the deconvolved volume.')
+parser.add_argument('--deconv_n_depths', type=int, default=120, help='Number of depths to create in 3D deconvolution.')
+parser.add_argument('--deconv_iterations', type=int, default=50, help='Number of iterations for 3D deconvolution of a cold started frame.')
+parser.add_argument('--deconv_iterations_warm', type=int, default=10, help='Maximum number of iterations for a warm started frame.')
+parser.add_argument('--warm_start', nargs='?', default='previous', help='Initialization of each frame: none, previous or xlfmnet.')
+parser.add_argument('--init_volumes_path', nargs='?', default='', help='Volumes used to warm start each frame with xlfmnet, use: path + *tif')
+parser.add_argument('--deconv_limit', type=float, default=10000, help='Maximum intensity allowed from doconvolution.')
+parser.add_argument('--deconv_depth_split', type=int, default=6, help='Number of depths to simultaneously deconvolve in the gpu.')
+parser.add_argument('--deconv_gpu', type=int, default=-1, help='GPU to use for deconvolution, -1 to use CPU, this is very memory intensive.')
+parser.add_argument('--deconv_forward_mode', nargs='?', default='per_depth', help='Forward projection in deconvolution: per_depth or spectral (single inverse FFT per iteration).')
+parser.add_argument('--deconv_acceleration', nargs='?', default='none', help='Richardson-Lucy update: none or biggs_andrews (vector extrapolation).')
+parser.add_argument('--deconv_stop_criterion', nargs='?', default='error', help='Stop deconvolution on relative change of the error or the volume: none, error or volume.')
+parser.add_argument('--deconv_stop_tol', type=float, default=1e-3, help='Relative change below which deconvolution stops.')
+parser.add_argument('--deconv_precision', nargs='?', default='float32', help='Storage precision of the OTF and volume in deconvolution: float32, float16 or bfloat16.')
+parser.add_argument('--deconv_pyramid', nargs='+', type=int, default=[1], help='Downsampling of each level of a coarse to fine deconvolution of the cold started frames, e.g. 4 2 1. The last one must be 1.')
+parser.add_argument('--deconv_pyramid_iterations', nargs='+', type=int, default=[], help='Iterations of each coarse level of deconv_pyramid, the full resolution runs deconv_iterations.')
+parser.add_argument('--deconv_skip_tol', type=float, default=0, help='Skip the depths with less energy than this fraction of the brightest one in deconvolution, 0 to use all depths.')
+parser.add_argument('--deconv_median_mode', nargs='?', default='exact', help='Median used to clamp the deconvolution updates: exact, subsampled or histogram (faster approximations).')
+parser.add_argument('--memory_budget', type=float, default=0, help='Memory in GB for the chunks of depths convolved at once, which are then chosen by the memory planner. 0 to use deconv_depth_split, -1 to use the free memory.')
+parser.add_argument('--deconv_roi', nargs='+', type=int, default=[], help='Lateral region of the volume to deconvolve: y x height width. Empty for the whole volume.')
+parser.add_argument('--deconv_depth_range', nargs='+', type=int, default=[], help='Depths to deconvolve: start stop. Empty for all.')
+parser.add_argument('--deconv_guard_pixels', type=int, default=16, help='Guard band around deconv_roi that absorbs the light from outside, cropped from the result.')
+parser.add_argument('--deconv_guard_depths', type=int, default=4, help='Guard depths around deconv_depth_range, cropped from the result.')
+parser.add_argument('--deconv_workers', type=int, default=0, help='Processes to split the depths of the CPU deconvolution, 0 to deconvolve in the main process.')
+
+args = parser.parse_args()
+assert args.warm_start in ['none','previous','xlfmnet'], 'Unknown warm_start: ' + str(args.warm_start)
+assert (len(args.deconv_roi)==0 and len(args.deconv_depth_range)==0) or (args.otf_max_ram_gb==0 and args.deconv_workers==0 and len(args.deconv_pyramid)==1), \
+    'deconv_roi and deconv_depth_range need an in memory OTF, and can not be used with deconv_workers or deconv_pyramid.'
+assert args.deconv_pyramid[-1]==1 and len(args.deconv_pyramid_iterations)==len(args.deconv_pyramid)-1, \
+    'deconv_pyramid should end with 1, with deconv_pyramid_iterations for each of the other levels.'
+
+# Deconvolution can be heavy on the GPU, and sometimes it doesn't fit, so use -1 for CPU
+if args.deconv_gpu==-1:
+    device_deconv = "cpu"
+else:
+    device_deconv = "cuda:" + str(args.deconv_gpu)
+
+# Frames to process, read one at a time to handle long recordings
+with TiffFile(args.input_file) as tif:
+    n_frames = len(tif.pages)
+frames_to_use = args.frames_to_use if len(args.frames_to_use)>0 else list(range(n_frames))
+
+init_volumes_list = []
+if args.warm_start=='xlfmnet':
+    init_volumes_list = sorted(glob.glob(args.init_volumes_path))
+    assert len(init_volumes_list)>=len(frames_to_use), 'Found ' + str(len(init_volumes_list)) + ' volumes in ' + args.init_volumes_path + ' for ' + str(len(frames_to_use)) + ' frames.'
+
+# Load measured PSF from matlab file and compute OTF
+output_shape = args.vol_size + [args.deconv_n_depths]
+# Stream the OTF from disk with bounded RAM, or keep it in memory
+if args.otf_max_ram_gb > 0:
+    OTF,psf_shape = load_PSF_OTF_store(args.psf_file, output_shape, n_depths=args.deconv_n_depths, n_split=20,
+                                cache_dir=args.otf_cache_dir, max_ram_gb=args.otf_max_ram_gb, chunk_depths=args.deconv_depth_split,
+                                fftshift_in_OTF=args.otf_fftshift==1)
+    print('Streaming OTF from ' + OTF.otf_path + ', ' + str(OTF.n_resident) + ' / ' + str(OTF.n_depths) + ' depths in RAM')
+else:
+    OTF,psf_shape = load_PSF_OTF(args.psf_file, output_shape, n_depths=args.deconv_n_depths,
+                                n_split=20, lenslet_centers_file_out="", compute_transpose=True, cache_dir=args.otf_cache_dir,
+                                fftshift_in_OTF=args.otf_fftshift==1)
+deconv_settings = {'forward_mode':args.deconv_forward_mode, 'acceleration':args.deconv_acceleration,
+                    'stop_criterion':args.deconv_stop_criterion, 'stop_tol':args.deconv_stop_tol, 'precision':args.deconv_precision,
+                    'fftshift_in_OTF':args.otf_fftshift==1, 'skip_tol':args.deconv_skip_tol,
+                    'median_mode':args.deconv_median_mode}
+# Depths deconvolved at once, from the memory budget of the deconvolution device
+if args.memory_budget != 0:
+    args.deconv_depth_split = plan_depth_chunk([OTF.shape[2], 2*(OTF.shape[3]-1)], args.deconv_n_depths,
+                                            memory_budget_gb=args.memory_budget, device=device_deconv, cache_dir=args.otf_cache_dir, verbose=True)
+# OTFs of the coarse levels of the pyramid deconvolution, they are small and kept in memory
+OTF_pyramid = [load_PSF_OTF(args.psf_file, output_shape, n_depths=args.deconv_n_depths, n_split=20, downS=downS,
+                            lenslet_centers_file_out="", compute_transpose=True, cache_dir=args.otf_cache_dir,
+                            fftshift_in_OTF=args.otf_fftshift==1)[0] for downS in args.deconv_pyramid[:-1]]
+
+# Split the depths of the CPU deconvolution between worker processes
+deconv_pool = None
+if args.deconv_workers > 0:
+    assert device_deconv=='cpu' and args.otf_max_ram_gb==0 and args.deconv_precision=='float32', \
+        'deconv_workers needs the CPU deconvolution (deconv_gpu -1), an in memory OTF and float32 precision.'
+    deconv_pool = XLFMDeconvPool(OTF, args.deconv_workers, ObjSize=args.vol_size)
+
+# Create output directory
+save_folder = args.output_path + datetime.now().strftime('%Y_%m_%d__%H:%M:%S') + '__' + args.warm_start + '_warm__' + args.prefix
+print('Output directory: ' + save_folder)
+os.makedirs(save_folder + '/XLFM_stack/')
+writer = SummaryWriter(save_folder)
+writer.add_text('arguments',str(vars(args)),0)
+writer.flush()
+
+total_iterations = 0
+total_time = 0
+prev_vol = None
+with torch.no_grad():
+    for ix,nFrame in enumerate(frames_to_use):
+        start_time = time.time()
+        curr_img = torch.from_numpy(imread(args.input_file, key=nFrame).astype(np.float32)).unsqueeze(0).unsqueeze(0)
+        curr_img = F.relu(curr_img - args.dark_current)
+
+        # Select the starting volume of this frame
+        init_volume = None
+        n_iterations = args.deconv_iterations
+        if args.warm_start=='previous' and prev_vol is not None:
+            init_volume = prev_vol
+        elif args.warm_start=='xlfmnet':
+            init_volume = torch.from_numpy(imread(init_volumes_list[ix]).astype(np.float32))
+            init_volume = init_volume.view(-1, *init_volume.shape[-3:])[:1]
+            # Match the size of the deconvolved volume and the intensity of the image
+            if list(init_volume.shape[1:]) != [args.deconv_n_depths] + args.vol_size:
+                init_volume = F.interpolate(init_volume.unsqueeze(1), [args.deconv_n_depths] + args.vol_size, mode='trilinear', align_corners=False)[:,0]
+            init_volume = XLFM_match_intensity(OTF, init_volume.clamp(min=0), curr_img, nSplitFourier=args.deconv_depth_split, forward_mode=args.deconv_forward_mode,
+                                                fftshift_in_OTF=args.otf_fftshift==1)
+        if init_volume is not None:
+            n_iterations = args.deconv_iterations_warm
+
+        deconv_args = {'ObjSize':args.vol_size, 'device':device_deconv, 'all_in_device':0, 'nSplitFourier':args.deconv_depth_split,
+                        'max_allowed':args.deconv_limit, 'return_stats':True, 'init_volume':init_volume, 'pool':deconv_pool}
+        # Only a region or some depths of the volume, or cold started frames coarse to fine if a pyramid is used
+        if len(args.deconv_roi)>0 or len(args.deconv_depth_range)>0:
+            deconv_vol,_,deconv_img,_,deconv_stats = XLFMDeconvROI(OTF, curr_img, n_iterations, roi=args.deconv_roi, depth_range=args.deconv_depth_range,
+                                                guard_pixels=args.deconv_guard_pixels, guard_depths=args.deconv_guard_depths, **deconv_args, **deconv_settings)
+        elif init_volume is None and len(OTF_pyramid)>0:
+            deconv_vol,_,deconv_img,_,deconv_stats = XLFMDeconvPyramid(OTF_pyramid + [OTF], curr_img, args.deconv_pyramid_iterations + [n_iterations],
+                                                downS=args.deconv_pyramid, **deconv_args, **deconv_settings)
+        else:
+            deconv_vol,_,deconv_img,_,deconv_stats = XLFMDeconv(OTF, curr_img, n_iterations, **deconv_args, **deconv_settings)
+        prev_vol = deconv_vol.clone()
+        # Report once the speed and accuracy of the approximate median
+        if args.deconv_median_mode!='exact' and ix==0:
+            median_benchmark = XLFM_median_benchmark(curr_img, deconv_img)
+            print('Median benchmark: ' + str(median_benchmark))
+            writer.add_text('deconv/median_benchmark', str(median_benchmark), 0)
+        # Report once the accuracy of the reduced precision deconvolution
+        if args.deconv_precision!='float32' and ix==0:
+            precision_error = XLFM_precision_error(OTF, curr_img, n_iterations, ObjSize=args.vol_size, device=device_deconv, all_in_device=0,
+                                                nSplitFourier=args.deconv_depth_split, max_allowed=args.deconv_limit, init_volume=init_volume,
+                                                **{k:v for k,v in deconv_settings.items() if k!='precision'}, precision=args.deconv_precision)
+            print('Reduced precision deconvolution error: ' + str(precision_error))
+            writer.add_text('deconv/precision_error', str(precision_error), 0)
+        curr_time = time.time() - start_time
+        total_iterations += len(deconv_stats)
+        total_time += curr_time
+
+        imsave(save_folder + '/XLFM_stack/XLFM_stack_'+ "%03d" % nFrame + '.tif', deconv_vol[0].cpu().numpy())
+        curr_error = deconv_stats[-1]['error'][0] if len(deconv_stats)>0 else 0
+        print('Frame ' + str(nFrame) + ' (' + str(ix+1) + ' / ' + str(len(frames_to_use)) + ')\t iterations: ' + str(len(deconv_stats)) + \
+                '\t currErr: ' + str(curr_error) + '\t time: ' + str(round(curr_time,2)) + 's')
+        writer.add_scalar('deconv/iterations', len(deconv_stats), ix)
+        writer.add_scalar('deconv/error', curr_error, ix)
+        writer.add_scalar('deconv/time', curr_time, ix)
+        if args.deconv_skip_tol > 0 and len(deconv_stats)>0:
+            writer.add_scalar('deconv/skipped_planes', deconv_stats[-1]['skipped_planes'], ix)
+        if deconv_pool is not None and len(deconv_stats)>0:
+            writer.add_scalar('deconv/time_per_iteration', np.mean([s['time'] for s in deconv_stats]), ix)
+            writer.add_scalar('deconv/worker_utilization', np.mean([s['worker_utilization'] for s in deconv_stats if 'worker_utilization' in s]), ix)
+
+print('Deconvolved ' + str(len(frames_to_use)) + ' frames with ' + str(total_iterations) + ' iterations (' + \
+        str(round(total_iterations/max(len(frames_to_use),1),1)) + ' per frame) in ' + str(round(total_time,1)) + 's')
+writer.add_text('summary', 'total_iterations: ' + str(total_iterations) + ', total_time: ' + str(total_time), 0)
+if args.otf_max_ram_gb > 0:
+    print('OTF streaming: ' + str(OTF.stats) + ', RAM ceiling used: ' + str(round(OTF.ram_usage()/2**30,2)) + 'GB')
+    OTF.close()
+if deconv_pool is not None:
+    print('Deconvolution workers: ' + str(deconv_pool.n_workers) + ', utilization: ' + str(round(deconv_pool.utilization(),3)))
+    deconv_pool.close()
+writer.close()
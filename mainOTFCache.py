@@ -0,0 +1,56 @@
+import argparse
+import time
+from datetime import datetime
+
+from utils.misc_utils import *
+
+# Manage the persistent OTF cache used by load_PSF_OTF
+# build: precompute the OTF of a PSF for a given volume size and store it in the cache
+# list: show the cached OTFs
+# evict: remove entries by key, all of them, or the least recently used until the cache fits in --max_size_gb
+parser = argparse.ArgumentParser()
+parser.add_argument('--otf_cache_dir', nargs='?', default=OTF_CACHE_DIR, help='Directory where the OTFs are cached.')
+subparsers = parser.add_subparsers(dest='command')
+
+parser_build = subparsers.add_parser('build', help='Precompute an OTF and store it in the cache.')
+parser_build.add_argument('--psf_file', nargs='?', default= "PSF_2.5um_processed.mat", help='.mat matlab file with PSF stack.')
+parser_build.add_argument('--vol_size', nargs='+', type=int, default=[512,512], help='Lateral size of the volume to deconvolve.')
+parser_build.add_argument('--n_depths', type=int, default=120, help='Number of depths of the PSF to use.')
+parser_build.add_argument('--n_split', type=int, default=20, help='Number of chunks to split the depths into while computing the OTF.')
+parser_build.add_argument('--downS', type=int, default=1)
+parser_build.add_argument('--compute_transpose', type=int, default=1, help='Store also the transposed OTF, needed by XLFMDeconv. 0 or 1')
+parser_build.add_argument('--fftshift_in_OTF', type=int, default=0, help='Fold the fftshift into the OTF as a phase ramp, as --otf_fftshift in the other scripts. 0 or 1')
+parser_build.add_argument('--device', nargs='?', default='cpu')
+
+parser_list = subparsers.add_parser('list', help='List the cached OTFs.')
+
+parser_evict = subparsers.add_parser('evict', help='Remove OTFs from the cache.')
+parser_evict.add_argument('--keys', nargs='+', default=None, help='Keys of the entries to remove, see list.')
+parser_evict.add_argument('--max_size_gb', type=float, default=None, help='Remove least recently used entries until the cache is smaller than this.')
+parser_evict.add_argument('--all', type=int, default=0, help='Remove all entries. 0 or 1')
+
+args = parser.parse_args()
+
+if args.command == 'build':
+    start = time.time()
+    OTF,psf_shape = load_PSF_OTF(args.psf_file, args.vol_size, n_depths=args.n_depths, n_split=args.n_split, downS=args.downS,
+                                device=args.device, compute_transpose=args.compute_transpose==1, lenslet_centers_file_out="",
+                                cache_dir=args.otf_cache_dir, fftshift_in_OTF=args.fftshift_in_OTF==1)
+    print('OTF with shape ' + str(list(OTF.shape)) + ' ready in ' + args.otf_cache_dir + ' (' + str(round(time.time()-start,1)) + 's)')
+
+elif args.command == 'list':
+    entries = list_OTF_cache(args.otf_cache_dir)
+    for e in entries:
+        print(e['key'] + '\t' + str(round(e['size']/2**30,2)) + 'GB\t' + datetime.fromtimestamp(e['last_used']).strftime('%Y_%m_%d__%H:%M:%S') + '\t' + e['psf_file'])
+    print(str(len(entries)) + ' entries, ' + str(round(sum(e['size'] for e in entries)/2**30,2)) + 'GB in ' + args.otf_cache_dir)
+
+elif args.command == 'evict':
+    if args.keys is None and args.max_size_gb is None and args.all==0:
+        parser.error('evict needs --keys, --max_size_gb or --all 1')
+    removed = evict_OTF_cache(args.otf_cache_dir, keys=args.keys, max_size_gb=args.max_size_gb)
+    for key in removed:
+        print('Removed ' + key)
+    print(str(len(removed)) + ' entries removed from ' + args.otf_cache_dir)
+
+else:
+    parser.print_help()
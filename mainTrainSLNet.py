@@ -66,6 +66,8 @@ parser.add_argument('--l0_ths', type=float, default=0.05, help='Threshold value
 # misc arguments
 parser.add_argument('--output_path', nargs='?', default='experiments')
 parser.add_argument('--main_gpu', nargs='+', type=int, default=[0], help='List of GPUs to use: [0,1]')
+parser.add_argument('--dataloader_workers', type=int, default=0, help='DataLoader worker processes, sharing the dataset. 0 to load in the main process.')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches loaded ahead by each DataLoader worker.')
 parser.add_argument('--slice_to_grab', nargs='+', type=int, default=19, help='slice to use for debug img')
 
 n_threads = 0
@@ -129,13 +131,19 @@ train_indices, val_indices = indices[split:], indices[:split]
 train_sampler = SubsetRandomSampler(train_indices)
 valid_sampler = SubsetRandomSampler(val_indices)
 
+# DataLoader workers share the dataset storage instead of copying it, and are kept alive between epochs
+loader_args = {'pin_memory' : False, 'num_workers' : args.dataloader_workers}
+if args.dataloader_workers>0:
+    loader_args.update({'persistent_workers' : True, 'prefetch_factor' : args.prefetch_factor})
+    dataset.share_memory()
+
 data_loaders = \
     {'train' : \
             data.DataLoader(dataset, batch_size=args.batch_size, 
-                                sampler=train_sampler, pin_memory=False, num_workers=n_threads), \
+                                sampler=train_sampler, **loader_args), \
     'val'   : \
             data.DataLoader(dataset, batch_size=args.batch_size,
-                                    sampler=valid_sampler, pin_memory=False, num_workers=n_threads), \
+                                    sampler=valid_sampler, **loader_args), \
     # 'test'  : \
             # data.DataLoader(dataset_test, batch_size=1, pin_memory=False, num_workers=n_threads, shuffle=True)
     }
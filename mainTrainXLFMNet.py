@@ -17,8 +17,10 @@ from pytorch_msssim import ssim, ms_ssim, SSIM, MS_SSIM
 
 from nets.XLFMNet import XLFMNet
 import utils.pytorch_shot_noise as pytorch_shot_noise
-from utils.XLFMDataset import XLFMDatasetFull
+from utils.XLFMDataset import XLFMDatasetFull, FramePreprocessing
 from utils.misc_utils import *
+from utils.LensletProjection import LensletForwardProjection, reprojection_loss_lenslets
+from utils.MemoryPlanner import plan_n_split
 
 # Arguments
 parser = argparse.ArgumentParser()
@@ -27,6 +29,8 @@ parser.add_argument('--data_folder_test', nargs='?', default='')
 parser.add_argument('--lenslet_file', nargs='?', default= "lenslet_centers_python.txt")
 parser.add_argument('--files_to_store', nargs='+', default=['mainTrainXLFMNet.py','mainTrainSLNet.py','mainCreateDataset.py','utils/XLFMDataset.py','utils/misc_utils.py','nets/extra_nets.py','nets/XLFMNet.py','nets/SLNet.py'])
 parser.add_argument('--psf_file', nargs='?', default= "PSF_2.5um_processed.mat")
+parser.add_argument('--otf_cache_dir', nargs='?', default=OTF_CACHE_DIR, help='Directory to cache the computed OTFs, empty to disable caching.')
+parser.add_argument('--otf_fftshift', type=int, default=0, help='Fold the fftshift into the OTF as a phase ramp, removing the shift copies after every FFT. 0 or 1')
 parser.add_argument('--prefix', nargs='?', default= "fishy")
 parser.add_argument('--checkpoint', nargs='?', default= "")
 parser.add_argument('--checkpoint_XLFMNet', nargs='?', default= "")
@@ -61,6 +65,14 @@ parser.add_argument('--output_path', nargs='?', default='')
 parser.add_argument('--main_gpu', nargs='+', type=int, default=[1])
 parser.add_argument('--gpu_repro', nargs='+', type=int, default=[])
 parser.add_argument('--n_split', type=int, default=20)
+parser.add_argument('--memory_budget', type=float, default=0, help='Memory in GB for the chunks of depths convolved at once, which are then chosen by the memory planner. 0 to use the given splits, -1 to use the free memory.')
+parser.add_argument('--dataset_lazy', type=int, default=0, help='Memory map the image stacks and volumes and decode them when needed, for datasets that do not fit in memory. 0 or 1')
+parser.add_argument('--dataloader_workers', type=int, default=0, help='DataLoader worker processes, sharing the dataset and running the dark current subtraction and noise. 0 to load in the main process.')
+parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches loaded ahead by each DataLoader worker.')
+parser.add_argument('--dataset_views', type=int, default=0, help='Extract the lenslet views of the frames once when loading the dataset, and train on them instead of the full frames. 0 or 1')
+parser.add_argument('--dataset_cache_size', type=int, default=64, help='Decoded frames and volumes kept in memory with --dataset_lazy.')
+parser.add_argument('--reprojection_mode', nargs='?', default='full', help='Reprojection check on the test set: full (needs --gpu_repro) or lenslet_roi (only the lenslet windows, cheap enough for CPU).')
+parser.add_argument('--reprojection_kernel_size', type=int, default=0, help='Side of the PSF kernel per lenslet in lenslet_roi mode, 0 for the exact kernel.')
 
 debug = False
 n_threads = 0
@@ -114,12 +126,14 @@ subimage_shape = argsSLNet.subimage_shape
 
 dataset = XLFMDatasetFull(args.data_folder, args.lenslet_file, subimage_shape, img_shape=[2160,2160],
             images_to_use=args.images_to_use, divisor=1, isTiff=True, n_frames_net=argsSLNet.n_frames, lenslets_offset=0,
-            load_all=True, load_vols=True, load_sparse=True, temporal_shifts=args.temporal_shifts, use_random_shifts=args.use_random_shifts, eval_video=False)
+            load_all=True, load_vols=True, load_sparse=True, temporal_shifts=args.temporal_shifts, use_random_shifts=args.use_random_shifts, eval_video=False,
+            lazy=args.dataset_lazy==1, cache_size=args.dataset_cache_size, lenslet_views=args.dataset_views==1)
 
 
 dataset_test = XLFMDatasetFull(args.data_folder_test, args.lenslet_file, subimage_shape, img_shape=[2160,2160],  
             images_to_use=args.images_to_use_test, divisor=1, isTiff=True, n_frames_net=argsSLNet.n_frames, lenslets_offset=0,
-            load_all=True, load_vols=True, load_sparse=True, temporal_shifts=args.temporal_shifts, use_random_shifts=args.use_random_shifts, eval_video=False)
+            load_all=True, load_vols=True, load_sparse=True, temporal_shifts=args.temporal_shifts, use_random_shifts=args.use_random_shifts, eval_video=False,
+            lazy=args.dataset_lazy==1, cache_size=args.dataset_cache_size, lenslet_views=args.dataset_views==1)
 
 
 n_depths = dataset.get_n_depths()
@@ -149,15 +163,22 @@ train_indices, val_indices = indices[split:], indices[:split]
 train_sampler = SubsetRandomSampler(train_indices)
 valid_sampler = SubsetRandomSampler(val_indices)
 
+# DataLoader workers share the dataset storage instead of copying it, and are kept alive between epochs
+loader_args = {'pin_memory' : False, 'num_workers' : args.dataloader_workers}
+if args.dataloader_workers>0:
+    loader_args.update({'persistent_workers' : True, 'prefetch_factor' : args.prefetch_factor})
+    dataset.share_memory()
+    dataset_test.share_memory()
+
 data_loaders = \
     {'train' : \
             data.DataLoader(dataset, batch_size=args.batch_size, 
-                                sampler=train_sampler, pin_memory=False, num_workers=n_threads), \
+                                sampler=train_sampler, **loader_args), \
     'val'   : \
             data.DataLoader(dataset, batch_size=args.batch_size,
-                                    sampler=valid_sampler, pin_memory=False, num_workers=n_threads), \
+                                    sampler=valid_sampler, **loader_args), \
     'test'  : \
-            data.DataLoader(dataset_test, batch_size=1, pin_memory=False, num_workers=n_threads, shuffle=True)
+            data.DataLoader(dataset_test, batch_size=1, shuffle=True, **loader_args)
     }
 
 def init_weights(m):
@@ -223,6 +244,19 @@ if len(args.checkpoint_SLNet)>0 and dataset.n_frames>1:
 else:
     net.tempConv = None
 
+# The workers subtract the dark current and add the noise to the input frames of each item, as the training loop does otherwise
+if args.dataloader_workers>0:
+    input_channel = -1 if net.tempConv is None else 0
+    frame_dims = 3 if args.dataset_views==1 else 2
+    dataset.transform = FramePreprocessing(args.dark_current, input_channel, args.add_noise==1, [args.signal_power_min, args.signal_power_max], frame_dims)
+    dataset_test.transform = FramePreprocessing(args.dark_current, input_channel, frame_dims=frame_dims)
+
+# With dataset_views the batches hold the lenslet views [B,n_frames,n_lenslets,h,w,2]. Only frame 0 of the sparse views is used,
+# and of the input frames without SLNet, so only those go to the device. The positions outside the frame are set back to zero
+# after the normalization, as extract_views would leave them.
+if args.dataset_views==1:
+    views_mask = dataset.views_mask.to(device)
+
 
 # Create summary writer to log stuff
 if debug is False:
@@ -239,14 +273,29 @@ if debug is False:
 
 import time
 
-if len(args.gpu_repro)>0:
+# Compute reprojection of the test set?
+use_repro = len(args.gpu_repro)>0 or args.reprojection_mode=='lenslet_roi'
+if args.reprojection_mode=='lenslet_roi':
+    # Forward model evaluated only inside the lenslet windows
+    kernel_shape = None if args.reprojection_kernel_size==0 else 2*[args.reprojection_kernel_size]
+    lenslet_projection = LensletForwardProjection(load_PSF(args.psf_file, n_depths), dataset.lenslet_coords, subimage_shape, args.output_shape,
+                                                kernel_shape=kernel_shape, n_split=args.n_split, device=device_repro)
+    if args.memory_budget != 0:
+        lenslet_projection.n_split = plan_n_split(lenslet_projection.fft_shape, n_depths, memory_budget_gb=args.memory_budget,
+                                                device=device_repro, cache_dir=args.otf_cache_dir, verbose=True, n_lenslets=lenslet_projection.n_lenslets)
+elif len(args.gpu_repro)>0:
     S = time.time()
     # Load PSF and compute OTF
     n_split = args.n_split
     if debug:
         n_split=60
-    OTF,psf_shape = load_PSF_OTF(args.psf_file, args.output_shape, n_depths=n_depths, n_split=n_split, device="cpu")
+    OTF,psf_shape = load_PSF_OTF(args.psf_file, args.output_shape, n_depths=n_depths, n_split=n_split, device="cpu", cache_dir=args.otf_cache_dir,
+                                fftshift_in_OTF=args.otf_fftshift==1)
     OTF = OTF.to(device)
+    # Depths reprojected at once, from the memory budget of the reprojection device
+    if args.memory_budget != 0:
+        n_split = plan_n_split([OTF.shape[2], 2*(OTF.shape[3]-1)], n_depths, memory_budget_gb=args.memory_budget,
+                                device=device_repro, cache_dir=args.otf_cache_dir, verbose=True)
     gc.collect()
     torch.cuda.empty_cache()
     E = time.time()
@@ -309,7 +358,16 @@ for epoch in range(start_epoch, args.max_epochs):
                 local_volumes = local_volumes.half()
 
             # curr_img_stack returns both the dense and the sparse images, here we only need the sparse.
-            if net.tempConv is None:
+            # With dataloader_workers the input frames come already preprocessed, followed by the sparse ones.
+            if args.dataset_views==1:
+                use_SLNet = net_get_params(net).tempConv is not None
+                input_channel = 0 if args.dataloader_workers>0 or use_SLNet else -1
+                curr_img_sparse = curr_img_stack[:,:1,...,-1].clone().to(device)
+                curr_img_stack = curr_img_stack[:,:(curr_img_stack.shape[1] if use_SLNet else 1),...,input_channel].clone().to(device)
+            elif args.dataloader_workers>0:
+                curr_img_sparse = curr_img_stack[...,-1].clone().to(device)
+                curr_img_stack = curr_img_stack[...,0].clone().to(device)
+            elif net.tempConv is None:
                 assert len(curr_img_stack.shape)>=5, "If sparse is used curr_img_stack should contain both images, dense and sparse stacked in the last dim."
                 curr_img_sparse = curr_img_stack[...,-1].clone().to(device) 
                 curr_img_stack = curr_img_stack[...,-1].clone().to(device)
@@ -317,12 +375,13 @@ for epoch in range(start_epoch, args.max_epochs):
                 curr_img_sparse = curr_img_stack[...,-1].clone().to(device)
                 curr_img_stack = curr_img_stack[...,0].clone().to(device)
             
-            curr_img_stack = curr_img_stack.half()
+            if args.dataloader_workers==0:
+                curr_img_stack = curr_img_stack.half()
 
-            curr_img_stack -= args.dark_current
-            curr_img_stack = F.relu(curr_img_stack).detach()
+                curr_img_stack -= args.dark_current
+                curr_img_stack = F.relu(curr_img_stack).detach()
 
-            if args.add_noise==1 and curr_train_stage!='test':
+            if args.add_noise==1 and curr_train_stage!='test' and args.dataloader_workers==0:
                 curr_max = curr_img_stack.max()
                 # Update new signal power
                 signal_power = (args.signal_power_min + (args.signal_power_max-args.signal_power_min) * torch.rand(1)).item()
@@ -343,6 +402,8 @@ for epoch in range(start_epoch, args.max_epochs):
             # curr_img_stack, local_volumes = normalize_type(curr_img_stack, local_volumes, args.norm_type, mean_imgs, std_images, mean_vols, std_vols, max_images, max_volumes)
             _, local_volumes = normalize_type(curr_img_stack, local_volumes, stats['norm_type'], stats['mean_imgs'], stats['std_images'], stats['mean_vols'], stats['std_vols'], stats['max_images'], stats['max_vols'])
             curr_img_stack, _ = normalize_type(curr_img_stack, local_volumes, stats['norm_type_img'], stats['mean_imgs'], stats['std_images'], stats['mean_vols'], stats['std_vols'], stats['max_images'], stats['max_vols'])
+            if args.dataset_views==1:
+                curr_img_stack = curr_img_stack * views_mask
                 
             # curr_img_sparse, _ = normalize_type(curr_img_sparse, local_volumes, args.norm_type, mean_imgs_sparse, std_images_sparse, mean_vols, std_vols, max_images, max_volumes)
             
@@ -369,15 +430,22 @@ for epoch in range(start_epoch, args.max_epochs):
                     curr_img_sparse = curr_img_sparse[:,0,...].unsqueeze(1)
                 
                 # Extract lenslet images
-                curr_img_sparse = dataset.extract_views(curr_img_sparse, dataset.lenslet_coords, dataset.subimage_shape)[:,0,...]
+                if args.dataset_views==1:
+                    curr_img_sparse = curr_img_sparse[:,0,...]
+                else:
+                    curr_img_sparse = dataset.extract_views(curr_img_sparse, dataset.lenslet_coords, dataset.subimage_shape)[:,0,...]
 
                 # curr_img_sparse, _ = normalize_type(curr_img_sparse, local_volumes, args.norm_type, mean_imgs_sparse, std_images_sparse, mean_vols, std_vols, max_images, max_volumes, inverse=True)
             
                 volume_loss = loss(local_volumes, prediction)
 
-                if curr_train_stage=='test' and len(args.gpu_repro)>0:
+                if curr_train_stage=='test' and use_repro:
                     with torch.no_grad():
-                        reproj_loss, reproj,curr_views,_ = reprojection_loss(sparse_prediction, prediction.float(), OTF, psf_shape, dataset, n_split, device_repro)
+                        if args.reprojection_mode=='lenslet_roi':
+                            reproj_loss, reproj,curr_views,_ = reprojection_loss_lenslets(sparse_prediction, prediction.float(), lenslet_projection)
+                        else:
+                            reproj_loss, reproj,curr_views,_ = reprojection_loss(sparse_prediction, prediction.float(), OTF, psf_shape, dataset, n_split, device_repro,
+                                                                            fftshift_in_OTF=args.otf_fftshift==1)
                     mean_repro += reproj_loss.item()
                     mean_repro_ssim += ssim_module((sparse_prediction/sparse_prediction.max()).to(device_repro).float(), (reproj/reproj.max()).float().to(device_repro)).cpu().item()
                 
@@ -459,7 +527,7 @@ for epoch in range(start_epoch, args.max_epochs):
             input_intermediate_sparse_grid = tv.utils.make_grid(sparse_prediction[0,10,...].float().unsqueeze(0).cpu().data.detach(), normalize=True, scale_each=False)
             input_GT_sparse_grid = tv.utils.make_grid(curr_img_sparse[0,10,...].float().unsqueeze(0).cpu().data.detach(), normalize=True, scale_each=False)
 
-            if curr_train_stage=='test' and len(args.gpu_repro)>0:
+            if curr_train_stage=='test' and use_repro:
                 repro_grid = tv.utils.make_grid(reproj[0,...].sum(0).float().unsqueeze(0).cpu().data.detach(), normalize=True, scale_each=False)
                 writer.add_image('reproj_'+curr_train_stage, repro_grid, epoch)
                 repro_grid = tv.utils.make_grid(curr_img_sparse[0,...].sum(0).float().unsqueeze(0).cpu().data.detach(), normalize=True, scale_each=False)
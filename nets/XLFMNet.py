@@ -14,7 +14,11 @@ class XLFMNet(nn.Module):
         self.output_shape = output_shape
         self.n_frames = n_temporal_frames
 
-        self.dataset = dataset
+        # Only the lenslet layout is kept from the dataset, not its frames and volumes
+        self.lenslet_coords = dataset.lenslet_coords if dataset is not None else None
+        self.subimage_shape = dataset.subimage_shape if dataset is not None else None
+        # Parts of the lenslet views inside the frame, for datasets with lenslet_views
+        self.views_mask = getattr(dataset, 'views_mask', None)
         self.stats = stats
         out_depths = output_shape[2]
         
@@ -31,10 +35,16 @@ class XLFMNet(nn.Module):
                         UNetLF(out_depths, out_depths, depth=unet_settings['depth'], wf=unet_settings['wf'], drop_out=unet_settings['drop_out'], use_bias=use_bias))
         
 
+    # input: frames [B,n_frames,H,W], or their lenslet views [B,n_frames,n_lenslets,h,w] from a dataset with lenslet_views.
+    # SLNet only has 1x1 convolutions, the views go through it as a [B,n_frames,n_lenslets*h,w] image. The parts of
+    # the views outside the frame are set back to zero afterwards, as in the views extracted from the frames.
     @autocast()
     def forward(self, input):
         # Fetch normalization stats for SLNet
         stats = self.stats
+        views_shape = input.shape if input.ndim==5 else None
+        if views_shape is not None:
+            input = input.flatten(2,3)
         intermediate_result = input
         # Compute sparse input with SLNet
         if self.n_frames!= 1 and self.tempConv is not None:
@@ -47,7 +57,12 @@ class XLFMNet(nn.Module):
                 # sparse_part = F.relu(input-D.detach())
         else:
             sparse_part = input
-        intermediate_result = self.dataset.extract_views(sparse_part[:,0,...].unsqueeze(1), self.dataset.lenslet_coords, self.dataset.subimage_shape)[:,0,...]
+        if views_shape is not None:
+            intermediate_result = sparse_part[:,0,...].view(views_shape[0], *views_shape[2:])
+            if self.views_mask is not None:
+                intermediate_result = intermediate_result * self.views_mask.to(intermediate_result.device)
+        else:
+            intermediate_result = XLFMDatasetFull.extract_views(sparse_part[:,0,...].unsqueeze(1), self.lenslet_coords, self.subimage_shape)[:,0,...]
             
         # Run 3D reconstruction network
         out = self.deconv(intermediate_result)
@@ -0,0 +1,52 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.misc_utils import load_PSF_OTF
+from utils.XLFMDeconv import XLFM_forward_projection
+
+# Small synthetic setup shared by the tests: a PSF with a few bright spots per depth, the volume size and
+# the OTF computed from it as load_PSF_OTF does for a PSF file.
+N_DEPTHS = 6
+PSF_SIZE = 48
+VOL_SIZE = 16
+
+def synthetic_psf(n_depths=N_DEPTHS, psf_size=PSF_SIZE, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand(1, n_depths, psf_size, psf_size, generator=generator)**8
+
+def synthetic_otf(psf, vol_size=VOL_SIZE, fftshift_in_OTF=False):
+    OTF,psf_shape = load_PSF_OTF('', [vol_size,vol_size], n_split=2, n_depths=psf.shape[1], psfIn=psf, compute_transpose=True,
+                                lenslet_centers_file_out='', fftshift_in_OTF=fftshift_in_OTF)
+    return OTF,psf_shape
+
+def synthetic_volume(batch_size=1, n_depths=N_DEPTHS, vol_size=VOL_SIZE, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    volume = torch.zeros(batch_size, n_depths, vol_size, vol_size)
+    volume[:,1:4,4:12,3:11] = 10*torch.rand(batch_size, 3, 8, 8, generator=generator)
+    return volume
+
+# Images of volume [B,1,psf_size,psf_size], cropped from the forward projection
+def synthetic_images(OTF, volume, psf_size=PSF_SIZE):
+    N = OTF.shape[2]
+    img = XLFM_forward_projection(OTF, volume, [volume.shape[0], 1, N, N], nSplitFourier=2)
+    start = (N - psf_size)//2
+    return img[..., start:start+psf_size, start:start+psf_size].contiguous()
+
+@pytest.fixture(scope='session')
+def psf():
+    return synthetic_psf()
+
+@pytest.fixture(scope='session')
+def otf(psf):
+    return synthetic_otf(psf)[0]
+
+@pytest.fixture(scope='session')
+def images(otf):
+    return synthetic_images(otf, synthetic_volume(batch_size=2))
+
+# Arguments of XLFMDeconv for the synthetic setup
+def deconv_args(**kwargs):
+    return dict(dict(ObjSize=[VOL_SIZE,VOL_SIZE], device='cpu', nSplitFourier=2, max_allowed=None), **kwargs)
@@ -0,0 +1,20 @@
+import pytest
+import torch
+from utils.LensletProjection import LensletForwardProjection, lenslet_projection_error
+from utils.misc_utils import load_PSF_OTF
+from conftest import synthetic_psf, synthetic_volume
+
+# Lenslets inside, near the border and partly outside of the 96x96 frame
+LENSLET_COORDS = torch.tensor([[10,50],[48,48],[90,20],[30,85],[70,70]])
+
+
+@pytest.mark.parametrize('fftshift_in_OTF', [False, True])
+@pytest.mark.parametrize('subimage_size', [24, 19, 30])
+def test_lenslet_views_match_the_full_reprojection(fftshift_in_OTF, subimage_size):
+    vol_size = 24
+    psf = synthetic_psf(8, 96)
+    OTF,_ = load_PSF_OTF('', 2*[vol_size], n_split=2, n_depths=8, psfIn=psf, lenslet_centers_file_out='', fftshift_in_OTF=fftshift_in_OTF)
+    lenslet_projection = LensletForwardProjection(psf, LENSLET_COORDS, 2*[subimage_size], 2*[vol_size], n_split=2)
+    volume = synthetic_volume(2, 8, vol_size)
+    error = lenslet_projection_error(lenslet_projection, volume, OTF, LENSLET_COORDS, n_split=2, fftshift_in_OTF=fftshift_in_OTF)
+    assert error['relative_error'] < 1e-5
@@ -0,0 +1,38 @@
+import json
+import os
+import pytest
+from utils.MemoryPlanner import *
+
+
+def test_chunk_fits_in_the_budget(tmp_path):
+    fft_shape = [64,64]
+    budget_gb = (fft_chunk_fixed_bytes(fft_shape) + 5*fft_chunk_bytes_per_depth(fft_shape)) / 2**30
+    chunk_size = plan_depth_chunk(fft_shape, 20, memory_budget_gb=budget_gb, cache_dir=str(tmp_path))
+    assert 1 <= chunk_size <= 5
+    assert plan_n_split(fft_shape, 20, memory_budget_gb=budget_gb, cache_dir=str(tmp_path)) == -(-20 // chunk_size)
+
+
+def test_calibration_is_stored_per_fft_shape(tmp_path):
+    budget_gb = 2**-10
+    plan_depth_chunk([32,32], 8, memory_budget_gb=budget_gb, cache_dir=str(tmp_path))
+    plan_depth_chunk([48,32], 8, memory_budget_gb=budget_gb, cache_dir=str(tmp_path))
+    plan_depth_chunk([48,32], 8, memory_budget_gb=budget_gb, cache_dir=str(tmp_path), n_lenslets=3)
+    with open(os.path.join(str(tmp_path), 'memory_planner.json')) as f:
+        calibrations = json.load(f)
+    keys = sorted(calibrations.keys())
+    assert len(keys) == 3
+    assert keys[0].endswith('_32x32') and keys[1].endswith('_48x32') and keys[2].endswith('_48x32_3L')
+    # Only the chunk sizes that fit the budget were measured
+    max_chunk = (budget_gb*2**30 - fft_chunk_fixed_bytes([32,32])) // fft_chunk_bytes_per_depth([32,32])
+    assert all(int(c) <= max_chunk for c in calibrations[keys[0]])
+
+
+def test_lenslet_model_needs_more_memory_with_more_lenslets(tmp_path):
+    fft_shape = [64,64]
+    budget_gb = 2**-8
+    few = plan_depth_chunk(fft_shape, 64, memory_budget_gb=budget_gb, cache_dir=str(tmp_path), n_lenslets=2)
+    many = plan_depth_chunk(fft_shape, 64, memory_budget_gb=budget_gb, cache_dir=str(tmp_path), n_lenslets=20)
+    assert many <= few
+    for n_lenslets, chunk_size in [(2,few), (20,many)]:
+        used = lenslet_chunk_fixed_bytes(fft_shape, n_lenslets) + chunk_size*lenslet_chunk_bytes_per_depth(fft_shape, n_lenslets)
+        assert chunk_size == 1 or used <= budget_gb*2**30
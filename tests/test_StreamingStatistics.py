@@ -0,0 +1,28 @@
+import math
+import numpy as np
+import pytest
+import torch
+from utils.StreamingStatistics import StreamingStatistics, STATISTICS_PERCENTILES
+
+
+@pytest.mark.parametrize('block_size', [7, 1000, 2**22])
+def test_streaming_statistics_match_numpy(block_size):
+    generator = torch.Generator().manual_seed(0)
+    # Two channels of float16 values around 1000 with negative ones, as items of different sizes
+    data = (1000 + 300*torch.randn(5000, 2, generator=generator)).to(torch.float16)
+    data[:50,1] = -data[:50,1]
+    stats = StreamingStatistics(2, block_size)
+    for start,stop in [(0,1), (1,999), (999,1000), (1000,5000)]:
+        stats.update(data[start:stop])
+    result = stats.result()
+
+    values = data.double().numpy()
+    assert result['count'] == [5000, 5000]
+    assert result['mean'] == pytest.approx(values.mean(0).tolist(), rel=1e-12)
+    assert result['std'] == pytest.approx(values.std(0, ddof=1).tolist(), rel=1e-10)
+    assert result['min'] == values.min(0).tolist() and result['max'] == values.max(0).tolist()
+    # The lowest value reaching the rank of each percentile
+    sorted_values = np.sort(values, 0)
+    for p in STATISTICS_PERCENTILES:
+        rank = max(1, math.ceil(p * 5000 / 100))
+        assert result['percentiles'][str(p)] == sorted_values[rank-1].tolist()
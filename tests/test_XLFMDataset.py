@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+import tifffile
+import torch
+from utils.XLFMDataset import XLFMDatasetFull, XLFMDatasetVol
+from utils.PreprocessedDataset import convert_dataset, is_memory_mapped
+
+N_IMAGES = 6
+DATASET_ARGS = {'subimage_shape' : [16,16], 'img_shape' : [64,64], 'lenslets_offset' : 0, 'n_depths_to_fill' : 8,
+                'border_blanking' : 2, 'temporal_shifts' : [0,1,2]}
+
+
+# A raw dataset of tiffs and its preprocessed versions, uncompressed (memory mapped) and compressed
+@pytest.fixture(scope='session')
+def datasets(tmp_path_factory):
+    root = tmp_path_factory.mktemp('dataset')
+    raw = str(root / 'raw')
+    generator = np.random.default_rng(0)
+    for folder in ['XLFM_image', 'XLFM_stack']:
+        os.makedirs(os.path.join(raw, folder))
+    tifffile.imwrite(os.path.join(raw, 'XLFM_image', 'XLFM_image_stack.tif'), generator.integers(100, 4000, (N_IMAGES,64,64)).astype(np.uint16))
+    for nImg in range(N_IMAGES):
+        tifffile.imwrite(os.path.join(raw, 'XLFM_stack', 'vol_%03d.tif' % nImg), (generator.random((5,40,40))*100).astype(np.float32))
+    lenslets = os.path.join(raw, 'lenslets.txt')
+    with open(lenslets, 'w') as f:
+        f.write('10\t12\n30\t30\n60\t5\n')
+    paths = {'raw' : raw, 'lenslets' : lenslets}
+    for name,compression in [('mapped',0), ('compressed',6)]:
+        paths[name] = str(root / name)
+        convert_dataset(XLFMDatasetFull(raw, lenslets, lazy=True, cache_size=0, **DATASET_ARGS), paths[name], compression=compression)
+    return paths
+
+
+@pytest.mark.parametrize('images_to_use', [[1,2,3,4], [4,0,2,3]])
+def test_share_memory_follows_the_storage(datasets, images_to_use):
+    dataset = XLFMDatasetFull(datasets['mapped'], datasets['lenslets'], images_to_use=images_to_use, **DATASET_ARGS).share_memory()
+    # Only consecutive frames are memory mapped, the other ones are copied into memory and have to be shared
+    mapped = images_to_use == [1,2,3,4]
+    for tensor in [dataset.stacked_views, dataset.vols]:
+        assert is_memory_mapped(tensor) == mapped
+        assert tensor.is_shared() != mapped
+
+
+@pytest.mark.parametrize('dataset_class', [XLFMDatasetFull, XLFMDatasetVol])
+def test_standarize_memory_mapped_items(datasets, dataset_class):
+    extra_args = {'load_imgs' : True} if dataset_class is XLFMDatasetVol else {}
+    mapped = dataset_class(datasets['mapped'], datasets['lenslets'], images_to_use=[1,2,3,4], **DATASET_ARGS, **extra_args)
+    in_memory = dataset_class(datasets['compressed'], datasets['lenslets'], images_to_use=[1,2,3,4], **DATASET_ARGS, **extra_args)
+    stored_frames = mapped.stacked_views.clone()
+    stats = in_memory.get_statistics()
+    stats = stats[:2] + stats[:2] + stats[2:]
+    mapped.standarize(stats)
+    in_memory.standarize(stats)
+    # The memory map is not written, the items are standarized when read
+    assert torch.equal(mapped.stacked_views, stored_frames)
+    for index in range(len(mapped)):
+        for item,expected in zip(mapped[index], in_memory[index]):
+            assert torch.allclose(item.float(), expected.float(), atol=1e-3)
+    assert mapped.get_dataset_statistics()['imgs']['mean'] == pytest.approx(in_memory.get_dataset_statistics()['imgs']['mean'], abs=1e-3)
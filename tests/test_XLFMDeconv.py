@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+import torch
+from utils.XLFMDeconv import *
+from utils.OTFStore import OTFStore
+from utils.XLFMDeconvPool import XLFMDeconvPool
+from conftest import VOL_SIZE, deconv_args, synthetic_otf, synthetic_volume
+
+
+def test_checkpoint_resume_matches_uninterrupted(otf, images, tmp_path):
+    checkpoint_path = str(tmp_path / 'deconv.pt')
+    full = XLFMDeconv(otf, images, 8, **deconv_args())[0]
+    XLFMDeconv(otf, images, 4, checkpoint_path=checkpoint_path, checkpoint_every=2, **deconv_args())
+    assert load_deconv_checkpoint(checkpoint_path, images)['iteration']==4
+    resumed = XLFMDeconv(otf, images, 8, checkpoint_path=checkpoint_path, checkpoint_every=2, **deconv_args())[0]
+    assert torch.equal(full, resumed)
+
+def test_checkpoint_of_other_images_or_corrupt_is_ignored(otf, images, tmp_path):
+    checkpoint_path = str(tmp_path / 'deconv.pt')
+    XLFMDeconv(otf, images, 2, checkpoint_path=checkpoint_path, checkpoint_every=1, **deconv_args())
+    assert load_deconv_checkpoint(checkpoint_path, images) is not None
+    assert load_deconv_checkpoint(checkpoint_path, 2*images) is None
+    with open(checkpoint_path, 'wb') as f:
+        f.write(b'not a checkpoint')
+    assert load_deconv_checkpoint(checkpoint_path, images) is None
+
+def test_roi_of_whole_volume_matches_full_deconvolution(otf, images):
+    full = XLFMDeconv(otf, images, 4, **deconv_args())[0]
+    roi = XLFMDeconvROI(otf, images, 4, **deconv_args())[0]
+    assert torch.equal(full, roi)
+
+def test_rectangular_roi_clipped_at_the_border(otf, images):
+    volume,proj,_,_ = XLFMDeconvROI(otf, images, 4, roi=[2,3,10,8], depth_range=[1,4], guard_pixels=4, guard_depths=1, **deconv_args())
+    assert list(volume.shape)==[2,3,10,8]
+    assert proj.shape[-2:]==volume_2_projections(volume.permute(0,2,3,1).unsqueeze(1)).shape[-2:]
+
+def test_roi_does_not_take_a_pool(otf, images):
+    with pytest.raises(AssertionError):
+        XLFMDeconvROI(otf, images, 1, roi=[0,0,8,8], pool=object(), **deconv_args())
+
+@pytest.mark.parametrize('fftshift_in_OTF', [False, True])
+def test_spectral_forward_projection_matches_per_depth(psf, fftshift_in_OTF):
+    OTF = synthetic_otf(psf, fftshift_in_OTF=fftshift_in_OTF)[0]
+    volume = synthetic_volume(batch_size=2)
+    img_shape = [2, 1, OTF.shape[2], OTF.shape[2]]
+    per_depth = XLFM_forward_projection(OTF, volume, img_shape, nSplitFourier=4, fftshift_in_OTF=fftshift_in_OTF)
+    spectral = XLFM_forward_projection(OTF, volume, img_shape, nSplitFourier=4, forward_mode='spectral', fftshift_in_OTF=fftshift_in_OTF)
+    assert torch.allclose(spectral, per_depth, rtol=1e-4, atol=1e-5*per_depth.max().item())
+
+def test_spectral_deconvolution_matches_per_depth(otf, images):
+    per_depth = XLFMDeconv(otf, images, 4, **deconv_args())[0]
+    spectral = XLFMDeconv(otf, images, 4, **deconv_args(forward_mode='spectral'))[0]
+    assert torch.allclose(spectral, per_depth, rtol=1e-3, atol=1e-4*per_depth.max().item())
+
+# The update as computed before XLFM_backprojection_update, with the FFT of the ratio for every depth
+def reference_backprojection_update(OTFt, ObjRecon, Ratio, padSize):
+    out = ObjRecon.clone()
+    for nDepth in range(ObjRecon.shape[1]):
+        update = batch_fftshift2d_real(torch.fft.irfft2(torch.fft.rfft2(Ratio) * OTFt[:,nDepth:nDepth+1]))
+        out[:,nDepth:nDepth+1] *= F.pad(update, [-p for p in padSize])
+    return out
+
+@pytest.mark.parametrize('nSplitFourier', [1, 4])
+def test_backprojection_update_matches_per_depth_ratio_fft(otf, nSplitFourier):
+    generator = torch.Generator().manual_seed(2)
+    OTFt = otf[...,1]
+    ObjRecon = torch.rand(2, otf.shape[1], 16, 16, generator=generator) + 0.5
+    Ratio = torch.rand(2, 1, otf.shape[2], otf.shape[2], generator=generator) + 0.5
+    padSize = 4*[(otf.shape[2] - 16)//2]
+    expected = reference_backprojection_update(OTFt, ObjRecon, Ratio, padSize)
+    updated = XLFM_backprojection_update(OTFt, ObjRecon.clone(), Ratio, padSize, nSplitFourier)
+    assert torch.allclose(updated, expected, rtol=1e-5)
+    precomputed = XLFM_backprojection_update(OTFt, ObjRecon.clone(), None, padSize, nSplitFourier, RatioFFT=torch.fft.rfft2(Ratio))
+    assert torch.equal(precomputed, updated)
+    # The frozen depths are left as they were
+    depth_mask = torch.arange(otf.shape[1]) % 2 == 0
+    masked = XLFM_backprojection_update(OTFt, ObjRecon.clone(), Ratio, padSize, nSplitFourier, depth_mask=depth_mask)
+    assert torch.allclose(masked[:,depth_mask], expected[:,depth_mask], rtol=1e-5)
+    assert torch.equal(masked[:,~depth_mask], ObjRecon[:,~depth_mask])
+
+def test_batched_deconvolution_matches_single_images(otf, images):
+    batch = torch.cat([images, torch.zeros_like(images[:1])])
+    batched = XLFMDeconv(otf, batch, 4, **deconv_args())[0]
+    for nImg in range(images.shape[0]):
+        single = XLFMDeconv(otf, images[nImg:nImg+1], 4, **deconv_args())[0]
+        assert torch.allclose(batched[nImg], single[0], rtol=1e-4, atol=1e-5*single.max().item())
+    # Empty images give empty volumes
+    assert batched[-1].abs().sum()==0
+
+@pytest.mark.parametrize('fftshift_in_OTF', [False, True])
+@pytest.mark.parametrize('n_resident', [0, 3])
+def test_streamed_otf_matches_in_memory(psf, images, tmp_path, fftshift_in_OTF, n_resident):
+    OTF = synthetic_otf(psf, fftshift_in_OTF=fftshift_in_OTF)[0]
+    np.save(str(tmp_path / 'OTF.npy'), OTF[...,0].numpy())
+    # Room for n_resident depths besides the chunk in use and the one read ahead
+    depth_bytes = OTF[0,0,...,0].numel() * 8
+    store = OTFStore(str(tmp_path / 'OTF.npy'), max_ram_gb=(n_resident+2)*depth_bytes/2**30 if n_resident else 0, chunk_depths=1,
+                    fftshift_in_OTF=fftshift_in_OTF)
+    assert store.n_resident == n_resident
+    in_memory = XLFMDeconv(OTF, images, 4, **deconv_args(fftshift_in_OTF=fftshift_in_OTF))[0]
+    streamed = XLFMDeconv(store, images, 4, **deconv_args(fftshift_in_OTF=fftshift_in_OTF))[0]
+    store.close()
+    assert store.stats['chunks_read'] > 0
+    assert torch.allclose(streamed, in_memory, rtol=1e-5, atol=1e-6*in_memory.max().item())
+
+@pytest.mark.parametrize('forward_mode', ['per_depth', 'spectral'])
+def test_worker_pool_matches_single_process(otf, images, forward_mode):
+    single = XLFMDeconv(otf, images, 4, **deconv_args(forward_mode=forward_mode))[0]
+    pool = XLFMDeconvPool(otf, 3, ObjSize=[VOL_SIZE,VOL_SIZE], max_batch_size=images.shape[0], n_reduce_slots=2)
+    try:
+        pooled = XLFMDeconv(otf, images, 4, pool=pool, **deconv_args(forward_mode=forward_mode))[0]
+    finally:
+        pool.close()
+    assert torch.allclose(pooled, single, rtol=1e-4, atol=1e-5*single.max().item())
@@ -0,0 +1,54 @@
+import pytest
+import torch
+from utils.misc_utils import *
+
+
+@pytest.mark.parametrize('shape', [[64,64], [63,64], [63,66], [1,8]])
+def test_fftshift_phase_ramp_matches_fftshift(shape):
+    x = torch.rand(2, 3, *shape, dtype=torch.float64)
+    X = torch.fft.rfft2(x)
+    shifted = torch.fft.irfft2(X * fftshift_phase_ramp(shape).to(torch.complex128), s=shape)
+    assert torch.allclose(shifted, batch_fftshift2d_real(x), atol=1e-6)
+
+def test_fftshift_phase_ramp_needs_even_width():
+    with pytest.raises(AssertionError):
+        fftshift_phase_ramp([64,63])
+
+def test_otf_with_fftshift_matches_shifted_convolution(psf):
+    from conftest import synthetic_otf, synthetic_volume
+    from utils.XLFMDeconv import XLFM_forward_projection
+    OTF,_ = synthetic_otf(psf)
+    OTF_shifted,_ = synthetic_otf(psf, fftshift_in_OTF=True)
+    volume = synthetic_volume()
+    img_shape = [1, 1, OTF.shape[2], OTF.shape[2]]
+    for forward_mode in ['per_depth', 'spectral']:
+        img = XLFM_forward_projection(OTF, volume, img_shape, nSplitFourier=2, forward_mode=forward_mode)
+        img_shifted = XLFM_forward_projection(OTF_shifted, volume, img_shape, nSplitFourier=2, forward_mode=forward_mode, fftshift_in_OTF=True)
+        assert torch.allclose(img, img_shifted, atol=1e-4*img.abs().max().item())
+
+# Views as extract_views copied them, one lenslet at a time
+def reference_lenslet_views(image, lenslet_coords, subimage_shape):
+    views = torch.zeros(list(image.shape[:2]) + [lenslet_coords.shape[0]] + list(subimage_shape), dtype=image.dtype)
+    for nLens,(row,col) in enumerate(lenslet_coords.tolist()):
+        patch = image[:,:,max(row-subimage_shape[0]//2,0):row+subimage_shape[0]//2, max(col-subimage_shape[1]//2,0):col+subimage_shape[1]//2]
+        views[:,:,nLens,-patch.shape[2]:,-patch.shape[3]:] = patch
+    return views
+
+@pytest.mark.parametrize('view_function', [unfold_lenslet_views, copy_lenslet_views, gather_lenslet_views])
+def test_lenslet_views_match_per_lenslet_copy(view_function):
+    generator = torch.Generator().manual_seed(1)
+    n_tested = 0
+    while n_tested < 200:
+        image_shape = torch.randint(8, 80, (2,), generator=generator).tolist()
+        # Odd and even subimages, with lenslets inside and across the border of the image
+        subimage_shape = torch.randint(1, 40, (2,), generator=generator).tolist()
+        n_lenslets = int(torch.randint(1, 8, (1,), generator=generator))
+        lenslet_coords = torch.cat([torch.randint(0, image_shape[n], (n_lenslets,1), generator=generator) for n in range(2)], 1).int()
+        image = torch.rand(2, 3, image_shape[0], image_shape[1], generator=generator)
+        try:
+            expected = reference_lenslet_views(image, lenslet_coords, subimage_shape)
+        except RuntimeError:
+            # Patches larger than the subimage, not a valid layout
+            continue
+        assert torch.equal(view_function(image, lenslet_coords, subimage_shape), expected)
+        n_tested += 1
@@ -0,0 +1,110 @@
+import torch
+import torch.nn.functional as F
+
+from utils.misc_utils import *
+from utils.XLFMDataset import XLFMDatasetFull
+
+
+# Forward projection evaluated only inside the lenslet windows used by XLFMDatasetFull.extract_views.
+# The full reprojection (fft_conv_split followed by extract_views) convolves the volume with the whole PSF and keeps
+# n_lenslets windows of the image, here each window is computed from a PSF kernel cropped around its lenslet:
+#   window[r] = sum_u volume[u] * PSF[y0 + t + r - u], with y0 the window start and t the offset of the full convolution.
+# kernel_shape:
+#   None: the kernel holds all the PSF that reaches the window (window + volume size - 1), the result in the
+#         windows is the same as the full reprojection.
+#   [K0,K1]: the kernel is trimmed to K around the lenslet, ignoring the PSF of neighbouring lenslets that
+#            only reaches the window borders, with smaller FFTs and kernels. See lenslet_projection_error.
+# The volume spectrum is shared by all lenslets, as all windows have the same size, and the depths are added up
+# in the Fourier domain, so a single inverse FFT is needed per lenslet.
+class LensletForwardProjection():
+    def __init__(self, psf, lenslet_coords, subimage_shape, vol_shape, kernel_shape=None, n_split=20, device='cpu'):
+        self.psf_shape = list(psf.shape[-2:])
+        self.vol_shape = list(vol_shape[:2])
+        self.subimage_shape = list(subimage_shape[:2])
+        self.lenslet_coords = lenslet_coords.clone()
+        self.n_lenslets = lenslet_coords.shape[0]
+        self.n_depths = psf.shape[1]
+        self.n_split = n_split
+        self.device = device
+
+        # Window size, as in extract_views, and offset between the volume and the PSF in the full convolution
+        half_subimg_shape = [s//2 for s in self.subimage_shape]
+        self.window_shape = [2*h for h in half_subimg_shape]
+        full_shape = [self.vol_shape[n] + self.psf_shape[n] for n in range(2)]
+        conv_offset = [(full_shape[n]+1)//2 - (self.psf_shape[n]+1)//2 for n in range(2)]
+        full_kernel_shape = [self.window_shape[n] + self.vol_shape[n] - 1 for n in range(2)]
+        if kernel_shape is None:
+            kernel_shape = full_kernel_shape
+        self.kernel_shape = [min(int(kernel_shape[n]), full_kernel_shape[n]) for n in range(2)]
+        assert all([self.kernel_shape[n] >= self.window_shape[n] - self.vol_shape[n] + 1 for n in range(2)]), \
+            'kernel_shape should be at least the window size minus the volume size plus one.'
+        kernel_offset = [(full_kernel_shape[n] - self.kernel_shape[n])//2 for n in range(2)]
+        # Start of the window in the circular convolution of the volume and the kernel, and FFT size
+        # big enough to not alias into the window
+        self.window_start = [self.vol_shape[n] - 1 - kernel_offset[n] for n in range(2)]
+        self.fft_shape = [max(self.kernel_shape[n] + kernel_offset[n], self.window_start[n] + self.window_shape[n]) for n in range(2)]
+
+        # Crop the kernel of every lenslet from the PSF, zero padded where the kernel falls outside the PSF
+        self.window_bounds = []
+        kernels = torch.zeros(self.n_lenslets, self.n_depths, self.fft_shape[0], self.fft_shape[1])
+        self.kernel_energy = torch.zeros(self.n_lenslets)
+        for nLens in range(self.n_lenslets):
+            window_start = [int(lenslet_coords[nLens,n]) - half_subimg_shape[n] for n in range(2)]
+            self.window_bounds.append(window_start)
+            kernel_start = [window_start[n] + conv_offset[n] - self.vol_shape[n] + 1 + kernel_offset[n] for n in range(2)]
+            src = [slice(max(kernel_start[n],0), min(kernel_start[n]+self.kernel_shape[n], self.psf_shape[n])) for n in range(2)]
+            if src[0].start >= src[0].stop or src[1].start >= src[1].stop:
+                continue
+            dst = [slice(src[n].start-kernel_start[n], src[n].stop-kernel_start[n]) for n in range(2)]
+            kernels[nLens,:,dst[0],dst[1]] = psf[0,:,src[0],src[1]].float()
+            self.kernel_energy[nLens] = kernels[nLens].sum()
+        self.OTFs = torch.fft.rfft2(kernels).to(device)
+
+    # Volume [B,nDepths,vol_shape[0],vol_shape[1]] to lenslet views [B,n_lenslets,subimage_shape[0],subimage_shape[1]],
+    # matching extract_views(fft_conv_split(volume, OTF, ...))[:,0]
+    def __call__(self, volume):
+        batch_size = volume.shape[0]
+        views_fft = torch.zeros(batch_size, self.n_lenslets, self.fft_shape[0], self.fft_shape[1]//2+1, dtype=torch.complex64, device=self.device)
+        n_chunk = max(self.n_depths // self.n_split, 1)
+        for jj in range(0, self.n_depths, n_chunk):
+            vol_fft = torch.fft.rfft2(volume[:,jj:jj+n_chunk].float().to(self.device), s=self.fft_shape)
+            views_fft += torch.einsum('bdxy,ldxy->blxy', vol_fft, self.OTFs[:,jj:jj+n_chunk])
+        windows = torch.fft.irfft2(views_fft, s=self.fft_shape)
+        windows = windows[...,self.window_start[0]:self.window_start[0]+self.window_shape[0],
+                            self.window_start[1]:self.window_start[1]+self.window_shape[1]].abs()
+
+        # Place the part of each window inside the image as extract_views does
+        views = torch.zeros(batch_size, self.n_lenslets, self.subimage_shape[0], self.subimage_shape[1], device=self.device)
+        for nLens in range(self.n_lenslets):
+            start = self.window_bounds[nLens]
+            valid = [slice(max(-start[n],0), min(self.window_shape[n], self.psf_shape[n]-start[n])) for n in range(2)]
+            n_valid = [valid[n].stop - valid[n].start for n in range(2)]
+            if n_valid[0] <= 0 or n_valid[1] <= 0:
+                continue
+            views[:,nLens,-n_valid[0]:,-n_valid[1]:] = windows[:,nLens,valid[0],valid[1]]
+        return views
+
+
+# Same as reprojection_loss, but evaluating only the lenslet windows with a LensletForwardProjection
+def reprojection_loss_lenslets(gt_imgs, prediction, lenslet_projection, loss=F.mse_loss):
+    out_type = gt_imgs.type()
+    device = lenslet_projection.device
+    with torch.no_grad():
+        reprojection_views = lenslet_projection(prediction)
+    curr_loss = loss(gt_imgs.float().to(device), reprojection_views.float())
+    return curr_loss.type(out_type), reprojection_views.type(out_type), gt_imgs.type(out_type), None
+
+
+# Difference of the lenslet windows to the full reprojection, for example to choose kernel_shape
+def lenslet_projection_error(lenslet_projection, volume, OTF, lenslet_coords, n_split=20, fftshift_in_OTF=False):
+    with torch.no_grad():
+        views = lenslet_projection(volume).cpu()
+        full_views = torch.zeros_like(views)
+        for nSample in range(volume.shape[0]):
+            reprojection = fft_conv_split(volume[nSample].unsqueeze(0).float(), OTF, torch.tensor(lenslet_projection.psf_shape), n_split,
+                                        B_precomputed=True, device=OTF.device, fftshift_in_OTF=fftshift_in_OTF)
+            full_views[nSample] = XLFMDatasetFull.extract_views(reprojection, lenslet_coords, lenslet_projection.subimage_shape)[0,0].cpu()
+    diff = views - full_views
+    return {'max_abs_error' : diff.abs().max().item(),
+            'relative_error' : (diff.norm() / full_views.norm().clamp(min=1e-12)).item()}
+
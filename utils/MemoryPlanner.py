@@ -0,0 +1,149 @@
+import torch
+import os
+import json
+import time
+import socket
+
+from utils.misc_utils import *
+
+
+# Choice of the number of depths convolved at once (nSplitFourier in XLFMDeconv, n_depths//n_split in fft_conv_split)
+# from a memory budget:
+#   - The memory of a chunk of depths grows linearly with its size (see fft_chunk_bytes_per_depth), which bounds the chunk.
+#   - Bigger chunks are faster up to a point, the throughput of each chunk size is measured once per machine, device and
+#     FFT shape by calibrate_fft_throughput and stored in the cache directory. The smallest chunk within 5% of the best
+#     throughput that fits in the budget is chosen.
+# There are two models, the full frame convolutions of XLFMDeconv and fft_conv_split, and the lenslet windows of a
+# LensletForwardProjection (n_lenslets > 0), whose chunks hold the spectra of the volume and the kernels of all lenslets.
+PLANNER_CHUNK_SIZES = [1,2,4,8,16,32]
+
+# Free memory of a device in bytes, for the CPU the available RAM
+def available_memory(device='cpu'):
+    device = torch.device(device)
+    if device.type=='cuda':
+        if hasattr(torch.cuda, 'mem_get_info'):
+            return torch.cuda.mem_get_info(device)[0]
+        # Older torch versions, the memory not reserved by this process
+        return torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+# Memory needed per depth of a chunk, for a batch of batch_size images with FFTs of fft_shape:
+# the OTF of the depth (complex64), the padded plane, its spectrum, the product with the OTF and the inverse FFT
+# with its shifted and rectified copies. fixed_bytes covers the images and ratio of the batch, which don't depend on the chunk.
+def fft_chunk_bytes_per_depth(fft_shape, batch_size=1):
+    n_real = fft_shape[0] * fft_shape[1]
+    n_complex = fft_shape[0] * (fft_shape[1]//2+1)
+    return 8*n_complex*(1 + 2*batch_size) + 16*n_real*batch_size
+
+def fft_chunk_fixed_bytes(fft_shape, batch_size=1):
+    return 4 * 4*fft_shape[0]*fft_shape[1]*batch_size
+
+# Same for LensletForwardProjection: the padded volume planes, their spectrum and its copy arranged for the einsum,
+# and the copy of the kernel spectra of the n_lenslets. The fixed part is the accumulated spectra of the lenslet
+# windows, the einsum result added to them and the inverse FFT of the windows.
+def lenslet_chunk_bytes_per_depth(fft_shape, n_lenslets, batch_size=1):
+    n_real = fft_shape[0] * fft_shape[1]
+    n_complex = fft_shape[0] * (fft_shape[1]//2+1)
+    return 4*n_real*batch_size + 8*n_complex*(2*batch_size + n_lenslets)
+
+def lenslet_chunk_fixed_bytes(fft_shape, n_lenslets, batch_size=1):
+    n_real = fft_shape[0] * fft_shape[1]
+    n_complex = fft_shape[0] * (fft_shape[1]//2+1)
+    return (2*8*n_complex + 2*4*n_real) * n_lenslets * batch_size
+
+# Depths per second of each chunk size, with FFTs of fft_shape:
+#   n_lenslets 0: rfft2, product with an OTF and irfft2, as in the full frame convolutions.
+#   n_lenslets > 0: rfft2 and the einsum with the kernels of the lenslets of a LensletForwardProjection.
+def calibrate_fft_throughput(device='cpu', fft_shape=[512,512], chunk_sizes=PLANNER_CHUNK_SIZES, n_repeats=3, n_lenslets=0):
+    def chunk_op(planes, OTF):
+        if n_lenslets > 0:
+            return torch.einsum('bdxy,ldxy->blxy', torch.fft.rfft2(planes), OTF)
+        return torch.fft.irfft2(torch.fft.rfft2(planes) * OTF)
+    throughput = {}
+    with torch.no_grad():
+        for chunk_size in chunk_sizes:
+            planes = torch.rand(1, chunk_size, fft_shape[0], fft_shape[1], device=device)
+            OTF = torch.fft.rfft2(torch.rand(max(n_lenslets,1), chunk_size, fft_shape[0], fft_shape[1], device=device))
+            chunk_op(planes, OTF)
+            if torch.device(device).type=='cuda':
+                torch.cuda.synchronize(device)
+            start_time = time.time()
+            for _ in range(n_repeats):
+                chunk_op(planes, OTF)
+            if torch.device(device).type=='cuda':
+                torch.cuda.synchronize(device)
+            throughput[chunk_size] = chunk_size * n_repeats / max(time.time() - start_time, 1e-9)
+            del planes, OTF
+    return throughput
+
+# Calibration of this machine, device and FFT shape for chunk_sizes, loaded from cache_dir or measured and stored there.
+# Only the chunk sizes missing from the cache are measured.
+def load_fft_calibration(device='cpu', cache_dir=OTF_CACHE_DIR, fft_shape=[512,512], chunk_sizes=PLANNER_CHUNK_SIZES, n_lenslets=0):
+    device = torch.device(device)
+    device_name = torch.cuda.get_device_name(device) if device.type=='cuda' else 'cpu' + str(torch.get_num_threads())
+    key = socket.gethostname() + '_' + device_name + '_' + torch.__version__ + '_' + 'x'.join([str(int(s)) for s in fft_shape[:2]]) + \
+            ('_' + str(n_lenslets) + 'L' if n_lenslets > 0 else '')
+    cache_file = os.path.join(cache_dir, 'memory_planner.json') if cache_dir else None
+    calibrations = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                calibrations = json.load(f)
+        except (OSError, ValueError):
+            calibrations = {}
+    missing = [c for c in chunk_sizes if str(c) not in calibrations.get(key, {})]
+    if len(missing) > 0:
+        measured = calibrate_fft_throughput(device, fft_shape, missing, n_lenslets=n_lenslets)
+        calibrations[key] = dict(calibrations.get(key, {}), **{str(c) : v for c,v in measured.items()})
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + '.tmp' + str(os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(calibrations, f, indent=1)
+            os.replace(tmp_file, cache_file)
+    return {int(k):v for k,v in calibrations[key].items() if int(k) in chunk_sizes}
+
+# Number of depths to convolve at once with FFTs of fft_shape, for at most n_depths.
+# memory_budget_gb: memory for the chunks, None or a negative value to use 80% of the free memory of the device.
+# n_lenslets: 0 for the full frame convolutions, or the lenslets of a LensletForwardProjection with FFTs of fft_shape.
+def plan_depth_chunk(fft_shape, n_depths, batch_size=1, memory_budget_gb=None, device='cpu', cache_dir=OTF_CACHE_DIR, verbose=False, n_lenslets=0):
+    if memory_budget_gb is None or memory_budget_gb < 0:
+        memory_budget = 0.8 * available_memory(device)
+    else:
+        memory_budget = memory_budget_gb * 2**30
+    if n_lenslets > 0:
+        per_depth = lenslet_chunk_bytes_per_depth(fft_shape, n_lenslets, batch_size)
+        fixed_bytes = lenslet_chunk_fixed_bytes(fft_shape, n_lenslets, batch_size)
+    else:
+        per_depth = fft_chunk_bytes_per_depth(fft_shape, batch_size)
+        fixed_bytes = fft_chunk_fixed_bytes(fft_shape, batch_size)
+    max_chunk = int((memory_budget - fixed_bytes) // per_depth)
+    max_chunk = min(max(max_chunk, 1), n_depths)
+
+    # Only the chunk sizes that fit are measured, at the FFT shape that will be used
+    candidates = [c for c in PLANNER_CHUNK_SIZES if c <= max_chunk]
+    if len(candidates)==0:
+        chunk_size = max_chunk
+    else:
+        throughput = load_fft_calibration(device, cache_dir, fft_shape, candidates, n_lenslets)
+        best = max(throughput[c] for c in candidates)
+        chunk_size = min(c for c in candidates if throughput[c] >= 0.95*best)
+        # The calibration doesn't go further, bigger chunks than the largest one are assumed as fast
+        if chunk_size==PLANNER_CHUNK_SIZES[-1] and max_chunk > chunk_size:
+            chunk_size = max_chunk
+    if verbose:
+        print('Memory planner: ' + str(chunk_size) + ' depths per chunk, ' + str(round(per_depth*chunk_size/2**30,2)) + \
+                'GB of ' + str(round(memory_budget/2**30,2)) + 'GB')
+    return chunk_size
+
+# n_split for fft_conv_split or a LensletForwardProjection (n_lenslets > 0), with chunks of at most plan_depth_chunk depths
+def plan_n_split(fft_shape, n_depths, batch_size=1, memory_budget_gb=None, device='cpu', cache_dir=OTF_CACHE_DIR, verbose=False, n_lenslets=0):
+    chunk_size = plan_depth_chunk(fft_shape, n_depths, batch_size, memory_budget_gb, device, cache_dir, verbose, n_lenslets)
+    return -(-n_depths // chunk_size)
@@ -0,0 +1,137 @@
+import torch
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.misc_utils import *
+
+
+# Disk backed OTF for deconvolution with bounded RAM.
+# The OTF [1,nDepths,H,W] (without transpose) is memory-mapped from the OTF cache, and XLFMDeconv reads it
+# nSplitFourier depths at a time, so only the requested chunks are copied to RAM:
+#   - The first depths that fit in max_ram_gb are kept resident, the rest are read from disk on every use.
+#     As every iteration sweeps all the depths in order, pinning a fixed part is better than any LRU policy.
+#   - While a chunk is being used, the next one is read in a background thread (read-ahead).
+#   - The transpose is not stored, OTF[...,1] conjugates the chunks when they are read.
+# OTF[...,0] and OTF[...,1] return views that can be sliced along depths like the in memory OTF,
+# OTF[:,jj:jj+n,...], and OTF.shape matches the in memory OTF with compute_transpose=True.
+# If the OTF has the fftshift baked in (fftshift_in_OTF) its conjugate holds the opposite shift,
+# which for odd sizes differs in one pixel and is corrected with the squared phase ramp.
+class OTFStore():
+    def __init__(self, otf_path, max_ram_gb=8, read_ahead=True, chunk_depths=6, fftshift_in_OTF=False):
+        self.otf_path = otf_path
+        self.OTF = np.load(otf_path, mmap_mode='r')
+        assert self.OTF.ndim==4, 'OTFStore expects an OTF without transpose, with shape [1,nDepths,H,W].'
+        self.n_depths = self.OTF.shape[1]
+        self.shape = torch.Size(list(self.OTF.shape) + [2])
+        self.depth_bytes = self.OTF[0,0].nbytes
+        self.fftshift_in_OTF = fftshift_in_OTF
+        self.conj_correction = None
+        # The stored OTF has the ramp of an even FFT width (see fftshift_phase_ramp), only odd heights need a correction
+        if fftshift_in_OTF and self.shape[2] % 2 != 0:
+            self.conj_correction = fftshift_phase_ramp([self.shape[2], 2*(self.shape[3]-1)])**2
+
+        # Keep resident as many depths as fit in the budget, leaving room for the chunk in use and the one read ahead
+        self.max_ram_gb = max_ram_gb
+        self.chunk_depths = chunk_depths
+        n_resident = int(max_ram_gb * 2**30 // self.depth_bytes)
+        if n_resident < self.n_depths:
+            n_resident = max(0, n_resident - 2*chunk_depths)
+        self.n_resident = min(n_resident, self.n_depths)
+        self.resident = torch.from_numpy(np.ascontiguousarray(self.OTF[:,:self.n_resident]))
+
+        self.read_ahead = read_ahead
+        self.executor = ThreadPoolExecutor(max_workers=1) if read_ahead else None
+        self.pending = None
+        self.stats = {'bytes_read' : 0, 'chunks_read' : 0, 'read_ahead_hits' : 0, 'wait_time' : 0.0}
+
+    def __getitem__(self, key):
+        # Only OTF[...,0] and OTF[...,1] are supported
+        assert isinstance(key, tuple) and len(key)==2 and key[0] is Ellipsis and key[1] in [0,1], 'OTFStore only supports OTF[...,0] and OTF[...,1]'
+        return OTFStoreView(self, conjugate=key[1]==1)
+
+    def read_depths(self, start, stop):
+        stop = min(stop, self.n_depths)
+        if stop <= self.n_resident:
+            return self.resident[:,start:stop]
+        chunk = torch.from_numpy(np.ascontiguousarray(self.OTF[:,max(start,self.n_resident):stop]))
+        self.stats['bytes_read'] += chunk.numel() * chunk.element_size()
+        self.stats['chunks_read'] += 1
+        if start < self.n_resident:
+            chunk = torch.cat((self.resident[:,start:], chunk), 1)
+        return chunk
+
+    def get_depths(self, start, stop):
+        stop = min(stop, self.n_depths)
+        start_time = time.time()
+        if self.pending is not None and self.pending[0]==(start,stop):
+            chunk = self.pending[1].result()
+            self.stats['read_ahead_hits'] += 1
+        else:
+            chunk = self.read_depths(start, stop)
+        self.stats['wait_time'] += time.time() - start_time
+        self.pending = None
+        # Read the next chunk while this one is used, wrapping around as the next sweep starts from the first depth
+        if stop < self.n_depths:
+            self.chunk_depths = stop - start
+        if self.read_ahead:
+            next_start = stop if stop < self.n_depths else 0
+            next_stop = min(next_start + self.chunk_depths, self.n_depths)
+            if next_stop > self.n_resident:
+                self.pending = ((next_start,next_stop), self.executor.submit(self.read_depths, next_start, next_stop))
+        return chunk
+
+    def ram_usage(self):
+        # Upper bound of the bytes held in RAM: resident depths, the chunk in use and the one read ahead
+        n_streamed = min(2*self.chunk_depths, self.n_depths - self.n_resident)
+        return (self.n_resident + n_streamed) * self.depth_bytes
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.pending = None
+
+
+class OTFStoreView():
+    def __init__(self, store, conjugate=False):
+        self.store = store
+        self.conjugate = conjugate
+        self.shape = store.shape[:-1]
+
+    def __getitem__(self, key):
+        # Only depth slices are supported: OTF[:,start:stop,...]
+        assert isinstance(key, tuple) and key[0]==slice(None) and isinstance(key[1], slice) and all(k is Ellipsis for k in key[2:]), \
+            'OTFStore views only support OTF[:,start:stop,...]'
+        start = key[1].start if key[1].start is not None else 0
+        stop = key[1].stop if key[1].stop is not None else self.store.n_depths
+        chunk = self.store.get_depths(start, stop)
+        if self.conjugate:
+            chunk = chunk.conj_physical()
+            if self.store.conj_correction is not None:
+                chunk *= self.store.conj_correction
+        return chunk
+
+    def to(self, device):
+        # Chunks are moved to the device when used
+        return self
+
+
+# Load the OTF of a PSF as an OTFStore, computing it and storing it in the OTF cache if needed
+def load_PSF_OTF_store(filename, vol_size, n_split=20, n_depths=120, downS=1, device="cpu",
+                 cache_dir=OTF_CACHE_DIR, max_ram_gb=8, read_ahead=True, chunk_depths=6, lenslet_centers_file_out='', fftshift_in_OTF=False):
+    assert cache_dir, 'An OTF cache directory is needed to stream the OTF from disk.'
+    cache_path = os.path.join(cache_dir, get_OTF_cache_key(hash_file(filename), vol_size, n_depths, downS, False, fftshift_in_OTF))
+    cache_entry = load_OTF_cache_entry(cache_path)
+    if cache_entry is None:
+        OTF,psf_shape = load_PSF_OTF(filename, vol_size, n_split=n_split, n_depths=n_depths, downS=downS, device=device,
+                                    compute_transpose=False, lenslet_centers_file_out=lenslet_centers_file_out, cache_dir=cache_dir,
+                                    fftshift_in_OTF=fftshift_in_OTF)
+        del OTF
+    else:
+        psf_shape = cache_entry[1]
+        del cache_entry
+        if len(lenslet_centers_file_out)>0:
+            np.savetxt(lenslet_centers_file_out, get_OTF_cache_lenslet_centers(cache_path, filename, n_depths), fmt='%d', delimiter='\t')
+    return OTFStore(os.path.join(cache_path, 'OTF.npy'), max_ram_gb=max_ram_gb, read_ahead=read_ahead, chunk_depths=chunk_depths,
+                    fftshift_in_OTF=fftshift_in_OTF), psf_shape
@@ -0,0 +1,235 @@
+import os
+import json
+import zlib
+import glob
+import hashlib
+import warnings
+import weakref
+import numpy as np
+import torch
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.StreamingStatistics import StreamingStatistics
+
+
+# Preprocessed dataset, written once by convert_dataset (see mainConvertDataset.py) from the raw tiffs, with the
+# frames and volumes exactly as XLFMDatasetFull stores them in memory:
+#   frames.bin: float16 frames [n_images, H, W], or [n_images, H, W, 2] with the sparse frames, padded and cropped.
+#   volumes.bin, volumes_sparse.bin: float16 depth-major volumes [n_images, n_depths, H, W] from XLFM_stack and XLFM_stack_S,
+#                                    border blanked and cropped.
+#   views.bin: optionally, the lenslet views of the frames [n_images, n_lenslets, h, w] or [n_images, n_lenslets, h, w, 2],
+#              for XLFMDatasetFull with lenslet_views. The manifest has the lenslet layout they were extracted with.
+#   manifest.json: shapes, the raw frame index of every stored item, statistics and the volumes that failed to load.
+#                  The statistics of each array (see StreamingStatistics) are the ones of all the stored items, the ones of
+#                  other subsets of frames are added under subset_statistics when a dataset first needs them.
+# The arrays are stored in chunks of chunk_size items. Uncompressed they are contiguous and memory mapped when loaded,
+# with zlib each chunk is compressed on its own and the chunk offsets are in the manifest.
+PREPROCESSED_MANIFEST = 'manifest.json'
+PREPROCESSED_VERSION = 1
+
+def is_preprocessed_dataset(path):
+    return os.path.exists(os.path.join(path, PREPROCESSED_MANIFEST))
+
+def read_manifest(path):
+    with open(os.path.join(path, PREPROCESSED_MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    assert manifest['version'] == PREPROCESSED_VERSION, 'Preprocessed dataset version ' + str(manifest['version']) + ' not supported.'
+    return manifest
+
+def write_manifest(path, manifest):
+    manifest_file = os.path.join(path, PREPROCESSED_MANIFEST)
+    tmp_file = manifest_file + '.tmp' + str(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+# Appends items of an array to a file, in chunks of chunk_size items, compressed with zlib at compression level (0 to store them raw)
+class ChunkedArrayWriter():
+    def __init__(self, filename, item_shape, chunk_size=16, compression=0, dtype=np.float16):
+        self.filename = filename
+        self.item_shape = list(item_shape)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.dtype = np.dtype(dtype)
+        self.file = open(filename, 'wb')
+        self.buffer = []
+        self.chunks = []
+        self.n_items = 0
+
+    def append(self, item):
+        item = np.ascontiguousarray(np.asarray(item, dtype=self.dtype))
+        assert list(item.shape) == self.item_shape, 'Item of shape ' + str(list(item.shape)) + ' instead of ' + str(self.item_shape)
+        self.buffer.append(item.tobytes())
+        self.n_items += 1
+        if len(self.buffer) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        data = b''.join(self.buffer)
+        if self.compression > 0:
+            data = zlib.compress(data, self.compression)
+        self.chunks.append([self.file.tell(), len(data)])
+        self.file.write(data)
+        self.buffer = []
+
+    # Closes the file and returns the description of the array for the manifest
+    def close(self):
+        self.flush()
+        self.file.close()
+        return {'file' : os.path.basename(self.filename), 'dtype' : self.dtype.name, 'shape' : [self.n_items] + self.item_shape,
+                'chunk_size' : self.chunk_size, 'compression' : 'zlib' if self.compression > 0 else None, 'chunks' : self.chunks}
+
+# Read only memory maps of load_preprocessed_array, see is_memory_mapped
+MEMORY_MAPS = []
+
+# Whether tensor is backed by a memory map of load_preprocessed_array. These are read only and writing to them crashes,
+# the processing of their items has to be out of place.
+def is_memory_mapped(tensor):
+    ptr = tensor.data_ptr()
+    for memory_map in MEMORY_MAPS:
+        data = memory_map()
+        if data is not None and data.ctypes.data <= ptr < data.ctypes.data + data.nbytes:
+            return True
+    return False
+
+# Items at positions of an array of the manifest, as a tensor. Uncompressed arrays are memory mapped read only (see
+# is_memory_mapped) and consecutive positions are returned without copies, compressed ones are decompressed into memory.
+def load_preprocessed_array(path, array, positions, n_workers=10):
+    filename = os.path.join(path, array['file'])
+    shape = array['shape']
+    dtype = np.dtype(array['dtype'])
+    if array['compression'] is None:
+        data = np.memmap(filename, dtype=dtype, mode='r', shape=tuple(shape))
+        MEMORY_MAPS[:] = [m for m in MEMORY_MAPS if m() is not None] + [weakref.ref(data)]
+        if positions == list(range(positions[0], positions[0]+len(positions))):
+            with warnings.catch_warnings():
+                # torch warns about tensors of read only arrays, the ones of MEMORY_MAPS are never written
+                warnings.simplefilter('ignore', UserWarning)
+                return torch.from_numpy(data[positions[0]:positions[0]+len(positions)])
+        return torch.from_numpy(data[positions])
+
+    out = torch.zeros([len(positions)] + shape[1:], dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype)
+    chunk_size = array['chunk_size']
+    positions_per_chunk = {}
+    for nOut,pos in enumerate(positions):
+        positions_per_chunk.setdefault(pos // chunk_size, []).append((nOut, pos % chunk_size))
+    def decompress(nChunk):
+        offset,n_bytes = array['chunks'][nChunk]
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            chunk = np.frombuffer(zlib.decompress(f.read(n_bytes)), dtype=dtype).reshape([-1] + shape[1:])
+        for nOut,pos in positions_per_chunk[nChunk]:
+            out[nOut] = torch.from_numpy(chunk[pos].copy())
+    with ThreadPoolExecutor(max_workers=max(n_workers,1)) as executor:
+        list(executor.map(decompress, positions_per_chunk))
+    return out
+
+# Frames and volumes of the raw frames images_to_use (all the stored ones with None), [stacked_views, vols, manifest, images_to_use].
+# The sparse frames and volumes are used when load_sparse and stored, as XLFMDatasetFull does, the missing arrays are returned as None.
+# frames_array: 'views' to load the lenslet views instead of the frames.
+def load_preprocessed_dataset(path, images_to_use=None, load_imgs=True, load_sparse=False, load_vols=True, n_workers=10, frames_array='frames'):
+    manifest = read_manifest(path)
+    stored_images = manifest['images_to_use']
+    if images_to_use is None:
+        images_to_use = stored_images
+    missing = [i for i in images_to_use if i not in stored_images]
+    assert len(missing)==0, 'Frames ' + str(missing[:10]) + ' are not in the preprocessed dataset ' + path
+    positions = [stored_images.index(i) for i in images_to_use]
+
+    load_sparse = load_sparse and manifest['sparse']
+    stacked_views = None
+    if load_imgs:
+        stacked_views = load_preprocessed_array(path, manifest['arrays'][frames_array], positions, n_workers)
+        if manifest['sparse'] and not load_sparse:
+            stacked_views = stacked_views[...,0]
+    vols = None
+    volumes_name = 'volumes_sparse' if load_sparse else 'volumes'
+    if load_vols and volumes_name in manifest['arrays']:
+        vols = load_preprocessed_array(path, manifest['arrays'][volumes_name], positions, n_workers)
+    return stacked_views, vols, manifest, list(images_to_use)
+
+# Writes the frames and volumes of an XLFMDatasetFull opened with lazy=True to output_path, decoding one item at a time.
+# The volumes loaded by the dataset are stored as volumes_sparse with load_sparse (XLFM_stack_S) and as volumes without,
+# with dense_volumes the ones in XLFM_stack are also stored for a sparse dataset.
+# compression: zlib level of each chunk, 0 to store the arrays uncompressed and memory map them when loading.
+# lenslet_views: store also the lenslet views of the frames, with the lenslet_coords and subimage_shape of the dataset.
+def convert_dataset(dataset, output_path, compression=0, chunk_size=16, dense_volumes=False, lenslet_views=False):
+    os.makedirs(output_path, exist_ok=True)
+    frame_shape = list(dataset.img_shape) + ([2] if dataset.load_sparse else [])
+    writers = {'frames' : ChunkedArrayWriter(os.path.join(output_path, 'frames.bin'), frame_shape, chunk_size, compression)}
+    if lenslet_views:
+        views_shape = [dataset.n_lenslets] + list(dataset.subimage_shape) + frame_shape[2:]
+        writers['views'] = ChunkedArrayWriter(os.path.join(output_path, 'views.bin'), views_shape, chunk_size, compression)
+    volume_files = {}
+    if dataset.load_vols:
+        volume_files['volumes_sparse' if dataset.load_sparse else 'volumes'] = dataset.all_files[:dataset.n_images]
+        if dataset.load_sparse and dense_volumes:
+            all_files = sorted(glob.glob(dataset.data_path + '/XLFM_stack/*.tif'))
+            volume_files['volumes'] = [all_files[i] for i in dataset.images_to_use[:dataset.n_images]]
+    for name in volume_files:
+        writers[name] = ChunkedArrayWriter(os.path.join(output_path, name + '.bin'),
+                                            [dataset.n_depths_to_fill] + list(dataset.vol_size), chunk_size, compression)
+
+    n_channels = {name : (2 if name in ['frames','views'] and dataset.load_sparse else 1) for name in writers}
+    statistics = {name : StreamingStatistics(n_channels[name]) for name in writers}
+    volume_errors = []
+    for nImg in tqdm(range(dataset.n_images), desc='Converting dataset'):
+        items = {'frames' : dataset.decode_frame(nImg)}
+        if lenslet_views:
+            items['views'] = dataset.frames_to_views(items['frames'].unsqueeze(0))[0]
+        for name,files in volume_files.items():
+            try:
+                items[name] = dataset.decode_volume(nImg, files[nImg])
+            except Exception as e:
+                print('Dataset error: volume ' + str(nImg) + ' ' + files[nImg] + ' not loaded: ' + repr(e))
+                volume_errors.append([name, nImg, files[nImg], repr(e)])
+                items[name] = torch.zeros(writers[name].item_shape, dtype=dataset.vol_type)
+        for name,item in items.items():
+            writers[name].append(item.numpy())
+            statistics[name].update(item)
+
+    manifest = {'version' : PREPROCESSED_VERSION,
+                'source' : os.path.abspath(dataset.data_path),
+                'images_to_use' : [int(i) for i in dataset.images_to_use[:dataset.n_images]],
+                'img_shape' : list(dataset.img_shape),
+                'sparse' : dataset.load_sparse,
+                'n_depths_to_fill' : dataset.n_depths_to_fill,
+                'border_blanking' : dataset.border_blanking,
+                'lenslet_views' : {'lenslet_coords' : dataset.lenslet_coords.tolist(), 'subimage_shape' : list(dataset.subimage_shape)} if lenslet_views else None,
+                'arrays' : {name : writer.close() for name,writer in writers.items()},
+                'statistics' : {name : stat.result() for name,stat in statistics.items()},
+                'volume_errors' : volume_errors}
+    write_manifest(output_path, manifest)
+    return manifest
+
+# Statistics (see StreamingStatistics) of the arrays names of a preprocessed dataset over the stored frames images_to_use,
+# {name : StreamingStatistics.result()}, with all the channels of each array. The missing ones, of subsets of the frames or
+# from manifests without percentiles, are computed going through the array chunk by chunk and stored in the manifest.
+def preprocessed_statistics(path, images_to_use, names, n_workers=10):
+    manifest = read_manifest(path)
+    stored_images = manifest['images_to_use']
+    if list(images_to_use) == stored_images:
+        statistics = manifest['statistics']
+    else:
+        key = hashlib.sha1(json.dumps([int(i) for i in images_to_use]).encode()).hexdigest()
+        statistics = manifest.setdefault('subset_statistics', {}).setdefault(key, {})
+    missing = [name for name in names if 'percentiles' not in statistics.get(name, {})]
+    if len(missing)==0:
+        return {name : statistics[name] for name in names}
+
+    positions = [stored_images.index(i) for i in images_to_use]
+    for name in missing:
+        array = manifest['arrays'][name]
+        stats = StreamingStatistics(array['shape'][-1] if name in ['frames','views'] and manifest['sparse'] else 1)
+        chunk_size = array['chunk_size']
+        for start in tqdm(range(0, len(positions), chunk_size), desc='Dataset statistics (' + name + ')'):
+            stats.update(load_preprocessed_array(path, array, positions[start:start+chunk_size], n_workers))
+        statistics[name] = stats.result()
+    try:
+        write_manifest(path, manifest)
+    except OSError as e:
+        print('Dataset error: statistics not stored in the manifest: ' + repr(e))
+    return {name : statistics[name] for name in names}
@@ -0,0 +1,103 @@
+import math
+import torch
+from tqdm import tqdm
+
+
+# Statistics of a dataset in one pass and bounded memory, fed by update with items of any size (frames, volumes, chunks of a
+# memory mapped array), which are reduced in blocks of block_size values per channel:
+#   - count, mean and M2 (sum of squared differences to the mean) of each channel in float64, merging the ones of every
+#     block as in Welford's algorithm (Chan et al. for blocks), instead of summing squares.
+#   - min and max of each channel.
+#   - a histogram of each channel with one bin per float16 number (65536 bins), for the percentiles. They are exact for
+#     float16 data, as the frames and volumes of the datasets, and rounded to float16 for other types.
+STATISTICS_PERCENTILES = [0.1, 1, 5, 25, 50, 75, 95, 99, 99.9]
+STATISTICS_BLOCK_SIZE = 2**22
+
+# float16 numbers sorted by value, and the histogram bin of each one (its bits as int16 plus 2**15), NaNs excluded
+FLOAT16_NUMBERS = torch.arange(-2**15, 2**15, dtype=torch.int32).to(torch.int16).view(torch.float16)
+FLOAT16_SORTED, FLOAT16_ORDER = FLOAT16_NUMBERS.float().sort()
+FLOAT16_ORDER = FLOAT16_ORDER[~FLOAT16_SORTED.isnan()]
+FLOAT16_SORTED = FLOAT16_SORTED[~FLOAT16_SORTED.isnan()]
+
+class StreamingStatistics():
+    def __init__(self, n_channels=1, block_size=STATISTICS_BLOCK_SIZE):
+        self.n_channels = n_channels
+        self.block_size = block_size
+        self.count = torch.zeros(n_channels, dtype=torch.float64)
+        self.mean = torch.zeros(n_channels, dtype=torch.float64)
+        self.M2 = torch.zeros(n_channels, dtype=torch.float64)
+        self.min = torch.full([n_channels], float('inf'), dtype=torch.float64)
+        self.max = torch.full([n_channels], -float('inf'), dtype=torch.float64)
+        self.histogram = torch.zeros(n_channels, 2**16, dtype=torch.int64)
+
+    # data: [...,n_channels], or any shape with a single channel
+    def update(self, data):
+        data = torch.as_tensor(data).reshape(-1, self.n_channels)
+        for start in range(0, data.shape[0], self.block_size):
+            self.update_block(data[start:start+self.block_size])
+        return self
+
+    def update_block(self, block):
+        if block.shape[0]==0:
+            return
+        block64 = block.double()
+        n = block64.shape[0]
+        mean = block64.mean(0)
+        M2 = ((block64 - mean)**2).sum(0)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.M2 += M2 + delta**2 * self.count * n / total
+        self.count = total
+        self.min = torch.min(self.min, block64.min(0)[0])
+        self.max = torch.max(self.max, block64.max(0)[0])
+        bins = block.to(torch.float16).view(torch.int16).to(torch.int64) + 2**15
+        for nChannel in range(self.n_channels):
+            self.histogram[nChannel] += torch.bincount(bins[:,nChannel], minlength=2**16)
+
+    # Unbiased std, as torch.std
+    def std(self):
+        return (self.M2 / (self.count-1).clamp(min=1)).sqrt()
+
+    # Value of each channel [len(percentiles),n_channels] below which are percentiles% of the values, the lowest
+    # value of the histogram reaching the rank (no interpolation between values)
+    def percentiles(self, percentiles=STATISTICS_PERCENTILES):
+        cumulative = self.histogram[:,FLOAT16_ORDER].cumsum(1)
+        out = torch.zeros(len(percentiles), self.n_channels, dtype=torch.float64)
+        for nChannel in range(self.n_channels):
+            if cumulative[nChannel,-1]==0:
+                continue
+            ranks = torch.tensor([max(1, math.ceil(p * int(cumulative[nChannel,-1]) / 100)) for p in percentiles], dtype=torch.int64)
+            out[:,nChannel] = FLOAT16_SORTED[torch.searchsorted(cumulative[nChannel], ranks)].double()
+        return out
+
+    # Statistics as lists per channel, as stored in the manifest of a preprocessed dataset
+    def result(self, percentiles=STATISTICS_PERCENTILES):
+        return {'count' : self.count.tolist(), 'min' : self.min.tolist(), 'max' : self.max.tolist(), 'mean' : self.mean.tolist(),
+                'std' : self.std().tolist(), 'percentiles' : {str(p) : values for p,values in zip(percentiles, self.percentiles(percentiles).tolist())}}
+
+# Statistics of the frames and volumes of a dataset, {'imgs' : StreamingStatistics.result(), 'vols' : ...}, going once through
+# frames and volumes: iterables of items (a tensor [n_items,...] iterates over its items), n_channels of the frames.
+def dataset_statistics(frames, volumes, n_channels=1, desc='Dataset statistics'):
+    stats = {'imgs' : StreamingStatistics(n_channels), 'vols' : StreamingStatistics(1)}
+    for name,items in [('imgs',frames), ('vols',volumes)]:
+        for item in tqdm(items, desc=desc + ' (' + name + ')', total=len(items) if hasattr(items, '__len__') else None):
+            stats[name].update(item)
+    return {name : stat.result() for name,stat in stats.items()}
+
+# Statistics of result (StreamingStatistics.result()) for some of its channels
+def select_channels(result, channels):
+    return {name : ({p : [v[c] for c in channels] for p,v in values.items()} if isinstance(values, dict) else [values[c] for c in channels])
+                for name,values in result.items()}
+
+# get_max of the datasets from dataset_statistics, (max_imgs, max_imgs_sparse, max_vols), with the frame statistics as imgs_type
+# and the volume ones as vols_type. Without sparse frames max_imgs_sparse is max_imgs.
+def statistics_max(stats, imgs_type, vols_type):
+    return torch.tensor(stats['imgs']['max'][0]).to(imgs_type), torch.tensor(stats['imgs']['max'][-1]).to(imgs_type), \
+            torch.tensor(stats['vols']['max'][0]).to(vols_type)
+
+# get_statistics of the datasets from dataset_statistics, (mean_imgs, std_imgs, mean_imgs_sparse, std_imgs_sparse, mean_vols, std_vols),
+# without mean_imgs_sparse and std_imgs_sparse for frames without sparse channel
+def statistics_mean_std(stats, imgs_type, vols_type):
+    imgs_stats = [torch.tensor(stats['imgs'][name][c]).to(imgs_type) for c in range(len(stats['imgs']['mean'])) for name in ['mean','std']]
+    return tuple(imgs_stats) + (torch.tensor(stats['vols']['mean'][0]).to(vols_type), torch.tensor(stats['vols']['std'][0]).to(vols_type))
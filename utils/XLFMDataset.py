@@ -1,4 +1,5 @@
 from json import load
+import os
 import torch
 from torch.utils import data
 import torch.nn.functional as F
@@ -7,12 +8,17 @@ import glob
 from PIL import Image
 from torchvision.transforms import ToTensor
 import numpy as np
+import tifffile
 from tifffile import imread
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import multipagetiff as mtif
 
 import utils.pytorch_shot_noise as pytorch_shot_noise
 from utils.misc_utils import *
+from utils.PreprocessedDataset import is_preprocessed_dataset, read_manifest, load_preprocessed_dataset, preprocessed_statistics, is_memory_mapped
+from utils.StreamingStatistics import StreamingStatistics, dataset_statistics, select_channels, statistics_max, statistics_mean_std
 
 def get_lenslet_centers(filename):
     x,y = [], []
@@ -24,9 +30,161 @@ def get_lenslet_centers(filename):
     lenslet_coords = torch.cat((torch.IntTensor(x).unsqueeze(1),torch.IntTensor(y).unsqueeze(1)),1)
     return lenslet_coords
 
-class XLFMDatasetFull(data.Dataset):
+# Reads the volume files with read_fn and stores them with store_fn(nImg, volume) from n_workers threads.
+# A file that fails to load is reported and its volume left empty, the rest of the dataset is loaded anyway.
+# Returns the list of (nImg, filename, error) of the failed files.
+def load_volumes_parallel(files, read_fn, store_fn, n_workers=10, desc='Loading volumes'):
+    def load(nImg, filename):
+        store_fn(nImg, read_fn(filename))
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(n_workers,1)) as executor:
+        futures = {executor.submit(load, nImg, filename) : (nImg, filename) for nImg,filename in enumerate(files)}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(futures[future] + (e,))
+    for nImg,filename,e in sorted(errors, key=lambda error: error[0]):
+        print('Dataset error: volume ' + str(nImg) + ' ' + filename + ' not loaded: ' + repr(e))
+    return errors
+
+# Pages of a multi-page tiff read on demand, stack[i] returns page i as a numpy array.
+# The file is memory mapped when its pages are uncompressed and contiguous, otherwise each page is decoded when requested.
+# The file is opened again in each process (DataLoader workers) and not pickled with the dataset.
+class LazyTiffStack():
+    def __init__(self, filename):
+        self.filename = filename
+        with tifffile.TiffFile(filename) as tif:
+            self.shape = (len(tif.pages),) + tuple(tif.pages[0].shape)
+        self.tiff = None
+        self.memmap = None
+        self.pid = None
+
+    def open(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        try:
+            self.memmap = tifffile.memmap(self.filename, mode='r').reshape(self.shape)
+        except ValueError:
+            self.memmap = None
+            self.tiff = tifffile.TiffFile(self.filename)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        self.open()
+        if self.memmap is not None:
+            return self.memmap[index]
+        if isinstance(index, slice):
+            return np.stack([self.tiff.pages[i].asarray() for i in range(*index.indices(self.shape[0]))])
+        return self.tiff.pages[index].asarray()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update({'tiff' : None, 'memmap' : None, 'pid' : None})
+        return state
+
+# Preprocessing of the frames of an item, set as the transform of a dataset so that the DataLoader workers run it instead of
+# the training loop. The input frames (channel input_channel of the frames [n_frames,H,W,2] with sparse, or the frames) get
+# the dark current subtracted, clamped to zero, and with add_noise are scaled to a signal power drawn in signal_power_range
+# and get camera noise. Returns the input frames and the untouched sparse ones stacked in the last dimension, or only the input frames.
+# frame_dims: dimensions of each frame, 2 for full frames and 3 for the lenslet views of a dataset with lenslet_views.
+class FramePreprocessing():
+    def __init__(self, dark_current=0, input_channel=0, add_noise=False, signal_power_range=[32**2,32**2], frame_dims=2):
+        self.dark_current = dark_current
+        self.input_channel = input_channel
+        self.add_noise = add_noise
+        self.signal_power_range = signal_power_range
+        self.frame_dims = frame_dims
+
+    def __call__(self, views, vol):
+        has_sparse = views.ndim==self.frame_dims+2
+        frames = views[...,self.input_channel] if has_sparse else views
+        frames = F.relu(frames.half() - self.dark_current)
+        if self.add_noise:
+            curr_max = frames.float().max()
+            signal_power = (self.signal_power_range[0] + (self.signal_power_range[1]-self.signal_power_range[0]) * torch.rand(1)).item()
+            frames = pytorch_shot_noise.add_camera_noise(signal_power/curr_max * frames).float()
+        if has_sparse:
+            frames = torch.stack((frames, views[...,-1].type(frames.type())), dim=-1)
+        return frames, vol
+
+# Items of the frames and volumes of XLFMDatasetFull and XLFMDatasetVol. The uncompressed arrays of preprocessed datasets are
+# memory mapped read only (see load_preprocessed_array), so their normalization and noise are not applied in place by
+# standarize and add_random_shot_noise_to_dataset, but to each item when it is read, with decode_stats and decode_noise_range.
+class DatasetItems():
+    # Moves the frames and volumes to shared memory, so that DataLoader workers use them without copies, also with persistent
+    # workers or the spawn start method. The memory mapped ones are file backed and the workers share them through the page
+    # cache, lazy datasets only hold their memory mapped tiffs.
+    def share_memory(self):
+        for tensor in [self.stacked_views, self.vols]:
+            if torch.is_tensor(tensor) and not is_memory_mapped(tensor):
+                tensor.share_memory_()
+        return self
+
+    # Frames self.stacked_views[indices], indices being a list
+    def read_frames(self, indices):
+        frames = self.stacked_views[indices,...]
+        if not is_memory_mapped(self.stacked_views):
+            return frames
+        if self.decode_noise_range is not None:
+            frames = torch.stack([self.add_shot_noise_to_frame(frame, self.decode_noise_range) for frame in frames])
+        if self.decode_stats is not None:
+            frames = self.standarize_frames(frames, self.decode_stats)
+            if getattr(self, 'lenslet_views', False):
+                # Views of a standarized frame, zero outside of it
+                frames = frames * (self.views_mask.unsqueeze(-1) if self.load_sparse else self.views_mask)
+        return frames
+
+    # Volumes self.vols[indices]
+    def read_volumes(self, indices):
+        vols = self.vols[indices,...]
+        if not is_memory_mapped(self.vols):
+            return vols
+        if self.decode_stats is not None:
+            return (vols-self.decode_stats[4]) / self.decode_stats[5]
+        return vols.clone()
+
+    # Frames and volumes to go through for their statistics, one item at a time
+    def frame_items(self):
+        if is_memory_mapped(self.stacked_views):
+            return (self.read_frames([nImg])[0] for nImg in range(self.stacked_views.shape[0]))
+        return self.stacked_views
+
+    def volume_items(self):
+        if is_memory_mapped(self.vols):
+            return (self.read_volumes([nImg])[0] for nImg in range(self.vols.shape[0]))
+        return self.vols
+
+    # Frames standarized with the statistics of get_statistics, out of place
+    def standarize_frames(self, frames, stats):
+        mean_imgs, std_imgs, mean_imgs_s, std_imgs_s = stats[:4]
+        if self.load_sparse:
+            return torch.stack(((frames[...,0]-mean_imgs) / std_imgs, (frames[...,1]-mean_imgs_s) / std_imgs_s), dim=-1)
+        return (frames-mean_imgs) / std_imgs
+
+    @staticmethod
+    def add_shot_noise_to_frame(frame, signal_power_range):
+        signal_power = (signal_power_range[0] + (signal_power_range[1]-signal_power_range[0]) * torch.rand(1)).item()
+        
+        curr_img_stack = frame.float()
+        curr_max = curr_img_stack.max()
+        curr_img_stack = signal_power * curr_img_stack / curr_max
+            
+        for kk in range(curr_img_stack.shape[0]):
+            curr_img_stack[kk,...] = pytorch_shot_noise.add_camera_noise(curr_img_stack[kk,...])
+        curr_img_stack = curr_max * curr_img_stack.float() / signal_power
+        return curr_img_stack.type(frame.type())
+
+class XLFMDatasetFull(data.Dataset, DatasetItems):
+    # lazy: instead of loading the whole dataset in memory, the image stacks and volumes are memory mapped (see LazyTiffStack)
+    #       and each frame and volume is decoded when __getitem__ needs it, keeping the last cache_size decoded items.
+    # lenslet_views: the frames are stored as their lenslet views [n_images,n_lenslets,subimage_shape[0],subimage_shape[1]] (see
+    #       to_lenslet_views), extracted once when loading, and __getitem__ returns the views of each frame instead of the frame.
     def __init__(self, data_path, lenslet_coords_path, subimage_shape, img_shape, images_to_use=None, lenslets_offset=50, n_depths_to_fill=120, border_blanking=10,
-     load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10):
+     load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10, lazy=False, cache_size=64, lenslet_views=False):
         # Load lenslets coordinates
         self.lenslet_coords = get_lenslet_centers(lenslet_coords_path) + torch.tensor(lenslets_offset)
         self.n_lenslets = self.lenslet_coords.shape[0]
@@ -36,10 +194,32 @@ class XLFMDatasetFull(data.Dataset):
         self.temporal_shifts = temporal_shifts
         self.use_random_shifts = use_random_shifts
         self.vol_type = torch.float16
+        # Applied to (frames, volume) of each item in __getitem__, see FramePreprocessing
+        self.transform = None
+        self.n_depths_to_fill = n_depths_to_fill
+        self.border_blanking = border_blanking
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # Normalization and noise applied when decoding, in lazy mode, or reading memory mapped items, see DatasetItems
+        self.decode_stats = None
+        self.decode_noise_range = None
 
         self.img_shape = img_shape
         self.subimage_shape = subimage_shape
         self.half_subimg_shape = [self.subimage_shape[0]//2,self.subimage_shape[1]//2]
+        self.lenslet_views = lenslet_views
+        # Statistics of the frames and volumes, see get_dataset_statistics
+        self.statistics = None
+        self.use_manifest_statistics = False
+        if lenslet_views:
+            # Positions of the views inside the frame, the rest is always zero
+            self.views_mask = self.extract_views(torch.ones(1,1,img_shape[0],img_shape[1]), self.lenslet_coords, subimage_shape)[0,0] > 0
+
+        # Preprocessed dataset, stored as the tensors below
+        if is_preprocessed_dataset(data_path):
+            self.load_preprocessed(images_to_use, maxWorkers)
+            return
 
         # Tiff images are stored in single tiff stack
         # Volumes are stored in individual tiff stacks
@@ -48,12 +228,18 @@ class XLFMDatasetFull(data.Dataset):
         vols_path = data_path + '/XLFM_stack/*.tif'
 
         # dataset = Image.open(imgs_path)
-        self.img_dataset = imread(imgs_path, maxworkers=maxWorkers)
+        if lazy:
+            self.img_dataset = LazyTiffStack(imgs_path)
+        else:
+            self.img_dataset = imread(imgs_path, maxworkers=maxWorkers)
         n_frames,h,w = np.shape(self.img_dataset)
 
         if self.load_sparse:
             try:
-                self.img_dataset_sparse = imread(imgs_path_sparse, maxworkers=maxWorkers)
+                if lazy:
+                    self.img_dataset_sparse = LazyTiffStack(imgs_path_sparse)
+                else:
+                    self.img_dataset_sparse = imread(imgs_path_sparse, maxworkers=maxWorkers)
             except:
                 self.load_sparse = False
                 print('Dataset error: Sparse dir XLFM_image/XLFM_image_stack_S.tif not found')
@@ -61,6 +247,7 @@ class XLFMDatasetFull(data.Dataset):
         if images_to_use is None:
             images_to_use = list(range(n_frames))
         self.n_images = min(len(images_to_use), n_frames)
+        self.images_to_use = images_to_use
 
         self.all_files = sorted(glob.glob(vols_path))
         if len(self.all_files)>0 and load_vols:
@@ -72,18 +259,31 @@ class XLFMDatasetFull(data.Dataset):
             if self.load_sparse:
                 self.all_files= [sorted(glob.glob(vols_path_sparse))[images_to_use[i]] for i in range(self.n_images)]
             # read single volume
-            currVol = self.read_tiff_stack(self.all_files[0])
-            odd_size = [currVol.shape[0], currVol.shape[1]]
+            if lazy:
+                vol_shape = LazyTiffStack(self.all_files[0]).shape
+                odd_size = [vol_shape[1], vol_shape[2]]
+            else:
+                currVol = self.read_tiff_stack(self.all_files[0])
+                odd_size = [currVol.shape[0], currVol.shape[1]]
             # odd_size = [int(n - (1 if (n%2 == 0) else 0)) for n in odd_size]
             # currVol = currVol[0:odd_size[0],0:odd_size[1]]
             half_volume_shape = [odd_size[0]//2,odd_size[1]//2]
-            self.volStart = [currVol.shape[0]//2-half_volume_shape[0], currVol.shape[1]//2-half_volume_shape[1]]
+            self.volStart = [odd_size[0]//2-half_volume_shape[0], odd_size[1]//2-half_volume_shape[1]]
             self.volEnd = [odd_size[n] + self.volStart[n] for n in range(len(self.volStart))]
-            self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=self.vol_type)
+            self.vol_size = odd_size
+            if lazy:
+                self.vols = None
+            else:
+                self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=self.vol_type)
             
         else:
             odd_size = self.subimage_shape
             self.vols = 255*torch.ones(1)
+
+        if lazy:
+            self.stacked_views = None
+            print('Opened ' + str(self.n_images) + ' lazily')
+            return
         
         # Create image storage
         self.stacked_views = torch.zeros(self.n_images, self.img_shape[0], self.img_shape[1],dtype=torch.float16)
@@ -91,40 +291,172 @@ class XLFMDatasetFull(data.Dataset):
         if self.load_sparse:
             stacked_views_sparse = self.stacked_views.clone()
 
+        self.volume_errors = []
+        if load_vols:
+            self.volume_errors = load_volumes_parallel(self.all_files[:self.n_images], self.read_tiff_stack,
+                                                        lambda nImg,currVol: self.prepare_volume(currVol, out=self.vols[nImg]), maxWorkers)
+
         for nImg in range(self.n_images):
 
             # Load the images indicated from the user
             curr_img = images_to_use[nImg]
-
-            if load_vols:
-                currVol = self.read_tiff_stack(self.all_files[curr_img])
-                assert not torch.isinf(currVol).any()
-                if border_blanking>0:
-                    currVol[:border_blanking,...] = 0
-                    currVol[-border_blanking:,...] = 0
-                    currVol[:,:border_blanking,...] = 0
-                    currVol[:,-border_blanking:,...] = 0
-                    currVol[:,:,:border_blanking] = 0
-                    currVol[:,:,-border_blanking:] = 0
-                self.vols[nImg,:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
-                    [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
-
             
             image = torch.from_numpy(np.array(self.img_dataset[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-
-            image = self.pad_img_to_min(image)
-            self.stacked_views[nImg,...] = center_crop(image.unsqueeze(0).unsqueeze(0), self.img_shape)[0,0,...]
+            self.stacked_views[nImg,...] = self.prepare_image(image)
             
             if self.load_sparse:
                 image = torch.from_numpy(np.array(self.img_dataset_sparse[curr_img,:,:]).astype(np.float16)).type(torch.float16)
-                image = self.pad_img_to_min(image)
-                stacked_views_sparse[nImg,...] = image
+                stacked_views_sparse[nImg,...] = self.prepare_image(image, crop=False)
 
         if self.load_sparse:
             self.stacked_views = torch.cat((self.stacked_views.unsqueeze(-1), stacked_views_sparse.unsqueeze(-1)), dim=3)
+        if lenslet_views:
+            self.to_lenslet_views()
 
         print('Loaded ' + str(self.n_images))  
 
+    # Frames and volumes from a preprocessed dataset (see mainConvertDataset.py), memory mapped as stored without any conversion.
+    # lazy is not needed, the uncompressed arrays are only read when used.
+    # With lenslet_views the stored views are used when they have the same lenslet layout, otherwise they are extracted from the frames.
+    def load_preprocessed(self, images_to_use, n_workers, load_imgs=True):
+        manifest = read_manifest(self.data_path)
+        assert list(self.img_shape) == manifest['img_shape'], 'The preprocessed dataset has frames of ' + str(manifest['img_shape'])
+        if self.load_sparse and not manifest['sparse']:
+            self.load_sparse = False
+            print('Dataset error: the preprocessed dataset has no sparse frames')
+        stored_views = manifest.get('lenslet_views', None)
+        use_stored_views = load_imgs and self.lenslet_views and stored_views is not None and \
+                    stored_views['lenslet_coords']==self.lenslet_coords.tolist() and stored_views['subimage_shape']==list(self.subimage_shape)
+        if self.lenslet_views and load_imgs and not use_stored_views:
+            print('Dataset: the preprocessed dataset has no lenslet views of this layout, extracting them from the frames')
+        self.stacked_views, vols, self.manifest, self.images_to_use = load_preprocessed_dataset(self.data_path, images_to_use,
+                                                                        load_imgs, self.load_sparse, self.load_vols, n_workers,
+                                                                        frames_array='views' if use_stored_views else 'frames')
+        if self.load_vols and vols is None:
+            self.load_vols = False
+            print('Dataset error: the preprocessed dataset has no ' + ('sparse ' if self.load_sparse else '') + 'volumes, see --dense_vols of mainConvertDataset.py')
+        if self.stacked_views is None:
+            self.stacked_views = torch.ones([1])
+        self.n_images = len(self.images_to_use)
+        self.n_depths_to_fill = self.manifest['n_depths_to_fill']
+        self.volume_errors = self.manifest['volume_errors']
+        self.all_files = []
+        self.lazy = False
+        if self.load_vols:
+            self.vols = vols
+            self.vol_size = list(vols.shape[-2:])
+        else:
+            self.vols = 255*torch.ones(1)
+        self.use_manifest_statistics = True
+        if self.lenslet_views and load_imgs and not use_stored_views:
+            self.to_lenslet_views()
+        print('Loaded ' + str(self.n_images) + ' preprocessed')
+
+    # Lenslet views of frames [N,H,W] or [N,H,W,2] with the sparse frames, as [N,n_lenslets,subimage_shape[0],subimage_shape[1]]
+    # or [N,n_lenslets,subimage_shape[0],subimage_shape[1],2], extracting chunk_size frames at a time
+    def frames_to_views(self, frames, chunk_size=16):
+        has_channels = frames.ndim==4
+        n_channels = frames.shape[-1] if has_channels else 1
+        views = torch.zeros([frames.shape[0], self.n_lenslets] + list(self.subimage_shape) + ([n_channels] if has_channels else []), dtype=frames.dtype)
+        for nStart in range(0, frames.shape[0], chunk_size):
+            chunk = frames[nStart:nStart+chunk_size]
+            chunk = chunk.permute(0,3,1,2) if has_channels else chunk.unsqueeze(1)
+            chunk_views = self.extract_views(chunk, self.lenslet_coords, self.subimage_shape)
+            views[nStart:nStart+chunk_size] = chunk_views.permute(0,2,3,4,1) if has_channels else chunk_views[:,0]
+        return views
+
+    # Replaces the frames in self.stacked_views with their lenslet views, keeping their statistics for normalization
+    def to_lenslet_views(self):
+        self.get_dataset_statistics()
+        self.stacked_views = self.frames_to_views(self.stacked_views)
+
+    # Volume read by read_tiff_stack [H,W,nDepths] to the [n_depths_to_fill,H,W] stored in self.vols, written into out when given
+    def prepare_volume(self, currVol, out=None):
+        assert not torch.isinf(currVol).any()
+        border_blanking = self.border_blanking
+        if border_blanking>0:
+            currVol[:border_blanking,...] = 0
+            currVol[-border_blanking:,...] = 0
+            currVol[:,:border_blanking,...] = 0
+            currVol[:,-border_blanking:,...] = 0
+            currVol[:,:,:border_blanking] = 0
+            currVol[:,:,-border_blanking:] = 0
+        vol = out if out is not None else torch.zeros(self.n_depths_to_fill, self.vol_size[0], self.vol_size[1], dtype=self.vol_type)
+        vol[:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
+            [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
+        return vol
+
+    # Raw frame to the frame stored in self.stacked_views, the sparse frames are only padded
+    def prepare_image(self, image, crop=True):
+        image = self.pad_img_to_min(image)
+        if crop:
+            image = center_crop(image.unsqueeze(0).unsqueeze(0), self.img_shape)[0,0,...]
+        return image
+
+    # Decoded item from the LRU cache, decoding it with decode_fn when missing
+    def get_cached(self, key, decode_fn):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        item = decode_fn()
+        if self.cache_size>0:
+            self.cache[key] = item
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return item
+
+    # Frame nImg as stored in self.stacked_views, in lazy mode
+    def decode_frame(self, nImg):
+        curr_img = self.images_to_use[nImg]
+        image = self.prepare_image(torch.from_numpy(np.asarray(self.img_dataset[curr_img]).astype(np.float16)))
+        if self.load_sparse:
+            image_sparse = self.prepare_image(torch.from_numpy(np.asarray(self.img_dataset_sparse[curr_img]).astype(np.float16)), crop=False)
+            image = torch.cat((image.unsqueeze(-1), image_sparse.unsqueeze(-1)), dim=2)
+        if self.decode_noise_range is not None:
+            image = self.add_shot_noise_to_frame(image, self.decode_noise_range)
+        if self.decode_stats is not None:
+            image = self.standarize_frames(image, self.decode_stats)
+        return image
+
+    # Volume nImg as stored in self.vols, in lazy mode, or the volume in filename with the same processing
+    def decode_volume(self, nImg, filename=None):
+        stack = LazyTiffStack(filename if filename is not None else self.all_files[nImg])
+        currVol = torch.from_numpy(np.nan_to_num(np.asarray(stack[:])).astype(np.float16)).permute(1,2,0)
+        vol = self.prepare_volume(currVol)
+        if self.decode_stats is not None:
+            vol = (vol-self.decode_stats[4]) / self.decode_stats[5]
+        return vol
+
+    def get_frame(self, nImg):
+        if self.lenslet_views:
+            return self.get_cached(('frame',nImg), lambda: self.frames_to_views(self.decode_frame(nImg).unsqueeze(0))[0])
+        return self.get_cached(('frame',nImg), lambda: self.decode_frame(nImg))
+
+    def get_volume(self, nImg):
+        return self.get_cached(('volume',nImg), lambda: self.decode_volume(nImg))
+
+    # Statistics of the frames (a channel for the frames and one for the sparse ones) and volumes, see StreamingStatistics,
+    # computed going once through the dataset, decoding the items in lazy mode, and kept until the frames or volumes change.
+    # The ones of preprocessed datasets are read from their manifest. With lenslet_views they are the statistics of the frames.
+    def get_dataset_statistics(self):
+        if self.statistics is not None and self.statistics['decode_stats'] is self.decode_stats:
+            return self.statistics
+        n_channels = 2 if self.load_sparse else 1
+        if self.use_manifest_statistics:
+            volumes_name = 'volumes_sparse' if self.load_sparse else 'volumes'
+            stored = preprocessed_statistics(self.data_path, self.images_to_use, ['frames'] + ([volumes_name] if self.load_vols else []))
+            stats = {'imgs' : select_channels(stored['frames'], range(n_channels)),
+                     'vols' : stored[volumes_name] if self.load_vols else StreamingStatistics().update(self.vols).result()}
+        elif self.lazy:
+            frames = map(self.decode_frame, range(self.n_images))
+            volumes = map(self.decode_volume, range(self.n_images)) if self.load_vols else [255*torch.ones(1)]
+            stats = dataset_statistics(frames, volumes, n_channels)
+        else:
+            stats = dataset_statistics(self.frame_items(), self.volume_items(), n_channels)
+        stats['decode_stats'] = self.decode_stats
+        self.statistics = stats
+        return stats
+
     def __len__(self):
         'Denotes the total number of samples'
         if self.use_random_shifts:
@@ -132,40 +464,46 @@ class XLFMDatasetFull(data.Dataset):
         return self.n_images-np.max(self.temporal_shifts)
 
     def get_n_depths(self):
+        if self.lazy and self.load_vols:
+            return self.n_depths_to_fill
         return self.vols.shape[1]
     
     def get_n_temporal_frames(self):
         return len(self.temporal_shifts)
 
+    # Types of the frame and volume statistics returned by get_max and get_statistics
+    def statistics_types(self):
+        return [t.dtype if torch.is_tensor(t) else self.vol_type for t in [self.stacked_views, self.vols]]
+
     def get_max(self):
         'Get max intensity from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().max().type(self.stacked_views.type()),\
-                    self.stacked_views[...,1].float().max().type(self.stacked_views.type()),\
-                    self.vols.float().max().type(self.vols.type())
-        else:
-            return self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.vols.float().max().type(self.vols.type())
+        return statistics_max(self.get_dataset_statistics(), *self.statistics_types())
 
     def get_statistics(self):
         'Get mean and standard deviation from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().mean().type(self.stacked_views.type()), self.stacked_views[...,0].float().std().type(self.stacked_views.type()), \
-                    self.stacked_views[...,1].float().mean().type(self.stacked_views.type()), self.stacked_views[...,1].float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-        else:
-            return  self.stacked_views.float().mean().type(self.stacked_views.type()), self.stacked_views.float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
+        return statistics_mean_std(self.get_dataset_statistics(), *self.statistics_types())
 
     def standarize(self, stats=None):
         mean_imgs, std_imgs, mean_imgs_s, std_imgs_s, mean_vols, std_vols = stats
-        if self.load_sparse:
-            self.stacked_views[...,0] = (self.stacked_views[...,0]-mean_imgs) / std_imgs
-            self.stacked_views[...,1] = (self.stacked_views[...,1]-mean_imgs_s) / std_imgs_s
-        else:
-            self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
-        self.vols = (self.vols-mean_vols) / std_vols
+        if self.lazy:
+            self.decode_stats = stats
+            self.cache.clear()
+            return
+        if is_memory_mapped(self.stacked_views) or is_memory_mapped(self.vols):
+            self.decode_stats = stats
+        if not is_memory_mapped(self.stacked_views):
+            if self.load_sparse:
+                self.stacked_views[...,0] = (self.stacked_views[...,0]-mean_imgs) / std_imgs
+                self.stacked_views[...,1] = (self.stacked_views[...,1]-mean_imgs_s) / std_imgs_s
+            else:
+                self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
+            if self.lenslet_views:
+                # Views of a standarized frame, zero outside of it
+                self.stacked_views *= (self.views_mask.unsqueeze(-1) if self.load_sparse else self.views_mask)
+        if not is_memory_mapped(self.vols):
+            self.vols = (self.vols-mean_vols) / std_vols
+        self.statistics = None
+        self.use_manifest_statistics = False
 
     def len_lenslets(self):
         'Denotes the total number of lenslets'
@@ -196,10 +534,18 @@ class XLFMDatasetFull(data.Dataset):
 
         indices = [img_index + temporal_shifts_ixs[i] for i in range(n_frames)]
         
-        views_out = self.stacked_views[indices,...]
+        if self.lazy:
+            views_out = torch.stack([self.get_frame(i) for i in indices])
+        else:
+            views_out = self.read_frames(indices)
         if self.load_vols is False:
-            return views_out,0
-        vol_out = self.vols[index,...]
+            vol_out = 0
+        elif self.lazy:
+            vol_out = self.get_volume(index)
+        else:
+            vol_out = self.read_volumes(index)
+        if self.transform is not None:
+            views_out,vol_out = self.transform(views_out, vol_out)
         
         return views_out,vol_out
 
@@ -209,27 +555,17 @@ class XLFMDatasetFull(data.Dataset):
         
         return vol[index]
 
+    # Patches of subimage_shape around each lenslet, [B,C,n_lenslets,subimage_shape[0],subimage_shape[1]]. The patches
+    # clipped by the image border are aligned to the bottom right of the view. On the GPU all the lenslets are gathered at once, see gather_lenslet_views.
     @staticmethod
     def extract_views(image, lenslet_coords, subimage_shape, debug=False):
-        half_subimg_shape = [subimage_shape[0]//2,subimage_shape[1]//2]
-        n_lenslets = lenslet_coords.shape[0]
-        stacked_views = torch.zeros(size=[image.shape[0], image.shape[1], n_lenslets, subimage_shape[0], subimage_shape[1]], device=image.device, dtype=image.dtype)
+        stacked_views = gather_lenslet_views(image, lenslet_coords, subimage_shape)
         
         if debug:
             debug_image = image.detach().clone()
             max_img = image.float().cpu().max()
-        for nLens in range(n_lenslets):
-            # Fetch coordinates
-            currCoords = lenslet_coords[nLens,:]
-            if debug:
+            for currCoords in lenslet_coords:
                 debug_image[:,:,currCoords[0]-2:currCoords[0]+2,currCoords[1]-2:currCoords[1]+2] = max_img
-            # Grab patches
-            lower_bounds = [currCoords[0]-half_subimg_shape[0], currCoords[1]-half_subimg_shape[1]]
-            lower_bounds = [max(lower_bounds[kk],0) for kk in range(2)]
-            currPatch = image[:,:,lower_bounds[0] : currCoords[0]+half_subimg_shape[0], lower_bounds[1] : currCoords[1]+half_subimg_shape[1]]
-            stacked_views[:,:,nLens,-currPatch.shape[2]:,-currPatch.shape[3]:] = currPatch
-        
-        if debug:
             import matplotlib.pyplot as plt
             plt.imshow(debug_image[0,0,...].float().cpu().detach().numpy())
             plt.show()
@@ -242,29 +578,28 @@ class XLFMDatasetFull(data.Dataset):
         except:
             max_val = np.finfo(out_datatype).max
 
-        dataset = Image.open(filename)
-        h,w = np.shape(dataset)
-        tiffarray = np.zeros([h,w,dataset.n_frames], dtype=out_datatype)
-        for i in range(dataset.n_frames):
-            dataset.seek(i)
-            img =  np.array(dataset)
-            img = np.nan_to_num(img)
-            # img[img>=max_val/2] = max_val/2
-            tiffarray[:,:,i] = img.astype(out_datatype)
-        return torch.from_numpy(tiffarray)
+        # All the pages decoded at once, instead of seeking them one by one
+        tiffarray = imread(filename, maxworkers=1)
+        if tiffarray.ndim==2:
+            tiffarray = tiffarray[np.newaxis]
+        tiffarray = np.nan_to_num(tiffarray, copy=False)
+        # img[img>=max_val/2] = max_val/2
+        return torch.from_numpy(np.ascontiguousarray(tiffarray.astype(out_datatype).transpose(1,2,0)))
 
+    # In lazy mode the noise is added when a frame is decoded, so a frame decoded again after leaving the cache gets a new noise,
+    # the same for memory mapped frames each time they are read
     def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2]):
+        if self.lazy or is_memory_mapped(self.stacked_views):
+            self.decode_noise_range = signal_power_range
+            self.cache.clear()
+            self.statistics = None
+            self.use_manifest_statistics = False
+            print("Adding noise to " + str(self.n_images) + " images when decoded.")
+            return
         for nImg in range(self.stacked_views.shape[0]):
-            signal_power = (signal_power_range[0] + (signal_power_range[1]-signal_power_range[0]) * torch.rand(1)).item()
-            
-            curr_img_stack = self.stacked_views[nImg,...].float()
-            curr_max = curr_img_stack.max()
-            curr_img_stack = signal_power * curr_img_stack / curr_max
-                
-            for kk in range(curr_img_stack.shape[0]):
-                curr_img_stack[kk,...] = pytorch_shot_noise.add_camera_noise(curr_img_stack[kk,...])
-            curr_img_stack = curr_max * curr_img_stack.float() / signal_power
-            self.stacked_views[nImg,...] = curr_img_stack
+            self.stacked_views[nImg,...] = self.add_shot_noise_to_frame(self.stacked_views[nImg,...], signal_power_range)
+        self.statistics = None
+        self.use_manifest_statistics = False
         print("Added noise to " + str(self.stacked_views.shape[0]) + " images.")
 
 
@@ -284,6 +619,10 @@ class XLFMDatasetFullRegistration(data.Dataset):
         self.temporal_shifts = temporal_shifts
         self.use_random_shifts = use_random_shifts
         self.vol_type = torch.float16
+        self.n_depths_to_fill = n_depths_to_fill
+        self.border_blanking = border_blanking
+        # Statistics of the frames and volumes, see get_dataset_statistics
+        self.statistics = None
 
         self.img_shape = img_shape
         self.subimage_shape = subimage_shape
@@ -327,6 +666,7 @@ class XLFMDatasetFullRegistration(data.Dataset):
             half_volume_shape = [odd_size[0]//2,odd_size[1]//2]
             self.volStart = [currVol.shape[0]//2-half_volume_shape[0], currVol.shape[1]//2-half_volume_shape[1]]
             self.volEnd = [odd_size[n] + self.volStart[n] for n in range(len(self.volStart))]
+            self.vol_size = odd_size
             self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=self.vol_type)
             
         else:
@@ -339,23 +679,16 @@ class XLFMDatasetFullRegistration(data.Dataset):
         if self.load_sparse:
             stacked_views_sparse = self.stacked_views.clone()
 
+        self.volume_errors = []
+        if load_vols:
+            self.volume_errors = load_volumes_parallel(self.all_files[:self.n_images], self.read_tiff_stack,
+                                                        lambda nImg,currVol: self.prepare_volume(currVol, out=self.vols[nImg]), maxWorkers)
+
         for nImg in range(self.n_images):
 
             # Load the images indicated from the user
             curr_img = images_to_use[nImg]
 
-            if load_vols:
-                currVol = self.read_tiff_stack(self.all_files[curr_img])
-                assert not torch.isinf(currVol).any()
-                if border_blanking>0:
-                    currVol[:border_blanking,...] = 0
-                    currVol[-border_blanking:,...] = 0
-                    currVol[:,:border_blanking,...] = 0
-                    currVol[:,-border_blanking:,...] = 0
-                    currVol[:,:,:border_blanking] = 0
-                    currVol[:,:,-border_blanking:] = 0
-                self.vols[nImg,:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
-                    [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
 
             
             image = torch.from_numpy(np.array(self.img_dataset[curr_img,:,:]).astype(np.float16)).type(torch.float16)
@@ -373,6 +706,21 @@ class XLFMDatasetFullRegistration(data.Dataset):
 
         print('Loaded ' + str(self.n_images))  
 
+    # Volume read by read_tiff_stack [H,W,nDepths] to the [n_depths_to_fill,H,W] stored in self.vols, written into out
+    def prepare_volume(self, currVol, out):
+        assert not torch.isinf(currVol).any()
+        border_blanking = self.border_blanking
+        if border_blanking>0:
+            currVol[:border_blanking,...] = 0
+            currVol[-border_blanking:,...] = 0
+            currVol[:,:border_blanking,...] = 0
+            currVol[:,-border_blanking:,...] = 0
+            currVol[:,:,:border_blanking] = 0
+            currVol[:,:,-border_blanking:] = 0
+        out[:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
+            [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
+        return out
+
     def __len__(self):
         'Denotes the total number of samples'
         if self.use_random_shifts:
@@ -385,26 +733,24 @@ class XLFMDatasetFullRegistration(data.Dataset):
     def get_n_temporal_frames(self):
         return len(self.temporal_shifts)
 
+    # Statistics of the frames (a channel for the frames and one for the sparse ones) and volumes, see StreamingStatistics,
+    # computed going once through the dataset and kept until the frames or volumes change
+    def get_dataset_statistics(self):
+        if self.statistics is None:
+            self.statistics = dataset_statistics(self.stacked_views, self.vols, 2 if self.load_sparse else 1)
+        return self.statistics
+
+    # Types of the frame and volume statistics returned by get_max and get_statistics
+    def statistics_types(self):
+        return [t.dtype if torch.is_tensor(t) else self.vol_type for t in [self.stacked_views, self.vols]]
+
     def get_max(self):
         'Get max intensity from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().max().type(self.stacked_views.type()),\
-                    self.stacked_views[...,1].float().max().type(self.stacked_views.type()),\
-                    self.vols.float().max().type(self.vols.type())
-        else:
-            return self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.vols.float().max().type(self.vols.type())
+        return statistics_max(self.get_dataset_statistics(), *self.statistics_types())
 
     def get_statistics(self):
         'Get mean and standard deviation from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().mean().type(self.stacked_views.type()), self.stacked_views[...,0].float().std().type(self.stacked_views.type()), \
-                    self.stacked_views[...,1].float().mean().type(self.stacked_views.type()), self.stacked_views[...,1].float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-        else:
-            return  self.stacked_views.float().mean().type(self.stacked_views.type()), self.stacked_views.float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
+        return statistics_mean_std(self.get_dataset_statistics(), *self.statistics_types())
 
     def standarize(self, stats=None):
         mean_imgs, std_imgs, mean_imgs_s, std_imgs_s, mean_vols, std_vols = stats
@@ -414,6 +760,7 @@ class XLFMDatasetFullRegistration(data.Dataset):
         else:
             self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
         self.vols = (self.vols-mean_vols) / std_vols
+        self.statistics = None
 
     def len_lenslets(self):
         'Denotes the total number of lenslets'
@@ -458,27 +805,17 @@ class XLFMDatasetFullRegistration(data.Dataset):
         
         return vol[index]
 
+    # Patches of subimage_shape around each lenslet, [B,C,n_lenslets,subimage_shape[0],subimage_shape[1]]. The patches
+    # clipped by the image border are aligned to the bottom right of the view. On the GPU all the lenslets are gathered at once, see gather_lenslet_views.
     @staticmethod
     def extract_views(image, lenslet_coords, subimage_shape, debug=False):
-        half_subimg_shape = [subimage_shape[0]//2,subimage_shape[1]//2]
-        n_lenslets = lenslet_coords.shape[0]
-        stacked_views = torch.zeros(size=[image.shape[0], image.shape[1], n_lenslets, subimage_shape[0], subimage_shape[1]], device=image.device, dtype=image.dtype)
+        stacked_views = gather_lenslet_views(image, lenslet_coords, subimage_shape)
         
         if debug:
             debug_image = image.detach().clone()
             max_img = image.float().cpu().max()
-        for nLens in range(n_lenslets):
-            # Fetch coordinates
-            currCoords = lenslet_coords[nLens,:]
-            if debug:
+            for currCoords in lenslet_coords:
                 debug_image[:,:,currCoords[0]-2:currCoords[0]+2,currCoords[1]-2:currCoords[1]+2] = max_img
-            # Grab patches
-            lower_bounds = [currCoords[0]-half_subimg_shape[0], currCoords[1]-half_subimg_shape[1]]
-            lower_bounds = [max(lower_bounds[kk],0) for kk in range(2)]
-            currPatch = image[:,:,lower_bounds[0] : currCoords[0]+half_subimg_shape[0], lower_bounds[1] : currCoords[1]+half_subimg_shape[1]]
-            stacked_views[:,:,nLens,-currPatch.shape[2]:,-currPatch.shape[3]:] = currPatch
-        
-        if debug:
             import matplotlib.pyplot as plt
             plt.imshow(debug_image[0,0,...].float().cpu().detach().numpy())
             plt.show()
@@ -491,16 +828,13 @@ class XLFMDatasetFullRegistration(data.Dataset):
         except:
             max_val = np.finfo(out_datatype).max
 
-        dataset = Image.open(filename)
-        h,w = np.shape(dataset)
-        tiffarray = np.zeros([h,w,dataset.n_frames], dtype=out_datatype)
-        for i in range(dataset.n_frames):
-            dataset.seek(i)
-            img =  np.array(dataset)
-            img = np.nan_to_num(img)
-            # img[img>=max_val/2] = max_val/2
-            tiffarray[:,:,i] = img.astype(out_datatype)
-        return torch.from_numpy(tiffarray)
+        # All the pages decoded at once, instead of seeking them one by one
+        tiffarray = imread(filename, maxworkers=1)
+        if tiffarray.ndim==2:
+            tiffarray = tiffarray[np.newaxis]
+        tiffarray = np.nan_to_num(tiffarray, copy=False)
+        # img[img>=max_val/2] = max_val/2
+        return torch.from_numpy(np.ascontiguousarray(tiffarray.astype(out_datatype).transpose(1,2,0)))
 
     def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2]):
         for nImg in range(self.stacked_views.shape[0]):
@@ -514,12 +848,13 @@ class XLFMDatasetFullRegistration(data.Dataset):
                 curr_img_stack[kk,...] = pytorch_shot_noise.add_camera_noise(curr_img_stack[kk,...])
             curr_img_stack = curr_max * curr_img_stack.float() / signal_power
             self.stacked_views[nImg,...] = curr_img_stack
+        self.statistics = None
         print("Added noise to " + str(self.stacked_views.shape[0]) + " images.")
 
 
 
 
-class XLFMDatasetVol(data.Dataset):
+class XLFMDatasetVol(data.Dataset, DatasetItems):
     def __init__(self, data_path, lenslet_coords_path, subimage_shape, img_shape, images_to_use=None, lenslets_offset=50, n_depths_to_fill=120, border_blanking=10,
      load_imgs=False, load_vols=True, load_sparse=False, temporal_shifts=[0,1,2], use_random_shifts=False, maxWorkers=10):
         # Load lenslets coordinates
@@ -532,11 +867,26 @@ class XLFMDatasetVol(data.Dataset):
         self.temporal_shifts = temporal_shifts
         self.use_random_shifts = use_random_shifts
         self.vol_type = torch.float16
+        # Applied to (frames, volume) of each item in __getitem__, see FramePreprocessing
+        self.transform = None
+        self.n_depths_to_fill = n_depths_to_fill
+        self.border_blanking = border_blanking
+        # Normalization and noise applied when reading memory mapped items, see DatasetItems
+        self.decode_stats = None
+        self.decode_noise_range = None
+        # Statistics of the frames and volumes, see get_dataset_statistics
+        self.statistics = None
+        self.use_manifest_statistics = False
 
         self.img_shape = img_shape
         self.subimage_shape = subimage_shape
         self.half_subimg_shape = [self.subimage_shape[0]//2,self.subimage_shape[1]//2]
 
+        # Preprocessed dataset, stored as the tensors below
+        if is_preprocessed_dataset(data_path):
+            self.load_preprocessed(images_to_use, maxWorkers, load_imgs)
+            return
+
         # Tiff images are stored in single tiff stack
         # Volumes are stored in individual tiff stacks
         imgs_path = data_path + '/XLFM_image/XLFM_image_stack.tif'
@@ -579,6 +929,7 @@ class XLFMDatasetVol(data.Dataset):
             half_volume_shape = [odd_size[0]//2,odd_size[1]//2]
             self.volStart = [currVol.shape[0]//2-half_volume_shape[0], currVol.shape[1]//2-half_volume_shape[1]]
             self.volEnd = [odd_size[n] + self.volStart[n] for n in range(len(self.volStart))]
+            self.vol_size = odd_size
             self.vols = torch.zeros(self.n_images, n_depths_to_fill, odd_size[0], odd_size[1], dtype=self.vol_type)
             
         else:
@@ -593,22 +944,15 @@ class XLFMDatasetVol(data.Dataset):
         if self.load_sparse:
             stacked_views_sparse = self.stacked_views.clone()
 
+        self.volume_errors = []
+        if load_vols:
+            self.volume_errors = load_volumes_parallel(self.all_files[:self.n_images], self.read_tiff_stack,
+                                                        lambda nImg,currVol: self.prepare_volume(currVol, out=self.vols[nImg]), maxWorkers)
+
         for nImg in tqdm (range(self.n_images), desc="Loading Img..."):
             # Load the images indicated from the user
             curr_img = images_to_use[nImg]
 
-            if load_vols:
-                currVol = self.read_tiff_stack(self.all_files[curr_img])
-                assert not torch.isinf(currVol).any()
-                if border_blanking>0:
-                    currVol[:border_blanking,...] = 0
-                    currVol[-border_blanking:,...] = 0
-                    currVol[:,:border_blanking,...] = 0
-                    currVol[:,-border_blanking:,...] = 0
-                    currVol[:,:,:border_blanking] = 0
-                    currVol[:,:,-border_blanking:] = 0
-                self.vols[nImg,:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
-                    [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
 
             if load_imgs:
                 image = torch.from_numpy(np.array(self.img_dataset[curr_img,:,:]).astype(np.float16)).type(torch.float16)
@@ -625,6 +969,46 @@ class XLFMDatasetVol(data.Dataset):
 
         print('Loaded ' + str(self.n_images))  
 
+    # Frames and volumes from a preprocessed dataset (see mainConvertDataset.py), memory mapped as stored without any conversion.
+    def load_preprocessed(self, images_to_use, n_workers, load_imgs=True):
+        self.stacked_views, vols, self.manifest, self.images_to_use = load_preprocessed_dataset(self.data_path, images_to_use,
+                                                                        load_imgs, self.load_sparse, self.load_vols, n_workers)
+        assert list(self.img_shape) == self.manifest['img_shape'], 'The preprocessed dataset has frames of ' + str(self.manifest['img_shape'])
+        if self.load_sparse and not self.manifest['sparse']:
+            self.load_sparse = False
+            print('Dataset error: the preprocessed dataset has no sparse frames')
+        if self.load_vols and vols is None:
+            self.load_vols = False
+            print('Dataset error: the preprocessed dataset has no ' + ('sparse ' if self.load_sparse else '') + 'volumes, see --dense_vols of mainConvertDataset.py')
+        if self.stacked_views is None:
+            self.stacked_views = torch.ones([1])
+        self.n_images = len(self.images_to_use)
+        self.n_depths_to_fill = self.manifest['n_depths_to_fill']
+        self.volume_errors = self.manifest['volume_errors']
+        self.all_files = []
+        if self.load_vols:
+            self.vols = vols
+            self.vol_size = list(vols.shape[-2:])
+        else:
+            self.vols = 255*torch.ones(1)
+        self.use_manifest_statistics = True
+        print('Loaded ' + str(self.n_images) + ' preprocessed')
+
+    # Volume read by read_tiff_stack [H,W,nDepths] to the [n_depths_to_fill,H,W] stored in self.vols, written into out
+    def prepare_volume(self, currVol, out):
+        assert not torch.isinf(currVol).any()
+        border_blanking = self.border_blanking
+        if border_blanking>0:
+            currVol[:border_blanking,...] = 0
+            currVol[-border_blanking:,...] = 0
+            currVol[:,:border_blanking,...] = 0
+            currVol[:,-border_blanking:,...] = 0
+            currVol[:,:,:border_blanking] = 0
+            currVol[:,:,-border_blanking:] = 0
+        out[:currVol.shape[2],:,:] = currVol.permute(2,0,1)\
+            [:,self.volStart[0]:self.volEnd[0],self.volStart[1]:self.volEnd[1]]
+        return out
+
     def __len__(self):
         'Denotes the total number of samples'
         if self.use_random_shifts:
@@ -637,35 +1021,49 @@ class XLFMDatasetVol(data.Dataset):
     def get_n_temporal_frames(self):
         return len(self.temporal_shifts)
 
+    # Statistics of the frames (a channel for the frames and one for the sparse ones) and volumes, see StreamingStatistics,
+    # computed going once through the dataset and kept until the frames or volumes change. The ones of preprocessed datasets
+    # are read from their manifest.
+    def get_dataset_statistics(self):
+        if self.statistics is not None:
+            return self.statistics
+        n_channels = self.stacked_views.shape[-1] if self.load_sparse and self.stacked_views.ndim==4 else 1
+        if self.use_manifest_statistics:
+            volumes_name = 'volumes_sparse' if self.load_sparse else 'volumes'
+            names = (['frames'] if self.load_imgs else []) + ([volumes_name] if self.load_vols else [])
+            stored = preprocessed_statistics(self.data_path, self.images_to_use, names)
+            self.statistics = {'imgs' : select_channels(stored['frames'], range(n_channels)) if self.load_imgs else StreamingStatistics().update(self.stacked_views).result(),
+                               'vols' : stored[volumes_name] if self.load_vols else StreamingStatistics().update(self.vols).result()}
+        else:
+            self.statistics = dataset_statistics(self.frame_items(), self.volume_items(), n_channels)
+        return self.statistics
+
+    # Types of the frame and volume statistics returned by get_max and get_statistics
+    def statistics_types(self):
+        return [t.dtype if torch.is_tensor(t) else self.vol_type for t in [self.stacked_views, self.vols]]
+
     def get_max(self):
         'Get max intensity from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().max().type(self.stacked_views.type()),\
-                    self.stacked_views[...,1].float().max().type(self.stacked_views.type()),\
-                    self.vols.float().max().type(self.vols.type())
-        else:
-            return self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.stacked_views.float().max().type(self.stacked_views.type()),\
-                self.vols.float().max().type(self.vols.type())
+        return statistics_max(self.get_dataset_statistics(), *self.statistics_types())
 
     def get_statistics(self):
         'Get mean and standard deviation from volumes and images for normalization'
-        if self.load_sparse:
-            return  self.stacked_views[...,0].float().mean().type(self.stacked_views.type()), self.stacked_views[...,0].float().std().type(self.stacked_views.type()), \
-                    self.stacked_views[...,1].float().mean().type(self.stacked_views.type()), self.stacked_views[...,1].float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
-        else:
-            return  self.stacked_views.float().mean().type(self.stacked_views.type()), self.stacked_views.float().std().type(self.stacked_views.type()), \
-                    self.vols.float().mean().type(self.vols.type()), self.vols.float().std().type(self.vols.type())
+        return statistics_mean_std(self.get_dataset_statistics(), *self.statistics_types())
 
     def standarize(self, stats=None):
         mean_imgs, std_imgs, mean_imgs_s, std_imgs_s, mean_vols, std_vols = stats
-        if self.load_sparse:
-            self.stacked_views[...,0] = (self.stacked_views[...,0]-mean_imgs) / std_imgs
-            self.stacked_views[...,1] = (self.stacked_views[...,1]-mean_imgs_s) / std_imgs_s
-        else:
-            self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
-        self.vols = (self.vols-mean_vols) / std_vols
+        if is_memory_mapped(self.stacked_views) or is_memory_mapped(self.vols):
+            self.decode_stats = stats
+        if not is_memory_mapped(self.stacked_views):
+            if self.load_sparse:
+                self.stacked_views[...,0] = (self.stacked_views[...,0]-mean_imgs) / std_imgs
+                self.stacked_views[...,1] = (self.stacked_views[...,1]-mean_imgs_s) / std_imgs_s
+            else:
+                self.stacked_views[...] = (self.stacked_views[...]-mean_imgs) / std_imgs
+        if not is_memory_mapped(self.vols):
+            self.vols = (self.vols-mean_vols) / std_vols
+        self.statistics = None
+        self.use_manifest_statistics = False
 
     def len_lenslets(self):
         'Denotes the total number of lenslets'
@@ -697,13 +1095,15 @@ class XLFMDatasetVol(data.Dataset):
         indices = [img_index + temporal_shifts_ixs[i] for i in range(n_frames)]
         
         if self.load_imgs:
-            views_out = self.stacked_views[indices,...]
+            views_out = self.read_frames(indices)
         else:
             views_out = 0
         if self.load_vols:
-            vol_out = self.vols[indices,...]
+            vol_out = self.read_volumes(indices)
         else:
             vol_out = 0
+        if self.transform is not None:
+            views_out,vol_out = self.transform(views_out, vol_out)
 
         return views_out,vol_out
 
@@ -713,27 +1113,17 @@ class XLFMDatasetVol(data.Dataset):
         
         return vol[index]
 
+    # Patches of subimage_shape around each lenslet, [B,C,n_lenslets,subimage_shape[0],subimage_shape[1]]. The patches
+    # clipped by the image border are aligned to the bottom right of the view. On the GPU all the lenslets are gathered at once, see gather_lenslet_views.
     @staticmethod
     def extract_views(image, lenslet_coords, subimage_shape, debug=False):
-        half_subimg_shape = [subimage_shape[0]//2,subimage_shape[1]//2]
-        n_lenslets = lenslet_coords.shape[0]
-        stacked_views = torch.zeros(size=[image.shape[0], image.shape[1], n_lenslets, subimage_shape[0], subimage_shape[1]], device=image.device, dtype=image.dtype)
+        stacked_views = gather_lenslet_views(image, lenslet_coords, subimage_shape)
         
         if debug:
             debug_image = image.detach().clone()
             max_img = image.float().cpu().max()
-        for nLens in range(n_lenslets):
-            # Fetch coordinates
-            currCoords = lenslet_coords[nLens,:]
-            if debug:
+            for currCoords in lenslet_coords:
                 debug_image[:,:,currCoords[0]-2:currCoords[0]+2,currCoords[1]-2:currCoords[1]+2] = max_img
-            # Grab patches
-            lower_bounds = [currCoords[0]-half_subimg_shape[0], currCoords[1]-half_subimg_shape[1]]
-            lower_bounds = [max(lower_bounds[kk],0) for kk in range(2)]
-            currPatch = image[:,:,lower_bounds[0] : currCoords[0]+half_subimg_shape[0], lower_bounds[1] : currCoords[1]+half_subimg_shape[1]]
-            stacked_views[:,:,nLens,-currPatch.shape[2]:,-currPatch.shape[3]:] = currPatch
-        
-        if debug:
             import matplotlib.pyplot as plt
             plt.imshow(debug_image[0,0,...].float().cpu().detach().numpy())
             plt.show()
@@ -749,7 +1139,14 @@ class XLFMDatasetVol(data.Dataset):
         out = np.clip(tiffarray.raw_images, 0, max_val)
         return torch.from_numpy(out).permute(1,2,0).type(out_datatype)
 
+    # The noise of memory mapped frames is added each time they are read
     def add_random_shot_noise_to_dataset(self, signal_power_range=[32**2,32**2]):
+        if is_memory_mapped(self.stacked_views):
+            self.decode_noise_range = signal_power_range
+            self.statistics = None
+            self.use_manifest_statistics = False
+            print("Adding noise to " + str(self.stacked_views.shape[0]) + " images when read.")
+            return
         for nImg in range(self.stacked_views.shape[0]):
             signal_power = (signal_power_range[0] + (signal_power_range[1]-signal_power_range[0]) * torch.rand(1)).item()
             
@@ -761,6 +1158,8 @@ class XLFMDatasetVol(data.Dataset):
                 curr_img_stack[kk,...] = pytorch_shot_noise.add_camera_noise(curr_img_stack[kk,...])
             curr_img_stack = curr_max * curr_img_stack.float() / signal_power
             self.stacked_views[nImg,...] = curr_img_stack
+        self.statistics = None
+        self.use_manifest_statistics = False
         print("Added noise to " + str(self.stacked_views.shape[0]) + " images.")
 
 
@@ -1,6 +1,10 @@
 import torch
 import nrrd
 import sys
+import os
+import time
+import inspect
+import pickle
 from PIL import Image
 from torchvision.transforms import ToTensor
 from torch.utils import data
@@ -13,17 +17,62 @@ import matplotlib.pyplot as plt
 import torch.nn.functional as F
 
 from utils.misc_utils import *
+from utils.OTFStore import OTFStore
 
 
+# Richardson-Lucy deconvolution of a batch of images img [B,1,H,W] into volumes [B,nDepths,ObjSize[0],ObjSize[1]].
+# Every chunk of nSplitFourier depths of the OTF is loaded once per iteration and applied to the whole batch.
+# Each image keeps its own median clamp and stops updating once its volume reaches max_allowed.
+# OTF can also be an OTFStore, to stream it from disk with bounded RAM.
+# acceleration:
+#   'none': plain Richardson-Lucy.
+#   'biggs_andrews': vector extrapolated Richardson-Lucy (Biggs and Andrews 1997), each iteration starts from
+#                    the current estimate extrapolated along the last update direction.
+# stop_criterion: 'none', 'error' or 'volume', an image stops when the relative change between iterations of
+#                 its errorMetric or of its volume falls below stop_tol.
+# With return_stats a list with a dict of statistics per iteration is also returned.
+# init_volume: optional [B,nDepths,ObjSize[0],ObjSize[1]] starting estimate (warm start), for example the volume of
+#              the previous frame of a sequence or an XLFMNet prediction, instead of a volume of ones.
+#              As the updates are multiplicative, voxels below init_floor times the mean of the volume are raised to it.
+# precision: 'float32', 'float16' or 'bfloat16', storage type of the OTF (real and imaginary parts) and of the volume
+#            between iterations. The FFTs and the updates are computed in float32 chunk by chunk, and the returned
+#            volume is float32. See XLFM_precision_error for the accuracy with respect to 'float32'.
+# fftshift_in_OTF: the OTF was loaded with load_PSF_OTF(..., fftshift_in_OTF=True), and the results of the
+#                  inverse FFTs are already shifted.
+# pool: optional XLFMDeconvPool, to split the depths between CPU processes (device 'cpu', in memory OTF and float32 only).
+#       The per iteration stats then include the worker utilization, the fraction of the time the workers were computing.
+# skip_tol: skip in the forward projection, and freeze in the update, the depths with less energy than skip_tol times the
+#           brightest one (see XLFM_depth_mask), 0 to project all the depths. The stats include the number of skipped planes.
+# median_mode: estimator of the median of the ratio used to clamp the updates, see XLFM_ratio_median.
+# obj_padding: [left,right,top,bottom] padding of the volume to the OTF size, by default the volume is centered.
+# background: optional fixed term added to the forward projection, a number or images [B,1,H,W] like img,
+#             for the light coming from outside the deconvolved volume (see XLFMDeconvROI and XLFM_background).
+# checkpoint_path: optional file where the state of the deconvolution is stored every checkpoint_every iterations and
+#                  at the end. If it exists when called with the same images, the deconvolution resumes from it, and a
+#                  finished checkpoint returns its result without iterating. The caller removes it once the result is stored.
 def XLFMDeconv(OTF, img, nIt, ObjSize=[512,512], PSFShape=[2160,2160], ROIsize=[512,512],\
-                 errorMetric=F.mse_loss, nSplitFourier=1, update_median_limit_multiplier=10, max_allowed=4500, device='cuda:0', all_in_device=False):
+                 errorMetric=F.mse_loss, nSplitFourier=1, update_median_limit_multiplier=10, max_allowed=4500, device='cuda:0', all_in_device=False,
+                 forward_mode='per_depth', acceleration='none', stop_criterion='none', stop_tol=1e-3, return_stats=False, verbose=False,
+                 init_volume=None, init_floor=1e-3, precision='float32', fftshift_in_OTF=False, pool=None,
+                 checkpoint_path=None, checkpoint_every=10, skip_tol=0, median_mode='exact',
+                 obj_padding=None, background=None):
+    assert precision in PRECISION_DTYPES, 'Unknown precision: ' + str(precision)
+    assert pool is None or (device=='cpu' and precision=='float32'), 'The XLFMDeconvPool only runs on the CPU in float32.'
+    assert acceleration in ['none','biggs_andrews'], 'Unknown acceleration: ' + str(acceleration)
+    assert stop_criterion in ['none','error','volume'], 'Unknown stop_criterion: ' + str(stop_criterion)
+    assert median_mode in MEDIAN_MODES, 'Unknown median_mode: ' + str(median_mode)
     
-    reconType = OTF.type()
     nDepths = OTF.shape[1]
+    batch_size = img.shape[0]
+    stats = []
 
-    if img.sum()==0:
-        volOut = torch.zeros(img.shape[0],nDepths, ObjSize[0], ObjSize[1]).type(reconType)
+    # Empty images produce empty volumes
+    active = [nImg for nImg in range(batch_size) if img[nImg].sum()!=0]
+    if len(active)==0:
+        volOut = torch.zeros(batch_size,nDepths, ObjSize[0], ObjSize[1])
         proj = volume_2_projections(volOut.permute(0,2,3,1).unsqueeze(1)).cpu()
+        if return_stats:
+            return volOut,proj,img,[],stats
         return volOut,proj,img,[]
 
     # paddedOTFShape = [ROIsize[i]//2 - 1 for i in range(2)]
@@ -32,17 +81,33 @@ def XLFMDeconv(OTF, img, nIt, ObjSize=[512,512], PSFShape=[2160,2160], ROIsize=[
     # device = OTF.device
 
     # Compute transposed OTF
-    OTFt = OTF[...,1].clone()
-    OTF = OTF[...,0].clone()
+    if isinstance(OTF, OTFStore) or pool is not None:
+        # Streamed from disk, the transpose is computed on the fly, or shared with the pool workers
+        OTFt = OTF[...,1]
+        OTF = OTF[...,0]
+    else:
+        OTFt = compress_OTF(OTF[...,1], PRECISION_DTYPES[precision])
+        OTF = compress_OTF(OTF[...,0], PRECISION_DTYPES[precision])
 
     padSize = 2*[(OTF.shape[2] - ObjSize[0])//2] + 2*[(OTF.shape[2] - ObjSize[1])//2]
+    if obj_padding is not None:
+        padSize = list(obj_padding)
     padSizeImg = 2*[(OTF.shape[2] - img.shape[2])//2] + 2*[(OTF.shape[2] - img.shape[3])//2]
 
     # Pad input
     ImgExp = F.pad(img, padSizeImg).to(device)
+    if torch.is_tensor(background):
+        background = F.pad(background.float(), padSizeImg).to(device)
     with torch.no_grad():
         # Initialize reconstructed volume
-        ObjRecon = torch.ones(1,nDepths,ObjSize[0],ObjSize[1])#.type(dtype=reconType)
+        ObjRecon = torch.ones(batch_size,nDepths,ObjSize[0],ObjSize[1], dtype=PRECISION_DTYPES[precision])
+        for nImg in range(batch_size):
+            if nImg not in active:
+                ObjRecon[nImg] = 0
+            elif init_volume is not None:
+                init_mean = init_volume[nImg].float().clamp(min=0).mean()
+                if init_mean>0:
+                    ObjRecon[nImg] = init_volume[nImg].float().cpu().clamp(min=init_floor*init_mean.item())
         
         ImgEst = 0* ImgExp.clone()
 
@@ -53,45 +118,125 @@ def XLFMDeconv(OTF, img, nIt, ObjSize=[512,512], PSFShape=[2160,2160], ROIsize=[
             ImgEst = ImgEst.to(device)
             ImgExp = ImgExp.to(device)
 
+        # Previous estimate and update direction, and extrapolation factor, for the accelerated updates
+        if acceleration=='biggs_andrews':
+            ObjPrev = ObjRecon.clone()
+            UpdatePrev = torch.zeros_like(ObjRecon)
+            alpha = torch.zeros(batch_size)
+        prev_errors = batch_size * [None]
+
         losses = []
-        end = "\r"
+        start_iteration = 0
+        # Resume from the last checkpoint
+        checkpoint = load_deconv_checkpoint(checkpoint_path, img)
+        if checkpoint is not None:
+            start_iteration = checkpoint['iteration']
+            active,prev_errors,losses,stats = checkpoint['active'],checkpoint['prev_errors'],checkpoint['losses'],checkpoint['stats']
+            ObjRecon = checkpoint['ObjRecon'].to(ObjRecon.device, ObjRecon.dtype)
+            ImgEst = checkpoint['ImgEst'].to(ImgEst.device)
+            if acceleration=='biggs_andrews':
+                ObjPrev,UpdatePrev,alpha = checkpoint['ObjPrev'].to(ObjRecon.device),checkpoint['UpdatePrev'].to(ObjRecon.device),checkpoint['alpha']
+            if verbose:
+                print('Deconv resumed from ' + checkpoint_path + ' at iteration ' + str(start_iteration))
+        # State needed to resume the deconvolution after iteration ii
+        def checkpoint_state(ii):
+            state = {'iteration' : ii+1, 'active' : active, 'prev_errors' : prev_errors, 'losses' : losses, 'stats' : stats,
+                     'ObjRecon' : ObjRecon.cpu(), 'ImgEst' : ImgEst.cpu(), 'img_shape' : list(img.shape), 'img_sum' : img.float().sum().item()}
+            if acceleration=='biggs_andrews':
+                state.update({'ObjPrev' : ObjPrev.cpu(), 'UpdatePrev' : UpdatePrev.cpu(), 'alpha' : alpha})
+            return state
         # plt.ion()
         # plt.figure()
-        for ii in range(nIt):
+        for ii in range(start_iteration, nIt if len(active)>0 else start_iteration):
+            start_time = time.time()
+            # Only deconvolve the images that didn't stop yet
+            all_active = len(active)==batch_size
+            currObj = ObjRecon if all_active else ObjRecon[active]
+            currImgExp = ImgExp if all_active else ImgExp[active]
+
+            if acceleration=='biggs_andrews':
+                # Extrapolate along the last update direction, and keep the current estimate
+                currAlpha = alpha[active].view(-1,1,1,1).to(currObj.device)
+                ObjPred = (currObj + currAlpha * (currObj - (ObjPrev if all_active else ObjPrev[active]))).clamp_(min=0).to(currObj.dtype)
+                if all_active:
+                    ObjPrev.copy_(currObj)
+                else:
+                    ObjPrev[active] = currObj
+                currObj = ObjPred
+                ObjStart = ObjPred.clone()
+            elif stop_criterion=='volume':
+                ObjStart = currObj.clone()
+            
+            # Compute current image estimate (forward projection), only of the depths with some energy
+            depth_mask = XLFM_depth_mask(currObj, skip_tol)
+            if pool is None:
+                currImgEst = XLFM_forward_projection_padded(OTF, currObj, nSplitFourier, device, forward_mode, padSize, fftshift_in_OTF, depth_mask=depth_mask)
+            else:
+                currImgEst,forward_timing = pool.forward_projection(currObj, padSize, nSplitFourier, forward_mode, fftshift_in_OTF, depth_mask)
             
-            # Compute current image estimate (forward projection)
-            ImgEst *= 0.0
-            ObjTemp = F.pad(ObjRecon, padSize)
-            for jj in range(0,nDepths, nSplitFourier):
-                curr_depths = list(range(jj,jj+nSplitFourier))
-                planeOTF = OTF[:,curr_depths,...].to(device)
-                currObjPlanes = ObjTemp[:,curr_depths,...]
-                if len(curr_depths)==1:
-                    planeOTF = planeOTF.unsqueeze(1)
-                    currObjPlanes = currObjPlanes.unsqueeze(1)
-                planeObjFFT = torch.fft.rfft2(currObjPlanes).to(device)
-                ImgEst += F.relu(batch_fftshift2d_real(torch.fft.irfft2(planeObjFFT * planeOTF))).sum(1).unsqueeze(1)
+            if background is not None:
+                currImgEst = currImgEst + (background if not torch.is_tensor(background) or all_active or background.shape[0]==1 else background[active])
             
             # Compute error in forward image
-            ImgEst[ImgEst<1e-6] = 0
-            Tmp = ImgExp / (ImgEst+1e-8)    
-            if Tmp[Tmp!=0].numel()>0:
-                Tmp.clamp_(0.0,Tmp[Tmp!=0].median()*update_median_limit_multiplier)
+            currImgEst[currImgEst<1e-6] = 0
+            Tmp = currImgExp / (currImgEst+1e-8)    
+            for nImg in range(Tmp.shape[0]):
+                median = XLFM_ratio_median(Tmp[nImg], median_mode)
+                if median is not None:
+                    Tmp[nImg].clamp_(0.0,median*update_median_limit_multiplier)
             Ratio = Tmp.to(device)
             # Propagate error back to volume space and update volume
-            for jj in range(0,nDepths, nSplitFourier):
-                curr_depths = list(range(jj,jj+nSplitFourier))
-                planeObj = ObjTemp[:,curr_depths,...].unsqueeze(1).to(device)
-                planeOTF = OTFt[:,curr_depths,...].to(device)
-                ObjRecon[:,curr_depths,...] = F.pad(planeObj * batch_fftshift2d_real(torch.fft.irfft2(torch.fft.rfft2(Ratio) * planeOTF)),[-p for p in padSize]).type(ObjRecon.type())
+            if pool is None:
+                XLFM_backprojection_update(OTFt, currObj, Ratio, padSize, nSplitFourier, device, fftshift_in_OTF, depth_mask=depth_mask)
+            else:
+                _,backward_timing = pool.backprojection_update(currObj, Ratio, padSize, nSplitFourier, fftshift_in_OTF, depth_mask)
+
+            curr_stats = {'iteration' : ii+1, 'active' : list(active)}
+            if skip_tol > 0:
+                curr_stats['skipped_planes'] = int(nDepths - depth_mask.sum())
+            if pool is not None:
+                # Time in the workers over the time spent waiting for them
+                busy_time = [forward_timing[1][n] + backward_timing[1][n] for n in range(len(forward_timing[1]))]
+                curr_stats['worker_utilization'] = sum(busy_time) / max(len(busy_time) * (forward_timing[0] + backward_timing[0]), 1e-12)
+            # Relative change of the volumes, with respect to the previous estimate
+            if stop_criterion=='volume':
+                ObjOld = ObjStart
+                if acceleration=='biggs_andrews':
+                    ObjOld = ObjPrev if all_active else ObjPrev[active]
+                curr_stats['relative_change'] = [((currObj[n].float()-ObjOld[n].float()).norm() / ObjOld[n].float().norm().clamp(min=1e-12)).item() for n in range(len(active))]
+
+            if acceleration=='biggs_andrews':
+                # New update direction and extrapolation factor
+                Update = ObjStart.neg_().add_(currObj)
+                currUpdatePrev = UpdatePrev if all_active else UpdatePrev[active]
+                dims = list(range(1,Update.ndim))
+                newAlpha = (Update.float()*currUpdatePrev.float()).sum(dims) / (currUpdatePrev.float()**2).sum(dims).clamp(min=1e-12)
+                alpha[active] = newAlpha.clamp(0,1).cpu()
+                if all_active:
+                    UpdatePrev = Update
+                else:
+                    UpdatePrev[active] = Update
+                curr_stats['alpha'] = alpha[active].tolist()
             
-            proj = volume_2_projections(ObjRecon.permute(0,2,3,1).unsqueeze(1)).cpu()
+            if all_active:
+                ObjRecon = currObj
+                ImgEst = currImgEst
+            else:
+                ObjRecon[active] = currObj
+                ImgEst[active] = currImgEst
 
-            curr_error = errorMetric(ImgExp,ImgEst).item()
+            curr_error = errorMetric(currImgExp,currImgEst).item()
             losses.append(curr_error)
-            if ii==nIt-1:
-                end = "\n"
-            print('Deconv it: ' + str(ii+1) + ' / ' + str(nIt) + '\t currErr: ' + str(curr_error), end=end)
+            curr_stats['error'] = [errorMetric(currImgExp[n:n+1],currImgEst[n:n+1]).item() for n in range(len(active))]
+            if stop_criterion=='error':
+                curr_stats['relative_change'] = [abs(curr_stats['error'][n]-prev_errors[active[n]]) / max(prev_errors[active[n]],1e-12) \
+                                                    if prev_errors[active[n]] is not None else float('inf') for n in range(len(active))]
+            for n in range(len(active)):
+                prev_errors[active[n]] = curr_stats['error'][n]
+            curr_stats['time'] = time.time() - start_time
+            stats.append(curr_stats)
+            if verbose:
+                print('Deconv it: ' + str(ii+1) + ' / ' + str(nIt) + '\t currErr: ' + str(curr_error))
             ## Uncomment to show some images
             # plt.subplot(1,3,1)
             # plt.imshow(ImgExp[0,0,...].cpu().numpy())
@@ -101,32 +246,310 @@ def XLFMDeconv(OTF, img, nIt, ObjSize=[512,512], PSFShape=[2160,2160], ROIsize=[
             # plt.imshow(proj[0,0,...].cpu().numpy())
             # plt.pause(0.1)
             # plt.show()
+            # Stop images that converged or reached max_allowed
+            keep = len(active) * [True]
+            if stop_criterion!='none':
+                keep = [keep[n] and curr_stats['relative_change'][n]>=stop_tol for n in range(len(active))]
             if max_allowed is not None:
-                if ObjRecon.float().max()>=max_allowed:
-                    break
+                keep = [keep[n] and currObj[n].float().max()<max_allowed for n in range(len(active))]
+            active = [active[n] for n in range(len(active)) if keep[n]]
+            if checkpoint_path is not None and (len(active)==0 or ii+1==nIt or (checkpoint_every>0 and (ii+1)%checkpoint_every==0)):
+                save_deconv_checkpoint(checkpoint_path, checkpoint_state(ii))
+            if len(active)==0:
+                break
+        ObjRecon = ObjRecon.float()
+        proj = volume_2_projections(ObjRecon.permute(0,2,3,1).unsqueeze(1)).cpu()
+    if return_stats:
+        return ObjRecon,proj,ImgEst,losses,stats
     return ObjRecon,proj,ImgEst,losses
 
 
-def XLFM_forward_projection(OTF, volume, img_shape, is_padded=False, nSplitFourier=6):
+# Coarse to fine Richardson-Lucy deconvolution. The first iterations mostly recover the low frequencies of the volume,
+# so they run on downsampled images and volumes, and each level warm starts the next one.
+# OTFs: list of OTFs from coarse to fine, loaded with load_PSF_OTF(..., downS=downS[n]), the last one usually with downS 1.
+# nIt: list with the iterations of each level.
+# The images are downsampled by area, adding up the pixels, and the volumes are upsampled keeping their total intensity,
+# so each level starts with the intensity of the previous one. max_allowed is scaled accordingly.
+# The rest of the arguments are passed to XLFMDeconv, the pool (if any) is only used in the last level and the
+# checkpoint_path gets the level appended. The stats of every iteration include its level and downS.
+def XLFMDeconvPyramid(OTFs, img, nIt, downS=[4,2,1], ObjSize=[512,512], max_allowed=4500, return_stats=False,
+                      init_volume=None, pool=None, checkpoint_path=None, **deconv_args):
+    assert len(OTFs)==len(downS)==len(nIt), 'XLFMDeconvPyramid needs an OTF and a number of iterations per level.'
+    stats = []
+    losses = []
+    volume = init_volume
+    for nLevel in range(len(OTFs)):
+        currDownS = downS[nLevel]
+        levelObjSize = [s//currDownS for s in ObjSize]
+        levelImg = img if currDownS==1 else F.avg_pool2d(img.float(), currDownS) * currDownS**2
+        if volume is not None and list(volume.shape[-2:])!=levelObjSize:
+            area_ratio = volume.shape[-2] * volume.shape[-1] / (levelObjSize[0] * levelObjSize[1])
+            volume = F.interpolate(volume.float(), levelObjSize, mode='bilinear', align_corners=False) * area_ratio
+        volume,proj,ImgEst,levelLosses,levelStats = XLFMDeconv(OTFs[nLevel], levelImg, nIt[nLevel], ObjSize=levelObjSize,
+                                                max_allowed=max_allowed*currDownS**2 if max_allowed is not None else None, return_stats=True, init_volume=volume,
+                                                pool=pool if nLevel==len(OTFs)-1 else None,
+                                                checkpoint_path=os.path.splitext(checkpoint_path)[0] + '_level' + str(nLevel) + '.pt' if checkpoint_path is not None else None, **deconv_args)
+        for curr_stats in levelStats:
+            curr_stats.update({'level' : nLevel, 'downS' : currDownS})
+        stats += levelStats
+        losses += levelLosses
+    if return_stats:
+        return volume,proj,ImgEst,losses,stats
+    return volume,proj,ImgEst,losses
+
+
+# Median of the non zero values of the ratio of an image, used to clamp the updates, None if all are zero.
+# median_mode:
+#   'exact': median of all the non zero values.
+#   'subsampled': median of the non zero values of every 4th pixel in each direction.
+#   'histogram': from a histogram of log10 of the values in MEDIAN_HISTOGRAM_BINS bins between 1e-12 and 1e12, interpolated
+#                inside the bin, without copying the non zero values (zeros and values out of range fall out of the histogram).
+# See XLFM_median_benchmark for their speed and accuracy.
+MEDIAN_MODES = ['exact','subsampled','histogram']
+MEDIAN_HISTOGRAM_BINS = 4096
+def XLFM_ratio_median(ratio, median_mode='exact'):
+    if median_mode=='histogram':
+        hist = torch.histc(torch.log10(ratio.float().clamp(min=1e-30)), bins=MEDIAN_HISTOGRAM_BINS, min=-12, max=12)
+        n_values = hist.sum().item()
+        if n_values==0:
+            return None
+        cdf = hist.cumsum(0)
+        nBin = min(int(torch.searchsorted(cdf, torch.tensor([n_values/2], device=cdf.device))[0]), MEDIAN_HISTOGRAM_BINS-1)
+        prev_count = cdf[nBin-1].item() if nBin>0 else 0
+        bin_pos = nBin + (n_values/2 - prev_count) / max(hist[nBin].item(), 1)
+        return 10**(-12 + 24*bin_pos/MEDIAN_HISTOGRAM_BINS)
+    if median_mode=='subsampled':
+        ratio = ratio[...,::4,::4]
+    values = ratio[ratio!=0]
+    if values.numel()==0:
+        return None
+    return values.median().item()
+
+
+# Time and relative error with respect to the exact median of each median_mode, on the ratio of the images img
+# and their forward projections ImgEst as returned by XLFMDeconv.
+def XLFM_median_benchmark(img, ImgEst, median_modes=MEDIAN_MODES, n_repeats=5):
+    padSizeImg = 2*[(ImgEst.shape[-1] - img.shape[-1])//2] + 2*[(ImgEst.shape[-2] - img.shape[-2])//2]
+    ratio = F.pad(img.float(), padSizeImg).to(ImgEst.device) / (ImgEst.float()+1e-8)
+    results = {}
+    for median_mode in median_modes:
+        start_time = time.time()
+        for _ in range(n_repeats):
+            medians = [XLFM_ratio_median(ratio[nImg], median_mode) for nImg in range(ratio.shape[0])]
+        results[median_mode] = {'time' : (time.time() - start_time) / n_repeats, 'medians' : medians}
+    exact = results['exact']['medians'] if 'exact' in results else [XLFM_ratio_median(ratio[nImg]) for nImg in range(ratio.shape[0])]
+    for median_mode in median_modes:
+        errors = [abs(m-e)/max(abs(e),1e-12) for m,e in zip(results[median_mode]['medians'],exact) if m is not None and e is not None]
+        results[median_mode]['relative_error'] = max(errors) if len(errors)>0 else 0.0
+        del results[median_mode]['medians']
+    return results
+
+
+# Deconvolution of a sub-volume: the depths depth_range=[start,stop) of the OTF and the lateral roi=[y,x,height,width]
+# of a volume of ObjSize. The rest of the volume still contributes to the image, which can be handled with:
+#   guard_depths, guard_pixels: the sub-volume is grown by a guard band (clipped to the volume) that absorbs the
+#                               light from outside, and is cropped at the end.
+#   background: fixed image added to the forward projection, for example XLFM_background of a previous estimate.
+# The FFTs keep the size of the OTF, the savings come from the depths left out and the smaller volume.
+# init_volume can be given for the whole volume or for the sub-volume, whose borders are then replicated into the guard band.
+# The rest of the arguments are passed to XLFMDeconv. A XLFMDeconvPool holds the whole volume and can't be used.
+def XLFMDeconvROI(OTF, img, nIt, roi=None, depth_range=None, guard_pixels=0, guard_depths=0, ObjSize=[512,512],
+                  init_volume=None, return_stats=False, pool=None, **deconv_args):
+    assert torch.is_tensor(OTF), 'XLFMDeconvROI needs an in memory OTF.'
+    assert pool is None, 'XLFMDeconvROI can not use a XLFMDeconvPool, which holds the whole volume.'
+    nDepths = OTF.shape[1]
+    roi = list(roi) if roi is not None and len(roi)>0 else [0, 0, ObjSize[0], ObjSize[1]]
+    depth_range = list(depth_range) if depth_range is not None and len(depth_range)>0 else [0, nDepths]
+    # Sub-volume to deconvolve, with the guard band
+    d0,d1 = max(depth_range[0]-guard_depths, 0), min(depth_range[1]+guard_depths, nDepths)
+    y0,x0 = max(roi[0]-guard_pixels, 0), max(roi[1]-guard_pixels, 0)
+    y1,x1 = min(roi[0]+roi[2]+guard_pixels, ObjSize[0]), min(roi[1]+roi[3]+guard_pixels, ObjSize[1])
+    # Padding that places the sub-volume where it is in the centered volume
+    top,left = (OTF.shape[2]-ObjSize[0])//2 + y0, (OTF.shape[2]-ObjSize[1])//2 + x0
+    obj_padding = [left, OTF.shape[2]-left-(x1-x0), top, OTF.shape[2]-top-(y1-y0)]
+
+    if init_volume is not None:
+        if list(init_volume.shape[1:])==[nDepths] + list(ObjSize):
+            init_volume = init_volume[:,d0:d1,y0:y1,x0:x1]
+        else:
+            init_volume = F.pad(init_volume.float().unsqueeze(1), [roi[1]-x0, x1-roi[1]-roi[3], roi[0]-y0, y1-roi[0]-roi[2],
+                                depth_range[0]-d0, d1-depth_range[1]], mode='replicate')[:,0]
+
+    volume,_,ImgEst,losses,stats = XLFMDeconv(OTF[:,d0:d1], img, nIt, ObjSize=[y1-y0, x1-x0], init_volume=init_volume, return_stats=True,
+                                                obj_padding=obj_padding, **deconv_args)
+    volume = volume[:, depth_range[0]-d0:depth_range[1]-d0, roi[0]-y0:roi[0]-y0+roi[2], roi[1]-x0:roi[1]-x0+roi[3]].contiguous()
+    proj = volume_2_projections(volume.permute(0,2,3,1).unsqueeze(1)).cpu()
+    if return_stats:
+        return volume,proj,ImgEst,losses,stats
+    return volume,proj,ImgEst,losses
+
+
+# Forward projection of the depths of volume outside depth_range, cropped to the size of the images img_shape,
+# to be used as the background of a deconvolution restricted to depth_range.
+def XLFM_background(OTF, volume, depth_range, img_shape, nSplitFourier=6, forward_mode='per_depth', fftshift_in_OTF=False):
+    outside = volume.float().clone()
+    outside[:,depth_range[0]:depth_range[1]] = 0
+    with torch.no_grad():
+        background = XLFM_forward_projection(OTF, outside, [volume.shape[0], 1, OTF.shape[2], OTF.shape[2]], nSplitFourier=nSplitFourier,
+                                            forward_mode=forward_mode, fftshift_in_OTF=fftshift_in_OTF)
+    crop = [(OTF.shape[2] - img_shape[-2])//2, (OTF.shape[2] - img_shape[-1])//2]
+    return background[..., crop[0]:crop[0]+img_shape[-2], crop[1]:crop[1]+img_shape[-1]]
+
+
+# Store a deconvolution checkpoint, writing to a temporary file first so a preempted job never leaves a partial checkpoint
+def save_deconv_checkpoint(checkpoint_path, state):
+    tmp_path = checkpoint_path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, checkpoint_path)
+
+
+# Checkpoints only hold tensors, numbers and lists, loaded without unpickling code in the torch versions that allow it
+CHECKPOINT_LOAD_ARGS = {'weights_only' : True} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+
+# Load a deconvolution checkpoint if it exists and belongs to the images img, None otherwise
+def load_deconv_checkpoint(checkpoint_path, img):
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return None
+    try:
+        state = torch.load(checkpoint_path, map_location='cpu', **CHECKPOINT_LOAD_ARGS)
+    except (OSError, RuntimeError, EOFError, pickle.UnpicklingError) as e:
+        print('Ignoring unreadable deconvolution checkpoint ' + checkpoint_path + ': ' + str(e))
+        return None
+    img_sum = img.float().sum().item()
+    if state['img_shape']!=list(img.shape) or abs(state['img_sum']-img_sum) > 1e-4*max(abs(img_sum),1):
+        print('Ignoring deconvolution checkpoint ' + checkpoint_path + ' of different images.')
+        return None
+    return state
+
+
+def XLFM_forward_projection(OTF, volume, img_shape, is_padded=False, nSplitFourier=6, forward_mode='per_depth', fftshift_in_OTF=False, skip_tol=0):
     ObjSize = volume.shape[-2:]
-    nDepths = volume.shape[1]
     device = volume.device
-    # Compute transposed OTF
-    OTFt = OTF[...,1].clone()
-    OTF = OTF[...,0].clone()
+    OTF = OTF[...,0]
 
     ImgEst = torch.zeros(img_shape).to(device)
     padSize = 2*[(OTF.shape[2] - ObjSize[0])//2] + 2*[(OTF.shape[2] - ObjSize[1])//2]
 
-    if not is_padded:
-        ObjTemp = F.pad(volume, padSize)
+    if is_padded:
+        padSize = None
+    ImgEst += XLFM_forward_projection_padded(OTF, volume, nSplitFourier, device, forward_mode, padSize, fftshift_in_OTF,
+                                             depth_mask=XLFM_depth_mask(volume, skip_tol))
+    return ImgEst
+
+
+# Reduced precision storage for deconvolution
+PRECISION_DTYPES = {'float32':torch.float32, 'float16':torch.float16, 'bfloat16':torch.bfloat16}
+
+# Store a complex OTF as its real and imaginary parts [...,2] in dtype, complex64 is kept as is
+def compress_OTF(OTF, dtype=torch.float32):
+    if dtype==torch.float32:
+        return OTF.clone()
+    return torch.view_as_real(OTF).to(dtype)
+
+# Chunk of an OTF stored with compress_OTF back to complex64, to be used in float32 FFTs
+def decompress_OTF(OTF):
+    if OTF.is_complex():
+        return OTF
+    return torch.view_as_complex(OTF.float())
+
+
+# Richardson-Lucy volume update, ObjRecon is multiplied in place by the backprojection of Ratio.
+# The spectrum of Ratio is computed once and reused for all depths, and the fftshift and crop
+# to the volume size are done together with crop_fftshift2d_real, so only the cropped planes are copied.
+# The spectrum of Ratio can also be given precomputed in RatioFFT, with Ratio set to None.
+# depth_mask: optional boolean [nDepths] from XLFM_depth_mask, the depths set to False are frozen and not updated.
+def XLFM_backprojection_update(OTFt, ObjRecon, Ratio, padSize, nSplitFourier=1, device='cpu', fftshift_in_OTF=False, RatioFFT=None, depth_mask=None):
+    nDepths = ObjRecon.shape[1]
+    ObjSize = ObjRecon.shape[-2:]
+    if RatioFFT is None:
+        RatioFFT = torch.fft.rfft2(Ratio.to(device))
+    for jj in range(0,nDepths, nSplitFourier):
+        keep = None if depth_mask is None else depth_mask[jj:jj+nSplitFourier]
+        if keep is not None and not keep.any():
+            continue
+        planeOTF = decompress_OTF(OTFt[:,jj:jj+nSplitFourier,...].to(device))
+        if keep is not None and not keep.all():
+            depths = jj + keep.nonzero()[:,0]
+            planeOTF = planeOTF[:,keep.to(planeOTF.device)]
+            planeUpdate = crop_fftshift2d_real(torch.fft.irfft2(RatioFFT * planeOTF), [padSize[2],padSize[0]], ObjSize, fftshift_in_OTF)
+            ObjRecon[:,depths,...] *= planeUpdate.to(ObjRecon.device)
+            continue
+        planeUpdate = crop_fftshift2d_real(torch.fft.irfft2(RatioFFT * planeOTF), [padSize[2],padSize[0]], ObjSize, fftshift_in_OTF)
+        ObjRecon[:,jj:jj+nSplitFourier,...] *= planeUpdate.to(ObjRecon.device)
+    return ObjRecon
+
+
+# Depths of a volume [B,nDepths,H,W] worth projecting: the ones whose energy (sum) is at least skip_tol times the energy
+# of the brightest depth, for any image of the batch. Sparse volumes have many depths that quickly fade out, skipping them
+# in the forward projection and freezing them in the update saves their FFTs. None if skip_tol is 0.
+def XLFM_depth_mask(ObjRecon, skip_tol=0):
+    if skip_tol <= 0:
+        return None
+    energy = ObjRecon.float().sum([2,3])
+    return (energy >= skip_tol * energy.amax(1, keepdim=True)).any(0).cpu()
+
+
+# Forward projection of a volume, nSplitFourier depths at a time.
+# If padSize is given, each chunk of depths is padded to the OTF size on the fly, otherwise ObjTemp must be already padded.
+# forward_mode:
+#   'per_depth': irfft2, fftshift and relu of every depth, then sum over depths.
+#   'spectral': as the forward model is linear, the spectra of all depths are added up,
+#               and a single irfft2, fftshift and relu is computed, halving the FFTs per iteration.
+#               See XLFM_forward_mode_error for its difference to 'per_depth'.
+# With spectrum_only, 'spectral' returns the summed spectrum before the inverse FFT, to add up partial projections.
+# depth_mask: optional boolean [nDepths] from XLFM_depth_mask, only the depths set to True are projected.
+def XLFM_forward_projection_padded(OTF, ObjTemp, nSplitFourier=1, device='cpu', forward_mode='per_depth', padSize=None, fftshift_in_OTF=False,
+                                    spectrum_only=False, depth_mask=None):
+    assert forward_mode in ['per_depth','spectral'], 'Unknown forward_mode: ' + str(forward_mode)
+    nDepths = ObjTemp.shape[1]
+    ImgEst = 0
     for jj in range(0,nDepths, nSplitFourier):
-        curr_depths = list(range(jj,jj+nSplitFourier))
-        planeOTF = OTF[:,curr_depths,...].to(device)
-        currObjPlanes = ObjTemp[:,curr_depths,...]
-        if len(curr_depths)==1:
-            planeOTF = planeOTF.unsqueeze(1)
-            currObjPlanes = currObjPlanes.unsqueeze(1)
-        planeObjFFT = torch.fft.rfft2(currObjPlanes).to(device)
-        ImgEst += F.relu(batch_fftshift2d_real(torch.fft.irfft2(planeObjFFT * planeOTF))).sum(1).unsqueeze(1)
-    return ImgEst
\ No newline at end of file
+        keep = None if depth_mask is None else depth_mask[jj:jj+nSplitFourier]
+        if keep is not None and not keep.any():
+            continue
+        planeOTF = decompress_OTF(OTF[:,jj:jj+nSplitFourier,...].to(device))
+        planeObj = ObjTemp[:,jj:jj+nSplitFourier,...].to(device).float()
+        if keep is not None and not keep.all():
+            planeOTF = planeOTF[:,keep.to(planeOTF.device)]
+            planeObj = planeObj[:,keep.to(planeObj.device)]
+        if padSize is not None:
+            planeObj = F.pad(planeObj, padSize)
+        planeObjFFT = torch.fft.rfft2(planeObj)
+        if forward_mode=='spectral':
+            ImgEst = ImgEst + (planeObjFFT * planeOTF).sum(1).unsqueeze(1)
+        else:
+            ImgEst = ImgEst + F.relu(batch_fftshift2d_real(torch.fft.irfft2(planeObjFFT * planeOTF), fftshift_in_OTF)).sum(1).unsqueeze(1)
+    if forward_mode=='spectral' and not spectrum_only:
+        ImgEst = F.relu(batch_fftshift2d_real(torch.fft.irfft2(ImgEst), fftshift_in_OTF))
+    return ImgEst
+
+
+# Numerical difference of the 'spectral' forward projection with respect to the 'per_depth' one
+def XLFM_forward_mode_error(OTF, volume, nSplitFourier=6, fftshift_in_OTF=False):
+    img_shape = [volume.shape[0], 1, OTF.shape[2], OTF.shape[2]]
+    with torch.no_grad():
+        img_per_depth = XLFM_forward_projection(OTF, volume.float(), img_shape, nSplitFourier=nSplitFourier, forward_mode='per_depth', fftshift_in_OTF=fftshift_in_OTF)
+        img_spectral = XLFM_forward_projection(OTF, volume.float(), img_shape, nSplitFourier=nSplitFourier, forward_mode='spectral', fftshift_in_OTF=fftshift_in_OTF)
+    diff = img_spectral - img_per_depth
+    return {'max_abs_error' : diff.abs().max().item(),
+            'relative_error' : (diff.norm() / img_per_depth.norm().clamp(min=1e-12)).item()}
+
+
+# Scale a volume so its forward projection carries the same intensity as img, used to bring warm start volumes
+# that come from a different normalization (e.g. XLFMNet predictions) to the range of the image to deconvolve.
+def XLFM_match_intensity(OTF, volume, img, nSplitFourier=6, forward_mode='per_depth', fftshift_in_OTF=False):
+    img_shape = [volume.shape[0], 1, OTF.shape[2], OTF.shape[2]]
+    with torch.no_grad():
+        img_est = XLFM_forward_projection(OTF, volume.float(), img_shape, nSplitFourier=nSplitFourier, forward_mode=forward_mode, fftshift_in_OTF=fftshift_in_OTF)
+    scale = img.float().sum([1,2,3]).cpu() / img_est.sum([1,2,3]).cpu().clamp(min=1e-12)
+    return volume.float() * scale.view(-1,1,1,1).to(volume.device)
+
+
+# Difference of a deconvolution in reduced precision with respect to float32, for the same settings
+def XLFM_precision_error(OTF, img, nIt, precision='float16', **deconv_args):
+    vol_full = XLFMDeconv(OTF, img, nIt, precision='float32', **deconv_args)[0]
+    vol_reduced = XLFMDeconv(OTF, img, nIt, precision=precision, **deconv_args)[0]
+    diff = vol_reduced - vol_full
+    return {'max_abs_error' : diff.abs().max().item(),
+            'relative_error' : (diff.norm() / vol_full.norm().clamp(min=1e-12)).item(),
+            'psnr' : (10 * torch.log10(vol_full.max()**2 / (diff**2).mean().clamp(min=1e-24))).item()}
@@ -0,0 +1,125 @@
+import torch
+import time
+import numpy as np
+import torch.nn.functional as F
+import torch.multiprocessing as mp
+
+from utils.misc_utils import *
+from utils.XLFMDeconv import XLFM_forward_projection_padded, XLFM_backprojection_update
+
+
+# Pool of CPU processes for XLFMDeconv, each one owns a contiguous range of depths of the OTF.
+# Every iteration:
+#   - The volume is copied to a shared memory buffer, and each worker forward projects its depths.
+#     The partial images (or spectra, with forward_mode='spectral') are added up into n_reduce_slots shared buffers,
+#     worker n into slot n % n_reduce_slots under a lock, and the main process adds up the slots.
+#   - The main process computes the ratio and its spectrum, shared with the workers, and each worker
+#     updates its depths of the shared volume in place, which is then copied back.
+# The workers are forked, so the OTF is shared with them without copies and should not be modified while the pool lives.
+# With torch_threads the threads of each worker are set, by default the CPU cores are split between the workers.
+# max_batch_size is the largest batch that XLFMDeconv will deconvolve with the pool.
+class XLFMDeconvPool():
+    def __init__(self, OTF, n_workers, ObjSize=[512,512], max_batch_size=1, n_reduce_slots=4, torch_threads=None):
+        assert torch.is_tensor(OTF), 'XLFMDeconvPool needs an in memory OTF.'
+        self.n_workers = n_workers
+        self.n_depths = OTF.shape[1]
+        self.max_batch_size = max_batch_size
+        self.n_reduce_slots = min(n_reduce_slots, n_workers)
+        if torch_threads is None:
+            torch_threads = max(torch.get_num_threads() // n_workers, 1)
+        img_size = OTF.shape[2]
+
+        # Shared buffers: volume, partial images and spectra, and spectrum of the ratio
+        self.obj = torch.zeros(max_batch_size, self.n_depths, ObjSize[0], ObjSize[1]).share_memory_()
+        self.partial = torch.zeros(self.n_reduce_slots, max_batch_size, 1, img_size, img_size).share_memory_()
+        self.partial_fft = torch.zeros(self.n_reduce_slots, max_batch_size, 1, img_size, OTF.shape[3], dtype=torch.complex64).share_memory_()
+        self.ratio_fft = torch.zeros(max_batch_size, 1, img_size, OTF.shape[3], dtype=torch.complex64).share_memory_()
+
+        ctx = mp.get_context('fork')
+        self.locks = [ctx.Lock() for _ in range(self.n_reduce_slots)]
+        self.depth_ranges = [(int(d[0]),int(d[-1])+1) for d in np.array_split(np.arange(self.n_depths), n_workers) if len(d)>0]
+        self.connections = []
+        self.processes = []
+        for nWorker,depth_range in enumerate(self.depth_ranges):
+            conn,worker_conn = ctx.Pipe()
+            process = ctx.Process(target=_deconv_worker, args=(worker_conn, nWorker, depth_range, OTF, self, torch_threads), daemon=True)
+            process.start()
+            self.connections.append(conn)
+            self.processes.append(process)
+        self.stats = {'wall_time' : 0.0, 'busy_time' : 0.0}
+
+    # Send a command to all the workers and wait for them, returns the wall time and the busy time of each worker
+    def run(self, command):
+        start_time = time.time()
+        for conn in self.connections:
+            conn.send(command)
+        busy = [conn.recv() for conn in self.connections]
+        wall_time = time.time() - start_time
+        self.stats['wall_time'] += wall_time
+        self.stats['busy_time'] += sum(busy)
+        return wall_time, busy
+
+    # Same as XLFM_forward_projection_padded(OTF, ObjTemp, ...) with padSize
+    def forward_projection(self, ObjTemp, padSize, nSplitFourier=1, forward_mode='per_depth', fftshift_in_OTF=False, depth_mask=None):
+        batch_size = ObjTemp.shape[0]
+        assert batch_size <= self.max_batch_size, 'Batch larger than the max_batch_size of the XLFMDeconvPool.'
+        self.obj[:batch_size].copy_(ObjTemp)
+        if forward_mode=='spectral':
+            self.partial_fft[:,:batch_size].zero_()
+        else:
+            self.partial[:,:batch_size].zero_()
+        timing = self.run(('forward', batch_size, padSize, nSplitFourier, forward_mode, fftshift_in_OTF, depth_mask))
+        if forward_mode=='spectral':
+            ImgEst = F.relu(batch_fftshift2d_real(torch.fft.irfft2(self.partial_fft[:,:batch_size].sum(0)), fftshift_in_OTF))
+        else:
+            ImgEst = self.partial[:,:batch_size].sum(0)
+        return ImgEst, timing
+
+    # Same as XLFM_backprojection_update(OTFt, ObjRecon, Ratio, ...), ObjRecon is updated in place.
+    # ObjRecon has to be the volume of the last forward_projection.
+    def backprojection_update(self, ObjRecon, Ratio, padSize, nSplitFourier=1, fftshift_in_OTF=False, depth_mask=None):
+        batch_size = ObjRecon.shape[0]
+        self.ratio_fft[:batch_size].copy_(torch.fft.rfft2(Ratio.cpu()))
+        timing = self.run(('backward', batch_size, padSize, nSplitFourier, fftshift_in_OTF, depth_mask))
+        ObjRecon.copy_(self.obj[:batch_size])
+        return ObjRecon, timing
+
+    # Fraction of the time the workers were computing, over all the iterations so far
+    def utilization(self):
+        return self.stats['busy_time'] / max(self.stats['wall_time'] * len(self.processes), 1e-12)
+
+    def close(self):
+        for conn in self.connections:
+            conn.send(('close',))
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+
+def _deconv_worker(conn, nWorker, depth_range, OTF, buffers, torch_threads):
+    torch.set_num_threads(torch_threads)
+    d0,d1 = depth_range
+    OTF_chunk = OTF[:,d0:d1,...,0]
+    OTFt_chunk = OTF[:,d0:d1,...,1]
+    slot = nWorker % buffers.n_reduce_slots
+    with torch.no_grad():
+        while True:
+            command = conn.recv()
+            if command[0]=='close':
+                break
+            start_time = time.time()
+            if command[0]=='forward':
+                batch_size,padSize,nSplitFourier,forward_mode,fftshift_in_OTF,depth_mask = command[1:]
+                ImgEst = XLFM_forward_projection_padded(OTF_chunk, buffers.obj[:batch_size,d0:d1], nSplitFourier, 'cpu', forward_mode,
+                                                        padSize, fftshift_in_OTF, spectrum_only=True, depth_mask=depth_mask[d0:d1] if depth_mask is not None else None)
+                with buffers.locks[slot]:
+                    if forward_mode=='spectral':
+                        buffers.partial_fft[slot,:batch_size] += ImgEst
+                    else:
+                        buffers.partial[slot,:batch_size] += ImgEst
+            elif command[0]=='backward':
+                batch_size,padSize,nSplitFourier,fftshift_in_OTF,depth_mask = command[1:]
+                XLFM_backprojection_update(OTFt_chunk, buffers.obj[:batch_size,d0:d1], None, padSize, nSplitFourier, 'cpu', fftshift_in_OTF,
+                                            RatioFFT=buffers.ratio_fft[:batch_size], depth_mask=depth_mask[d0:d1] if depth_mask is not None else None)
+            conn.send(time.time() - start_time)
@@ -5,7 +5,13 @@ from PIL import Image
 import torchvision.transforms as TF
 import matplotlib.pyplot as plt
 import re
+import os
+import json
+import time
+import shutil
+import hashlib
 import numpy as np
+from collections import OrderedDict
 import findpeaks
 from tifffile import imread
 
@@ -53,7 +59,7 @@ def volume_2_projections(vol_in, proj_type=torch.max, scaling_factors=[1,1,2], d
     )
 
     out_img[:, :, : vol_size[2], : vol_size[3]] = z_projection
-    out_img[:, :, vol_size[2] + border_thickness :, : vol_size[3]] = F.interpolate(x_projection.permute(0, 1, 3, 2), size=[vol_size[-1],vol_size[-3]])
+    out_img[:, :, vol_size[2] + border_thickness :, : vol_size[3]] = F.interpolate(x_projection.permute(0, 1, 3, 2), size=[vol_size[4],vol_size[3]])
     out_img[:, :, : vol_size[2], vol_size[3] + border_thickness :] = F.interpolate(y_projection, size=[vol_size[2],vol_size[4]])
 
     line_color = out_img.max()
@@ -64,8 +70,8 @@ def volume_2_projections(vol_in, proj_type=torch.max, scaling_factors=[1,1,2], d
     if add_scale_bars:
         start = 0.02
         out_img[:, :, int(start* vol_size[2]):int(start* vol_size[2])+4, int(0.9* vol_size[3]):int(0.9* vol_size[3])+scale_bar_vox_sizes[0]] = line_color
-        out_img[:, :, int(start* vol_size[2]):int(start* vol_size[2])+4, vol_size[2] + border_thickness + 10 : vol_size[2] + border_thickness + 10 + scale_bar_vox_sizes[1]*scaling_factors[2]] = line_color
-        out_img[:, :, vol_size[2] + border_thickness + 10 : vol_size[2] + border_thickness + 10 + scale_bar_vox_sizes[1]*scaling_factors[2], int(start* vol_size[2]):int(start* vol_size[2])+4] = line_color
+        out_img[:, :, int(start* vol_size[2]):int(start* vol_size[2])+4, vol_size[3] + border_thickness + 10 : vol_size[3] + border_thickness + 10 + scale_bar_vox_sizes[1]*scaling_factors[2]] = line_color
+        out_img[:, :, vol_size[2] + border_thickness + 10 : vol_size[2] + border_thickness + 10 + scale_bar_vox_sizes[1]*scaling_factors[2], int(start* vol_size[3]):int(start* vol_size[3])+4] = line_color
 
     return out_img
 
@@ -106,7 +112,10 @@ def roll_n(X, axis, n):
     front = X[f_idx]
     back = X[b_idx]
     return torch.cat([back, front], axis)
-def batch_fftshift2d_real(x):
+def batch_fftshift2d_real(x, fftshift_in_OTF=False):
+    # Compatibility path: if the OTF was loaded with fftshift_in_OTF the shift is already applied
+    if fftshift_in_OTF:
+        return x
     out = x
     for dim in range(2, len(out.size())):
         n_shift = x.size(dim)//2
@@ -114,9 +123,44 @@ def batch_fftshift2d_real(x):
             n_shift += 1  # for odd-sized images
         out = roll_n(out, axis=dim, n=n_shift)
     return out  
+# Crop fftshift(x)[...,start[0]:start[0]+size[0],start[1]:start[1]+size[1]] directly from x,
+# without building the full shifted copy. Returns views of x unless the crop wraps around the border.
+# With fftshift_in_OTF x is already shifted and only cropped.
+def crop_fftshift2d_real(x, start, size, fftshift_in_OTF=False):
+    out = x
+    for n in range(2):
+        dim = x.ndim-2+n
+        n_shift = x.size(dim)//2
+        if x.size(dim) % 2 != 0:
+            n_shift += 1  # for odd-sized images
+        if fftshift_in_OTF:
+            n_shift = 0
+        first = (start[n] + n_shift) % x.size(dim)
+        if first + size[n] <= x.size(dim):
+            out = out.narrow(dim, first, size[n])
+        else:
+            out = torch.cat([out.narrow(dim, first, x.size(dim)-first), out.narrow(dim, 0, size[n]-(x.size(dim)-first))], dim)
+    return out
+# Phase ramp that applies batch_fftshift2d_real in the Fourier domain:
+# irfft2(X * fftshift_phase_ramp(shape)) == batch_fftshift2d_real(irfft2(X)), for real signals of size shape [H,W].
+# irfft2 is used without its size, which only recovers signals of even width.
+def fftshift_phase_ramp(shape, device="cpu"):
+    assert shape[-1] % 2 == 0, 'The fftshift can only be folded into the OTF for an even FFT width, got ' + str(shape[-1])
+    ramps = []
+    for n,N in enumerate(shape[-2:]):
+        n_shift = N//2 + N%2
+        k = torch.arange(N if n==0 else N//2+1, dtype=torch.float64)
+        if N % 2 == 0:
+            # Exact +-1 for even sizes
+            ramps.append((1 - 2*(k % 2)).to(torch.complex128))
+        else:
+            ramps.append(torch.exp(2j * np.pi * ((k*n_shift) % N) / N))
+    return (ramps[0].unsqueeze(1) * ramps[1].unsqueeze(0)).to(torch.complex64).to(device)
 
 # FFT convolution, the kernel fft can be precomputed
-def fft_conv(A,B, fullSize, Bshape=[],B_precomputed=False):
+# If the precomputed kernel has the fftshift baked in (see load_PSF_OTF) use fftshift_in_OTF.
+# With sum_channels the channels of the result are added up in the Fourier domain, needing a single inverse FFT.
+def fft_conv(A,B, fullSize, Bshape=[],B_precomputed=False, fftshift_in_OTF=False, sum_channels=False):
     import torch.fft
     nDims = A.ndim-2
     # fullSize = torch.tensor(A.shape[2:]) + Bshape
@@ -130,7 +174,9 @@ def fft_conv(A,B, fullSize, Bshape=[],B_precomputed=False):
     A_padded = F.pad(A,padSizesA)
     Afft = torch.fft.rfft2(A_padded)
     if B_precomputed:
-        return batch_fftshift2d_real(torch.fft.irfft2( Afft * B.detach()))
+        if sum_channels:
+            return batch_fftshift2d_real(torch.fft.irfft2( (Afft * B.detach()).sum(1).unsqueeze(1)), fftshift_in_OTF)
+        return batch_fftshift2d_real(torch.fft.irfft2( Afft * B.detach()), fftshift_in_OTF)
     else:
         padSizeB = (fullSize - torch.tensor(B.shape[2:]))
         padSizesB = torch.zeros(2*nDims,dtype=int)
@@ -151,20 +197,12 @@ def reprojection_loss_camera(gt_imgs, prediction, PSF, camera, dataset, device="
 
     return loss.type(out_type), reprojection_views.type(out_type), gt_imgs.type(out_type), reprojection.type(out_type)
 
-def reprojection_loss(gt_imgs, prediction, OTF, psf_shape, dataset, n_split=20, device="cpu", loss=F.mse_loss):
+# Reprojection of the whole batch: the batch goes through fft_conv_split at once, and the lenslet views are
+# extracted with gather_lenslet_views.
+def reprojection_loss(gt_imgs, prediction, OTF, psf_shape, dataset, n_split=20, device="cpu", loss=F.mse_loss, fftshift_in_OTF=False):
     out_type = gt_imgs.type()
-    batch_size = prediction.shape[0]
-    reprojection = fft_conv_split(prediction[0,...].unsqueeze(0), OTF, psf_shape, n_split, B_precomputed=True, device=device)
-
-    reprojection_views = torch.zeros_like(gt_imgs)
-    reprojection_views[0,...] = dataset.extract_views(reprojection, dataset.lenslet_coords, dataset.subimage_shape)[0,0,...]
-
-    # full_reprojection = reprojection.detach()
-    # reprojection_views = reprojection_views.unsqueeze(0).repeat(batch_size,1,1,1)
-    for nSample in range(1,batch_size):
-        reprojection = fft_conv_split(prediction[nSample,...].unsqueeze(0), OTF, psf_shape, n_split, B_precomputed=True, device=device)
-        reprojection_views[nSample,...] = dataset.extract_views(reprojection, dataset.lenslet_coords, dataset.subimage_shape)[0,0,...]
-        # full_reprojection += reprojection.detach()
+    reprojection = fft_conv_split(prediction, OTF, psf_shape, n_split, B_precomputed=True, device=device, fftshift_in_OTF=fftshift_in_OTF)
+    reprojection_views = gather_lenslet_views(reprojection, dataset.lenslet_coords, dataset.subimage_shape)[:,0,...].to(gt_imgs.device, gt_imgs.dtype)
 
     # gt_imgs /= gt_imgs.float().max()
     # reprojection_views /= reprojection_views.float().max()
@@ -174,11 +212,88 @@ def reprojection_loss(gt_imgs, prediction, OTF, psf_shape, dataset, n_split=20,
 
     return loss.type(out_type), reprojection_views.type(out_type), gt_imgs.type(out_type), reprojection.type(out_type)
 
+# Plans of gather_lenslet_views, by lenslet coordinates, subimage shape, image shape and device, the last ones used kept
+LENSLET_VIEW_PLANS = OrderedDict()
+LENSLET_VIEW_PLANS_SIZE = 16
+
+# Where each lenslet view of extract_views lies in the image, computed once per layout. A view is the window of the image
+# starting at starts, the patch clipped by the image border aligned to the bottom right of the view:
+#   pad: zero padding (left, right, top, bottom) for the windows crossing the image border.
+#   starts: [2][n_lenslets] first row and column of each window in the padded image.
+#   zeros: [n_lenslets,subimage_shape[0],subimage_shape[1]] True where the view is zero but the window is inside the image
+#          (clipped patches not touching the top or left border and odd subimage_shape), None if there is no such place.
+def lenslet_view_plan(lenslet_coords, subimage_shape, image_shape, device='cpu'):
+    key = (tuple(lenslet_coords.flatten().tolist()), tuple(subimage_shape), tuple(image_shape), str(device))
+    if key in LENSLET_VIEW_PLANS:
+        LENSLET_VIEW_PLANS.move_to_end(key)
+        return LENSLET_VIEW_PLANS[key]
+    starts = []
+    first_valid = []
+    needs_mask = False
+    for n in range(2):
+        starts.append([])
+        first_valid.append([])
+        for c in lenslet_coords[:,n].tolist():
+            # Same bounds as the slicing in extract_views
+            lower,upper,_ = slice(max(c-subimage_shape[n]//2,0), c+subimage_shape[n]//2).indices(image_shape[n])
+            patch_size = max(upper-lower, 0)
+            assert patch_size <= subimage_shape[n], 'Lenslet at ' + str(c) + ' out of an image of ' + str(image_shape[n])
+            starts[n].append(lower + patch_size - subimage_shape[n])
+            first_valid[n].append(subimage_shape[n] - patch_size)
+            needs_mask = needs_mask or (lower > 0 and patch_size < subimage_shape[n])
+    pad = []
+    for n in [1,0]:
+        pad += [max(-min(starts[n]),0), max(max(starts[n]) + subimage_shape[n] - image_shape[n],0)]
+    plan = {'pad' : pad,
+            'starts' : [torch.tensor(starts[0], device=device) + pad[2], torch.tensor(starts[1], device=device) + pad[0]],
+            'zeros' : None}
+    if needs_mask:
+        masks = [torch.arange(subimage_shape[n], device=device).unsqueeze(0) >= torch.tensor(first_valid[n], device=device).unsqueeze(1) for n in range(2)]
+        plan['zeros'] = ~(masks[0].unsqueeze(2) & masks[1].unsqueeze(1))
+    LENSLET_VIEW_PLANS[key] = plan
+    if len(LENSLET_VIEW_PLANS) > LENSLET_VIEW_PLANS_SIZE:
+        LENSLET_VIEW_PLANS.popitem(last=False)
+    return plan
+
+# Same result as XLFMDatasetFull.extract_views, [B,C,n_lenslets,subimage_shape[0],subimage_shape[1]]. On the GPU all
+# the lenslet windows of the image are gathered at once with unfold_lenslet_views, on the CPU copying the patches one
+# by one is faster.
+def gather_lenslet_views(image, lenslet_coords, subimage_shape):
+    if image.device.type=='cpu':
+        return copy_lenslet_views(image, lenslet_coords, subimage_shape)
+    return unfold_lenslet_views(image, lenslet_coords, subimage_shape)
+
+# Lenslet views gathered at once from the windows of the image, with the plan of lenslet_view_plan
+def unfold_lenslet_views(image, lenslet_coords, subimage_shape):
+    plan = lenslet_view_plan(lenslet_coords, subimage_shape, image.shape[-2:], image.device)
+    if any(p>0 for p in plan['pad']):
+        image = F.pad(image, plan['pad'])
+    windows = image.unfold(2, subimage_shape[0], 1).unfold(3, subimage_shape[1], 1)
+    stacked_views = windows[:,:,plan['starts'][0],plan['starts'][1]]
+    if plan['zeros'] is not None:
+        stacked_views.masked_fill_(plan['zeros'], 0)
+    return stacked_views
+
+def copy_lenslet_views(image, lenslet_coords, subimage_shape):
+    half_subimg_shape = [subimage_shape[0]//2,subimage_shape[1]//2]
+    n_lenslets = lenslet_coords.shape[0]
+    stacked_views = torch.zeros(size=[image.shape[0], image.shape[1], n_lenslets, subimage_shape[0], subimage_shape[1]], device=image.device, dtype=image.dtype)
+    for nLens in range(n_lenslets):
+        # Fetch coordinates
+        currCoords = lenslet_coords[nLens,:]
+        # Grab patches
+        lower_bounds = [currCoords[0]-half_subimg_shape[0], currCoords[1]-half_subimg_shape[1]]
+        lower_bounds = [max(lower_bounds[kk],0) for kk in range(2)]
+        currPatch = image[:,:,lower_bounds[0] : currCoords[0]+half_subimg_shape[0], lower_bounds[1] : currCoords[1]+half_subimg_shape[1]]
+        stacked_views[:,:,nLens,-currPatch.shape[2]:,-currPatch.shape[3]:] = currPatch
+    return stacked_views
+
 # Split an fft convolution into batches containing different depths
-def fft_conv_split(A, B, psf_shape, n_split, B_precomputed=False, device = "cpu"):
+# A can hold a batch of volumes, with a precomputed OTF the depths of each split are added up before the inverse FFT.
+def fft_conv_split(A, B, psf_shape, n_split, B_precomputed=False, device = "cpu", fftshift_in_OTF=False):
     n_depths = A.shape[1]
     
-    split_conv = n_depths//n_split
+    split_conv = max(n_depths//n_split, 1)
     depths = list(range(n_depths))
     depths = [depths[i:i + split_conv] for i in range(0, n_depths, split_conv)]
 
@@ -190,10 +305,10 @@ def fft_conv_split(A, B, psf_shape, n_split, B_precomputed=False, device = "cpu"
     img_new = torch.zeros(A.shape[0], 1, psf_shape[0], psf_shape[1], device=device)
     if B_precomputed == False:
         OTF_out = torch.zeros(1, n_depths, fullSize[0], fullSize[1]//2+1, requires_grad=False, dtype=torch.complex64, device=device)
-    for n in range(n_split):
+    for n in range(len(depths)):
         # print(n)
         curr_psf = B[:,depths[n],...].to(device)
-        img_curr = fft_conv(A[:,depths[n],...].to(device), curr_psf, fullSize, psf_shape, B_precomputed)
+        img_curr = fft_conv(A[:,depths[n],...].to(device), curr_psf, fullSize, psf_shape, B_precomputed, fftshift_in_OTF, sum_channels=B_precomputed)
         if B_precomputed == False:
             OTF_out[:,depths[n],...] = img_curr[1]
             img_curr = img_curr[0]
@@ -307,31 +422,185 @@ def load_PSF(filename, n_depths=120):
 
 def load_PSF_OTF(filename, vol_size, n_split=20, n_depths=120, downS=1, device="cpu",
                  dark_current=106, calc_max=False, psfIn=None, compute_transpose=False,
-                 n_lenslets=29, lenslet_centers_file_out='lenslet_centers_python.txt'):
+                 n_lenslets=29, lenslet_centers_file_out='lenslet_centers_python.txt', cache_dir=None, fftshift_in_OTF=False):
+    # fftshift_in_OTF: multiply the OTF (and its transpose) by fftshift_phase_ramp, so the convolutions using it
+    #                  don't need batch_fftshift2d_real, the functions using the OTF need the same flag.
+    # downS: lateral downsampling of the PSF (by area, each depth still adds up to one), the OTF is then
+    #        for volumes of size vol_size//downS and the returned psf_shape is the downsampled one.
+    # Check if this OTF was already computed and stored in the cache
+    cache_path = None
+    if cache_dir:
+        if psfIn is None:
+            psf_hash = hash_file(filename)
+        else:
+            psf_hash = hashlib.sha1(psfIn.float().contiguous().cpu().numpy().tobytes()).hexdigest()
+        cache_path = os.path.join(cache_dir, get_OTF_cache_key(psf_hash, vol_size, n_depths, downS, compute_transpose, fftshift_in_OTF))
+        cache_entry = load_OTF_cache_entry(cache_path)
+        if cache_entry is not None:
+            OTF, psf_shape, psfMaxCoeffs = cache_entry
+            if len(lenslet_centers_file_out)>0:
+                lenslet_centers = get_OTF_cache_lenslet_centers(cache_path, filename, n_depths, n_lenslets, psfIn)
+                np.savetxt(lenslet_centers_file_out, lenslet_centers, fmt='%d', delimiter='\t')
+            OTF = OTF.to(device)
+            if calc_max:
+                return OTF, psf_shape, psfMaxCoeffs
+            return OTF, psf_shape
+
     # Load PSF
     if psfIn is None:
         psfIn = load_PSF(filename, n_depths)
 
+    lenslet_centers = None
     if len(lenslet_centers_file_out)>0:
-        find_lenslet_centers(psfIn[0,n_depths//2,...].numpy(), n_lenslets=n_lenslets, file_out_name=lenslet_centers_file_out)
-    if calc_max:
-        psfMaxCoeffs = torch.amax(psfIn, dim=[0,2,3])
+        lenslet_centers = find_lenslet_centers(psfIn[0,n_depths//2,...].numpy(), n_lenslets=n_lenslets, file_out_name=lenslet_centers_file_out)
+    if downS > 1:
+        psfIn = F.avg_pool2d(psfIn.float(), downS)
+        psfIn = psfIn / psfIn.sum([2,3], keepdim=True).clamp(min=1e-12)
+    psfMaxCoeffs = torch.amax(psfIn, dim=[0,2,3])
 
     psf_shape = torch.tensor(psfIn.shape[2:])
-    vol = torch.rand(1,psfIn.shape[1], vol_size[0], vol_size[1], device=device)
+    vol = torch.rand(1,psfIn.shape[1], vol_size[0]//downS, vol_size[1]//downS, device=device)
     img, OTF = fft_conv_split(vol, psfIn.float().detach().to(device), psf_shape, n_split=n_split, device=device)
     
     OTF = OTF.detach()
 
     if compute_transpose:
         OTFt = torch.real(OTF) - 1j * torch.imag(OTF)
+    if fftshift_in_OTF:
+        # Size of the real FFTs of the convolutions, volume plus PSF
+        ramp = fftshift_phase_ramp([int(s) for s in torch.tensor(vol.shape[2:]) + psf_shape], device=OTF.device)
+        OTF *= ramp
+        if compute_transpose:
+            OTFt *= ramp
+    if compute_transpose:
         OTF = torch.cat((OTF.unsqueeze(-1), OTFt.unsqueeze(-1)), 4)
+
+    if cache_path is not None:
+        save_OTF_cache_entry(cache_path, OTF, psf_shape, psfMaxCoeffs,
+            {'psf_file':filename, 'psf_hash':psf_hash, 'vol_size':[int(v) for v in vol_size[:2]],
+             'n_depths':n_depths, 'downS':downS, 'compute_transpose':bool(compute_transpose), 'fftshift_in_OTF':bool(fftshift_in_OTF),
+             'lenslet_centers':{} if lenslet_centers is None else {str(n_lenslets) : lenslet_centers.tolist()}})
+
     if calc_max:
         return OTF, psf_shape, psfMaxCoeffs
     else:
         return OTF,psf_shape
 
 
+# Persistent OTF cache
+# Each entry is a directory <cache_dir>/<key> containing the OTF as a .npy file, which is memory-mapped
+# when loaded, and a meta.json with the parameters used to compute it.
+OTF_CACHE_DIR = os.environ.get('XLFM_OTF_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'XLFM_OTF'))
+
+def hash_file(filename, block_size=2**24):
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def get_OTF_cache_key(psf_hash, vol_size, n_depths, downS=1, compute_transpose=False, fftshift_in_OTF=False):
+    vol_size = 'x'.join([str(int(v)) for v in vol_size[:2]])
+    return psf_hash[:16] + '_' + vol_size + '_' + str(n_depths) + 'nD_' + str(downS) + 'dS_' + ('T' if compute_transpose else 'N') + ('S' if fftshift_in_OTF else '')
+
+def load_OTF_cache_entry(cache_path):
+    try:
+        with open(os.path.join(cache_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        # Copy on write memory map, so the OTF can be modified in place without touching the file
+        OTF = torch.from_numpy(np.load(os.path.join(cache_path, 'OTF.npy'), mmap_mode='c'))
+    except (OSError, ValueError):
+        return None
+    # Mark entry as recently used, for eviction
+    os.utime(cache_path)
+    return OTF, torch.tensor(meta['psf_shape']), torch.tensor(meta['psf_max_coeffs'])
+
+def save_OTF_cache_entry(cache_path, OTF, psf_shape, psfMaxCoeffs, meta):
+    # Write to a temporary directory first, so concurrent runs never see half written entries
+    tmp_path = cache_path + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'OTF.npy'), OTF.cpu().numpy())
+    meta = dict(meta, psf_shape=[int(s) for s in psf_shape], psf_max_coeffs=psfMaxCoeffs.float().tolist(),
+                OTF_shape=list(OTF.shape), created=time.time())
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process stored this entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+# Lenslet centers found in the PSF of a cache entry, stored in its meta.json by number of lenslets. Entries stored
+# without them get them the first time, the only time the PSF is loaded on a cache hit.
+def get_OTF_cache_lenslet_centers(cache_path, filename, n_depths, n_lenslets=29, psfIn=None):
+    lenslet_centers = load_OTF_cache_lenslet_centers(cache_path, n_lenslets)
+    if lenslet_centers is None:
+        if psfIn is None:
+            psfIn = load_PSF(filename, n_depths)
+        lenslet_centers = find_lenslet_centers(psfIn[0,n_depths//2,...].numpy(), n_lenslets=n_lenslets, file_out_name='')
+        save_OTF_cache_lenslet_centers(cache_path, n_lenslets, lenslet_centers)
+    return lenslet_centers
+
+def load_OTF_cache_lenslet_centers(cache_path, n_lenslets):
+    try:
+        with open(os.path.join(cache_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    lenslet_centers = meta.get('lenslet_centers', {}).get(str(n_lenslets))
+    return None if lenslet_centers is None else np.array(lenslet_centers, dtype=int)
+
+def save_OTF_cache_lenslet_centers(cache_path, n_lenslets, lenslet_centers):
+    meta_path = os.path.join(cache_path, 'meta.json')
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return
+    meta.setdefault('lenslet_centers', {})[str(n_lenslets)] = np.asarray(lenslet_centers).tolist()
+    # Replace meta.json at once, as other processes could be reading it
+    tmp_path = meta_path + '.tmp' + str(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp_path, meta_path)
+
+def list_OTF_cache(cache_dir=OTF_CACHE_DIR):
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for key in sorted(os.listdir(cache_dir)):
+        cache_path = os.path.join(cache_dir, key)
+        try:
+            with open(os.path.join(cache_path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        meta['key'] = key
+        meta['size'] = sum(os.path.getsize(os.path.join(cache_path, f)) for f in os.listdir(cache_path))
+        meta['last_used'] = os.path.getmtime(cache_path)
+        entries.append(meta)
+    return entries
+
+def evict_OTF_cache(cache_dir=OTF_CACHE_DIR, keys=None, max_size_gb=None):
+    # Remove the given entries, or the least recently used ones until the cache fits in max_size_gb
+    entries = list_OTF_cache(cache_dir)
+    if keys is not None:
+        to_remove = [e for e in entries if e['key'] in keys]
+    elif max_size_gb is not None:
+        to_remove = []
+        total_size = sum(e['size'] for e in entries)
+        for e in sorted(entries, key=lambda e: e['last_used']):
+            if total_size <= max_size_gb * 2**30:
+                break
+            to_remove.append(e)
+            total_size -= e['size']
+    else:
+        to_remove = entries
+    for e in to_remove:
+        shutil.rmtree(os.path.join(cache_dir, e['key']), ignore_errors=True)
+    return [e['key'] for e in to_remove]
+
+
 def find_lenslet_centers(img, n_lenslets=29, file_out_name='lenslet_centers_python.txt'):
     fp2 = findpeaks.findpeaks()
     